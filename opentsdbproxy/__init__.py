@@ -1,10 +1,25 @@
+import time
+import signal
 import logging
 
+import gevent
+
+from gevent import socket, ssl
 from gevent.server import StreamServer
 from gevent.pool import Pool
+from gevent.event import Event
 
-from opentsdbproxy.backends import backends
-from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.authcache import AuthSession, auth_cache
+from opentsdbproxy.backends import backends, load_backend_config
+from opentsdbproxy.exceptions import ConfigurationException, SessionExpired, \
+    UpstreamUnavailable
+from opentsdbproxy.framing import LineReader, DecompressionError
+from opentsdbproxy.httpapi import HTTPIngestServer
+from opentsdbproxy.stats import registry, StatsServer
+from opentsdbproxy.tls import make_server_context, read_fingerprint, HANDSHAKE_SECONDS, \
+    HANDSHAKE_FAILURES
+from opentsdbproxy.spool import worker_spool_dir
+from opentsdbproxy.workers import reuse_port_listener
 
 log = logging.getLogger(__name__)
 
@@ -12,67 +27,304 @@ __version__ = "0.1.3"
 __fullversion__ = "OpenTSDB Proxy %s" % __version__
 
 MAX_CONNECTIONS = 10000
-BUF_SIZE = 4096
+BUF_SIZE = 65536
+MAX_LINE_LENGTH = 8192
+HANDSHAKE_TIMEOUT = 10
+DRAIN_TIMEOUT = 30
+UNAVAILABLE_LOG_INTERVAL = 10
 DEFAULT_PORT = 4242
 DEFAULT_BACKEND_PARAMS = {}
 
+CONNECTIONS = registry.counter('connections_total', "Client connections accepted")
+LINES_RECEIVED = registry.counter('lines_received_total', "Lines received from clients")
+BYTES_RECEIVED = registry.counter('bytes_received_total', "Bytes received from clients")
+RECV_SECONDS = registry.histogram('recv_seconds',
+    "Time handle_message spends reading each batch of lines, including waiting for data")
+HANDLE_SECONDS = registry.histogram('handle_seconds',
+    "Time the backend spends handling each batch of lines")
+RELOADS = registry.counter('reloads_total', "SIGHUP reloads by result", ('result',))
+UNAVAILABLE_DROPPED_LINES = registry.counter('upstream_unavailable_dropped_lines_total',
+    "Lines dropped because no OpenTSDB connection was available and there is no spool")
+
+# gevent.signal was renamed in gevent 1.5
+signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+
 
 class OpenTSDBProxy(object):
 
     def __init__(self, port=None, backend=None, backend_parameters=None,
-            ssl_cert_path=None, ssl_key_path=None):
+            ssl_cert_path=None, ssl_key_path=None, max_line_length=None, reuse_port=False,
+            stats_port=None, ssl_ciphers=None, ssl_ecdh_curve=None, ssl_session_tickets=True,
+            plaintext_port=None, compression=True, max_compression_ratio=None, http_port=None,
+            http_max_body=None, backend_config=None, drain_timeout=None, auth_sessions=False,
+            worker=None, ssl_context=None):
 
         self.port = port
         if self.port is None:
             self.port = DEFAULT_PORT
 
+        self.max_line_length = max_line_length
+        if self.max_line_length is None:
+            self.max_line_length = MAX_LINE_LENGTH
+
+        self.compression = compression
+        self.auth_sessions = auth_sessions
+        self.max_compression_ratio = max_compression_ratio
+
+        self.drain_timeout = drain_timeout
+        if self.drain_timeout is None:
+            self.drain_timeout = DRAIN_TIMEOUT
+        self.draining = False
+        self.stopped = Event()
+        self.unavailable_logged = 0
+        self.unavailable_dropped = 0
+
         if backend_parameters is None:
             backend_parameters = {}
 
-        Backend = backends.get(backend)
-        if Backend is None:
+        self.Backend = backends.get(backend)
+        if self.Backend is None:
             raise ConfigurationException("The '%s' backend isn't supported" % backend)
-        self.backend = Backend(**backend_parameters)
+        self.backend_parameters = backend_parameters
+        self.backend_config = backend_config
+        self.worker = worker
+        self.backend = self.make_backend()
 
         if ssl_cert_path is None or ssl_key_path is None:
             raise ConfigurationException("An SSL cert and key must be provided")
+        self.ssl_parameters = dict(cert_path=ssl_cert_path, key_path=ssl_key_path,
+            ciphers=ssl_ciphers, ecdh_curve=ssl_ecdh_curve, session_tickets=ssl_session_tickets)
+        self.ssl_fingerprint = read_fingerprint(ssl_cert_path, ssl_key_path)
+        # A context made before forking into workers shares its ticket keys
+        self.ssl_context = ssl_context or make_server_context(**self.ssl_parameters)
 
         self.pool = Pool(MAX_CONNECTIONS)
+        registry.gauge('client_greenlets', "Greenlets handling client connections",
+            callback=lambda: len(self.pool))
+        registry.gauge('client_greenlets_free', "Free client connection slots",
+            callback=self.pool.free_count)
+
+        self.stats_server = None
+        if stats_port is not None:
+            self.stats_server = StatsServer(stats_port)
+            self.stats_server.start()
         log.debug("Starting server with SSL cert '%s' and key '%s'" % (ssl_cert_path, ssl_key_path))
 
-        self.server = StreamServer(('', self.port), self.handle_message,
-            certfile=ssl_cert_path, keyfile=ssl_key_path,
+        # The TLS handshake is done in handle_tls rather than by the server,
+        # so it can be timed and its failures counted
+        self.server = StreamServer(self.listener(self.port, reuse_port), self.handle_tls,
             spawn=self.pool)
+
+        self.plaintext_server = None
+        if plaintext_port is not None:
+            self.plaintext_server = StreamServer(self.listener(plaintext_port, reuse_port),
+                self.handle_message, spawn=self.pool)
+            self.plaintext_server.start()
+            log.info("%s serving plaintext on port %s" % (__fullversion__, plaintext_port))
+
+        self.http_server = None
+        if http_port is not None:
+            self.http_server = HTTPIngestServer(self.backend, self.listener(http_port, reuse_port),
+                ssl_context=self.ssl_context, spawn=self.pool, max_body=http_max_body)
+            self.http_server.start()
+
+        signal_handler(signal.SIGHUP, self.reload)
+        signal_handler(signal.SIGTERM, self.drain)
+
         log.info("%s serving on port %s" % (__fullversion__, self.port))
+        self.server.start()
         try:
-            self.server.serve_forever()
+            # Rather than serve_forever, so closing the listener to drain
+            # doesn't also stop the clients still connected
+            self.stopped.wait()
         except KeyboardInterrupt:
             log.info("Stopping server...")
             self.server.stop()
+            if self.plaintext_server is not None:
+                self.plaintext_server.stop()
+            if self.http_server is not None:
+                self.http_server.stop()
+            self.backend.close()
+            if self.stats_server is not None:
+                self.stats_server.stop()
             log.info("Server stopped")
 
+    def make_backend(self):
+        """make_backend
+
+        @returns - a backend built from backend_parameters, overridden by
+                   the backend config file if there is one
+        """
+        parameters = dict(self.backend_parameters)
+        if self.backend_config is not None:
+            parameters.update(load_backend_config(self.backend_config))
+        if parameters.get('spool_dir') is not None:
+            parameters['spool_dir'] = worker_spool_dir(parameters['spool_dir'], self.worker)
+        return self.Backend(**parameters)
+
+    def reload(self):
+        """reload
+
+        Called on SIGHUP. Reload the TLS cert and key and rebuild the backend,
+        so credentials and the backend config file are read again. Connected
+        clients stay connected and their next message goes to the new backend.
+        If anything fails to load, the old TLS context and backend are kept.
+        """
+        log.info("Reloading...")
+        # A new context would have new session ticket keys, and workers'
+        # keys would no longer match, so it is only made if the cert changed
+        fingerprint = read_fingerprint(self.ssl_parameters['cert_path'],
+            self.ssl_parameters['key_path'])
+        ssl_context = self.ssl_context
+        if fingerprint is None or fingerprint != self.ssl_fingerprint:
+            try:
+                ssl_context = make_server_context(**self.ssl_parameters)
+            except ConfigurationException as e:
+                log.error("Keeping the previous configuration, couldn't reload TLS: %s" % e)
+                RELOADS.labels('failed').inc()
+                return
+
+        old_backend = self.backend
+        old_backend.pause()
+        try:
+            backend = self.make_backend()
+        except (ConfigurationException, Exception) as e:
+            log.exception("Keeping the previous configuration, couldn't reload the backend: %s" % e)
+            old_backend.resume()
+            RELOADS.labels('failed').inc()
+            return
+
+        self.ssl_context = ssl_context
+        self.ssl_fingerprint = fingerprint
+        self.backend = backend
+        if self.http_server is not None:
+            self.http_server.ssl_context = ssl_context
+            self.http_server.backend = backend
+        auth_cache.invalidate()
+
+        # Queued writes still go out through the old backend's connections
+        old_backend.close()
+        RELOADS.labels('succeeded').inc()
+        log.info("Reloaded")
+
+    def drain(self):
+        """drain
+
+        Called on SIGTERM. Stop accepting connections, let clients finish the
+        message they are sending for up to half of drain_timeout, then give
+        queued writes the rest of it to reach OpenTSDB before exiting.
+        """
+        if self.draining:
+            return
+        self.draining = True
+        deadline = time.time() + self.drain_timeout
+        log.info("Draining for up to %ss..." % self.drain_timeout)
+
+        for server in (self.server, self.plaintext_server, self.http_server):
+            if server is not None:
+                server.close()
+
+        client_deadline = time.time() + self.drain_timeout / 2.0
+        while len(self.pool) and time.time() < client_deadline:
+            gevent.sleep(0.1)
+        if len(self.pool):
+            log.warning("Closing %d client connections that are still open" % len(self.pool))
+            self.pool.kill(block=True, timeout=1)
+
+        self.backend.close(max(0, deadline - time.time()))
+        if self.stats_server is not None:
+            self.stats_server.stop()
+        log.info("Drained")
+        self.stopped.set()
+
+    def listener(self, port, reuse_port):
+        if reuse_port:
+            return reuse_port_listener(port)
+        return ('', port)
+
+    def handle_tls(self, sock, address):
+        started = time.time()
+        try:
+            with gevent.Timeout(HANDSHAKE_TIMEOUT):
+                tls_sock = self.ssl_context.wrap_socket(sock, server_side=True)
+        except (ssl.SSLError, socket.error, gevent.Timeout) as e:
+            HANDSHAKE_FAILURES.inc()
+            log.debug("TLS handshake with %s failed: %s" % (address, e))
+            sock.close()
+            return
+        HANDSHAKE_SECONDS.observe(time.time() - started)
+        self.handle_message(tls_sock, address)
+
+    def upstream_unavailable(self, error, message):
+        """upstream_unavailable
+
+        Count a message dropped because OpenTSDB couldn't be reached, logging
+        at most once every UNAVAILABLE_LOG_INTERVAL seconds
+
+        @param error - the UpstreamUnavailable raised
+        @param message - the lines that were dropped
+        """
+        lines = message.count('\n')
+        UNAVAILABLE_DROPPED_LINES.inc(lines)
+        self.unavailable_dropped += lines
+        now = time.time()
+        if now - self.unavailable_logged >= UNAVAILABLE_LOG_INTERVAL:
+            log.warning("%s, dropped %d lines" % (error, self.unavailable_dropped))
+            self.unavailable_logged = now
+            self.unavailable_dropped = 0
+
     def handle_message(self, sock, address):
         log.debug("Opening socket")
+        CONNECTIONS.inc()
 
-        while True:
-            message = ''
+        reader = LineReader(sock, recv_size=BUF_SIZE,
+            max_line_length=self.max_line_length, compression=self.compression,
+            max_compression_ratio=self.max_compression_ratio)
+        # Credentials are then checked once per connection rather than per line
+        session = AuthSession() if self.auth_sessions else None
+        try:
             while True:
-                bufr = sock.recv(BUF_SIZE)
-                message += bufr
-                if len(bufr) != BUF_SIZE:
+                started = time.time()
+                message = reader.read_lines()
+                received = time.time()
+                RECV_SECONDS.observe(received - started)
+                if message == '':
                     break
-            log.debug("Received: '%s'" % message)
-
-            if message == '':
-                break
+                log.debug("Received: '%s'" % message)
+                LINES_RECEIVED.inc(message.count('\n'))
+                BYTES_RECEIVED.inc(len(message))
 
-            response = self.backend.handle(message)
-            if response is not None:
-                log.debug("Responded: '%s'" % response)
-                sock.sendall(response)
-            else:
-                log.debug("Got no response from backend")
-                break
-
-        sock.close()
-        log.debug("Closing socket")
+                try:
+                    response = self.backend.handle(message, address=address, session=session)
+                except UpstreamUnavailable as e:
+                    # The connection stays open, so the client isn't made to
+                    # reconnect over and over while OpenTSDB is down
+                    self.upstream_unavailable(e, message)
+                    response = None
+                HANDLE_SECONDS.observe(time.time() - received)
+                if response is not None:
+                    log.debug("Responded: '%s'" % response)
+                    sock.sendall(response)
+                if self.draining:
+                    # So the client reconnects to another proxy
+                    break
+        except (ssl.SSLError, socket.error) as e:
+            log.debug("Connection from %s failed: %s" % (address, e))
+        except DecompressionError as e:
+            log.warning("Closing connection from %s: %s" % (address, e))
+        except SessionExpired as e:
+            # The client reconnects and authenticates again
+            log.info("Closing connection from %s: %s" % (address, e))
+            try:
+                sock.sendall("%s\n" % e)
+            except (ssl.SSLError, socket.error):
+                pass
+        finally:
+            if reader.dropped_lines:
+                log.warning("Dropped %d overlong lines from %s" % (reader.dropped_lines, address))
+            if reader.algorithm is not None:
+                log.debug("%s stream from %s: %d bytes in, %d bytes out, ratio %.1f, %.3fs CPU" % (
+                    reader.algorithm, address, reader.compressed_bytes, reader.decompressed_bytes,
+                    reader.compression_ratio or 0, reader.decompress_seconds))
+            sock.close()
+            log.debug("Closing socket")
@@ -0,0 +1,181 @@
+import os
+import hmac
+import time
+import hashlib
+import logging
+
+from collections import OrderedDict
+
+from opentsdbproxy.stats import registry
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_POSITIVE_TTL = 300
+DEFAULT_NEGATIVE_TTL = 30
+
+
+class AuthCache(object):
+    """A bounded LRU cache of authentication results
+
+    Credentials are keyed by an HMAC of the username and password under a
+    random per process key, so plaintext passwords are never kept. Successful
+    and failed authentications expire after separate TTLs, so a bad password
+    can be retried soon without hammering the user database.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, positive_ttl=DEFAULT_POSITIVE_TTL,
+            negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()
+        self.configure(max_size=max_size, positive_ttl=positive_ttl,
+            negative_ttl=negative_ttl)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        # Bumped on every invalidation, so sessions know to check again
+        self.generation = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def configure(self, max_size=None, positive_ttl=None, negative_ttl=None):
+        """configure
+
+        Change the cache bounds, any argument left as None is unchanged
+
+        @param max_size - most credentials to remember, 0 disables the cache
+        @param positive_ttl - seconds to remember a successful authentication
+        @param negative_ttl - seconds to remember a failed authentication
+        """
+        if max_size is not None:
+            self.max_size = max_size
+        if positive_ttl is not None:
+            self.positive_ttl = positive_ttl
+        if negative_ttl is not None:
+            self.negative_ttl = negative_ttl
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _digest(self, username, password):
+        return hmac.new(self._key, "%s\0%s" % (username, password), hashlib.sha256).digest()
+
+    def get(self, username, password):
+        """get
+
+        @returns - True or False for a cached result, None on a miss
+        """
+        key = self._digest(username, password)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        _, authenticated, expires = entry
+        if expires <= time.time():
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        # Reinsert to mark as most recently used
+        self._entries[key] = entry
+        self.hits += 1
+        return authenticated
+
+    def set(self, username, password, authenticated):
+        if self.max_size <= 0:
+            return
+        authenticated = bool(authenticated)
+        ttl = self.positive_ttl if authenticated else self.negative_ttl
+
+        key = self._digest(username, password)
+        self._entries.pop(key, None)
+        self._entries[key] = (username, authenticated, time.time() + ttl)
+
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, username=None):
+        """invalidate
+
+        Forget cached results, for instance after a password change
+
+        @param username - only forget this user's results, or everything if None
+        """
+        self.generation += 1
+        if username is None:
+            log.debug("Invalidating all %d cached authentications" % len(self._entries))
+            self._entries.clear()
+            return
+
+        for key, entry in self._entries.items():
+            if entry[0] == username:
+                del self._entries[key]
+
+
+class AuthSession(object):
+    """The credentials a client connection authenticated with
+
+    Lines on the connection with the same credentials, or with none, are
+    authorized without being checked again, until the session expires after
+    the cache's positive TTL or the cache is invalidated. Like the cache, the
+    session keeps an HMAC of the credentials rather than the password.
+    """
+
+    __slots__ = ('user', 'credentials', 'generation', 'expires')
+
+    def __init__(self):
+        self.clear()
+
+    def establish(self, user, password, cache):
+        self.user = user
+        self.credentials = cache._digest(user, password)
+        self.generation = cache.generation
+        self.expires = time.time() + cache.positive_ttl
+
+    def clear(self):
+        self.user = None
+        self.credentials = None
+        self.generation = None
+        self.expires = 0
+
+    @property
+    def authenticated(self):
+        return self.user is not None
+
+    def matches(self, user, password, cache):
+        """matches
+
+        @returns - True if user and password are the session's credentials,
+                   compared in constant time
+        """
+        if self.credentials is None:
+            return False
+        return hmac.compare_digest(cache._digest(user, password), self.credentials)
+
+    def valid(self, cache):
+        """valid
+
+        @returns - True if the session was established since cache was last
+                   invalidated, and hasn't expired
+        """
+        return self.user is not None and self.generation == cache.generation and \
+            time.time() < self.expires
+
+
+# Shared by every authorizing backend in the process
+auth_cache = AuthCache()
+
+registry.counter('auth_cache_hits_total', "Authentications answered from the cache",
+    callback=lambda: auth_cache.hits)
+registry.counter('auth_cache_misses_total', "Authentications not in the cache",
+    callback=lambda: auth_cache.misses)
+registry.counter('auth_cache_evictions_total', "Cached authentications evicted to make room",
+    callback=lambda: auth_cache.evictions)
+registry.gauge('auth_cache_entries', "Cached authentications", callback=lambda: len(auth_cache))
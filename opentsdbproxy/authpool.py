@@ -0,0 +1,118 @@
+"""Runs authentication in native threads, off the gevent hub
+
+Django's authenticate blocks in a database driver gevent can't patch, and
+hashing passwords is pure CPU, so either would stall every connection if it
+ran in a greenlet. The greenlet waiting on a thread yields to the others.
+"""
+
+import os
+import hmac
+import time
+import hashlib
+import logging
+
+from gevent.event import AsyncResult
+from gevent.threadpool import ThreadPool
+
+from opentsdbproxy.stats import registry
+
+log = logging.getLogger(__name__)
+
+DEFAULT_THREADS = 10
+
+AUTH_POOL_COALESCED = registry.counter('auth_pool_coalesced_total',
+    "Authentications that waited on the same credentials already being checked")
+AUTH_POOL_WAIT_SECONDS = registry.histogram('auth_pool_wait_seconds',
+    "Time authentications waited for a free thread")
+
+
+class AuthPool(object):
+    """A bounded pool of threads that authentications are run in
+
+    Greenlets checking the same credentials at the same time share one call,
+    so a collector reconnecting with many connections, or an auth cache
+    invalidation, costs one lookup per user rather than one per connection.
+    Like AuthCache, in flight credentials are keyed by an HMAC so plaintext
+    passwords aren't kept.
+
+    @param size - most authentications run at once, the rest are queued
+    """
+
+    def __init__(self, size=DEFAULT_THREADS):
+        self._key = os.urandom(32)
+        self._pending = {}
+        self._threadpool = None
+        self.size = size
+
+    def __len__(self):
+        return len(self._pending)
+
+    @property
+    def queued(self):
+        """Authentications waiting for a free thread"""
+        return max(0, len(self._pending) - self.size)
+
+    def configure(self, size=None):
+        """configure
+
+        @param size - most authentications run at once, left unchanged if None
+        """
+        if size is None or size == self.size:
+            return
+        self.size = size
+        if self._threadpool is not None:
+            self._threadpool.maxsize = size
+
+    def _digest(self, username, password):
+        return hmac.new(self._key, "%s\0%s" % (username, password), hashlib.sha256).digest()
+
+    def authenticate(self, authenticate, username, password):
+        """authenticate
+
+        @param authenticate - function taking username and password keyword
+                              arguments, returning None for bad credentials
+
+        @returns - True if the credentials are good
+        """
+        key = self._digest(username, password)
+        result = self._pending.get(key)
+        if result is not None:
+            AUTH_POOL_COALESCED.inc()
+            return result.get()
+
+        # Threads are started on first use, after any fork into workers
+        if self._threadpool is None:
+            self._threadpool = ThreadPool(self.size)
+
+        result = self._pending[key] = AsyncResult()
+        try:
+            authenticated, waited = self._threadpool.apply(_timed_authenticate,
+                (authenticate, username, password, time.time()))
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        else:
+            result.set(authenticated)
+        finally:
+            del self._pending[key]
+        AUTH_POOL_WAIT_SECONDS.observe(waited)
+        return authenticated
+
+
+def _timed_authenticate(authenticate, username, password, queued):
+    """Runs in a pool thread
+
+    @returns - (whether the credentials are good, seconds spent queued)
+    """
+    waited = time.time() - queued
+    return authenticate(username=username, password=password) is not None, waited
+
+
+# Shared by every authorizing backend in the process, so a reload doesn't
+# leave the previous backend's threads behind
+auth_pool = AuthPool()
+
+registry.gauge('auth_pool_pending', "Distinct credentials being authenticated or queued",
+    callback=lambda: len(auth_pool))
+registry.gauge('auth_pool_queue_depth', "Authentications waiting for a free thread",
+    callback=lambda: auth_pool.queued)
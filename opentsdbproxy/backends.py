@@ -1,31 +1,105 @@
 import os
 import sys
-import socket
+import json
+import time
 import logging
 
+import gevent
+
 import opentsdbproxy
 
-from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.exceptions import ConfigurationException, SessionExpired, UpstreamUnavailable
+from opentsdbproxy.authcache import auth_cache
+from opentsdbproxy.authpool import auth_pool as shared_auth_pool
+from opentsdbproxy.batching import WriteBatcher
+from opentsdbproxy.credentials import CredentialFile
+from opentsdbproxy.httpoutput import HTTPUpstream
+from opentsdbproxy.mirror import parse_mirror
+from opentsdbproxy.parser import parse, sanitize, tag_user
+from opentsdbproxy.ratelimit import RateLimiter, load_overrides
+from opentsdbproxy.spool import SpoolReplayer, open_spool
+from opentsdbproxy.stages import DuplicateFilter, Downsampler
+from opentsdbproxy.stats import registry
+from opentsdbproxy.upstream import FailoverPool, ShardedUpstream, UpstreamPool, parse_upstreams, \
+    DRAIN_TIMEOUT
 
 log = logging.getLogger(__name__)
 
+CREDENTIAL_RELOAD_INTERVAL = 5
+
+AUTH_COMMAND = 'auth'
+
+TELNET = 'telnet'
+HTTP = 'http'
+UPSTREAM_PROTOCOLS = (TELNET, HTTP)
+
+LINES_AUTHORIZED = registry.counter('lines_authorized_total', "Lines with good credentials")
+LINES_REJECTED = registry.counter('lines_rejected_total', "Lines with missing or bad credentials")
+FILTER_SECONDS = registry.histogram('filter_message_seconds', "Time spent in filter_message")
+AUTH_SESSIONS = registry.counter('auth_sessions_total',
+    "Connections that authenticated a session, by auth command or first line", ('method',))
+AUTH_SESSION_FAILURES = registry.counter('auth_session_failures_total',
+    "auth commands with bad credentials")
+AUTH_SESSIONS_EXPIRED = registry.counter('auth_sessions_expired_total',
+    "Connections closed because their session lapsed on a line without credentials")
+AUTHENTICATE_SECONDS = registry.histogram('authenticate_seconds',
+    "Time spent checking credentials that weren't cached, including waiting for a thread")
+
 
 class BaseOpenTSDBBackend(object):
 
     def __init__(self):
         raise NotImplementedError("Subclasses must implement __init__")
 
-    def handle(self, line):
+    def handle(self, line, address=None, session=None):
         """handle
 
         handle a line from tcp
 
         @param line - line read from tcp socket
+        @param address - the tcp client's address
+        @param session - the connection's authcache.AuthSession, if the proxy
+                         authenticates connections rather than every line
 
         @returns - what to return to the tcp client
         """
         raise NotImplementedError("Subclasses must implement __init__")
 
+    def ingest(self, records, address=None):
+        """ingest
+
+        handle puts that were authorized as a whole, from the HTTP API
+
+        @param records - list of parser.Record puts
+        @param address - the http client's address
+        """
+        raise NotImplementedError("Subclasses must implement ingest")
+
+    def pause(self):
+        """pause
+
+        stop background work that a replacement backend would duplicate,
+        called on reload before the replacement is made
+        """
+        pass
+
+    def resume(self):
+        """resume
+
+        restart what pause stopped, called when a reload fails and this
+        backend is kept
+        """
+        pass
+
+    def close(self, timeout=None):
+        """close
+
+        release any upstream resources, called when the proxy shuts down
+
+        @param timeout - seconds to let queued writes reach OpenTSDB
+        """
+        pass
+
 
 class MockOpenTSDBBackend(BaseOpenTSDBBackend):
 
@@ -33,7 +107,7 @@ class MockOpenTSDBBackend(BaseOpenTSDBBackend):
         log.debug("MockOpenTSDBBackend init")
         self.messages = []
 
-    def handle(self, message):
+    def handle(self, message, address=None, session=None):
 
         self.messages.append(message)
         log.debug("MockOpenTSDBBackend got message: '%s'" % message)
@@ -43,61 +117,489 @@ class MockOpenTSDBBackend(BaseOpenTSDBBackend):
         else:
             return None
 
+    def ingest(self, records, address=None):
+        self.messages.append(sanitize(records))
 
-class ForwardingOpenTSDBBackend(BaseOpenTSDBBackend):
 
-    connection = None
+class ForwardingOpenTSDBBackend(BaseOpenTSDBBackend):
 
-    def __init__(self, host=None, port=None):
+    def __init__(self, host=None, port=None, fire_and_forget=False,
+            upstream_connections=None, upstream_checkout=None,
+            batch=False, batch_max_bytes=None, batch_max_lines=None, batch_max_delay_ms=None,
+            spool_dir=None, spool_segment_size=None, spool_max_size=None, spool_replay_rate=None,
+            queue_max_bytes=None, queue_policy=None, upstream_vnodes=None,
+            dedupe_window=None, dedupe_max_entries=None, downsample=None,
+            upstream_protocol=None, http_batch_size=None, http_linger_ms=None,
+            standby_hosts=None, upstream_probe_interval=None, upstream_backoff=None,
+            upstream_max_backoff=None, mirrors=None, mirror_queue_max_bytes=None,
+            mirror_queue_policy=None):
         if host is None or port is None:
             raise ConfigurationException("%s requires a host and port to be configured" % self.__class__.__name__)
+        upstream_protocol = upstream_protocol or TELNET
+        if upstream_protocol not in UPSTREAM_PROTOCOLS:
+            raise ConfigurationException("Unknown upstream protocol '%s', choose from %s" % (
+                upstream_protocol, ', '.join(UPSTREAM_PROTOCOLS)))
 
         self.host = host
         self.port = port
-        self.alive = True
-        self.tsd = None
-        self.last_verify = 0
-        self.buffer_size = 4096
+        upstreams = parse_upstreams(host, port)
+
+        self.spool = None
+        self.replayer = None
+        on_failure = None
+        if spool_dir is not None:
+            self.spool = open_spool(spool_dir, segment_size=spool_segment_size, max_size=spool_max_size)
+            on_failure = self.spool.append
+
+        pool_parameters = dict(size=upstream_connections, on_failure=on_failure,
+            queue_max_bytes=queue_max_bytes, queue_policy=queue_policy,
+            circuit_backoff=upstream_backoff, circuit_max_backoff=upstream_max_backoff)
+        # Each HTTP connection has at most one /api/put in flight
+        if upstream_protocol == HTTP:
+            Pool = HTTPUpstream
+            pool_parameters.update(batch_size=http_batch_size, linger_ms=http_linger_ms,
+                probe_interval=upstream_probe_interval)
+        else:
+            Pool = UpstreamPool
+            pool_parameters.update(checkout=upstream_checkout,
+                reconnect_interval=upstream_probe_interval)
+
+        self.sharded = len(upstreams) > 1
+        if self.sharded and standby_hosts:
+            raise ConfigurationException("Standby OpenTSDB hosts can't be used with sharding")
+        if self.sharded:
+            self.upstream = ShardedUpstream(upstreams, vnodes=upstream_vnodes, pool_class=Pool,
+                **pool_parameters)
+        elif standby_hosts:
+            self.upstream = FailoverPool([Pool(host, port, **pool_parameters)
+                for host, port in upstreams + parse_upstreams(standby_hosts, port)])
+        else:
+            (host, port), = upstreams
+            self.upstream = Pool(host, port, **pool_parameters)
+
+        if self.spool is not None:
+            self.replayer = SpoolReplayer(self.spool, self.replay,
+                lambda: self.upstream.healthy, rate=spool_replay_rate)
+            self.replayer.start()
+
+        # One batcher per TSD, so a batch is written whole to one of them
+        self.batchers = {}
+        if batch:
+            pools = self.upstream.pools.values() if self.sharded else [self.upstream]
+            for pool in pools:
+                self.batchers[pool] = WriteBatcher(lambda data, pool=pool: self.write(data, pool),
+                    max_bytes=batch_max_bytes, max_lines=batch_max_lines,
+                    max_delay_ms=batch_max_delay_ms, on_failure=on_failure)
+
+        # Puts pass through these before being forwarded
+        self.stages = []
+        if dedupe_window:
+            self.stages.append(DuplicateFilter(window=dedupe_window, max_entries=dedupe_max_entries))
+        if downsample:
+            self.stages.append(Downsampler(downsample,
+                lambda data: self.forward_records(parse(data), stages=False)))
+
+        # Forwarded puts are copied to these, each with its own queue
+        self.mirrors = [parse_mirror(spec, mirror_queue_max_bytes, mirror_queue_policy)
+            for spec in mirrors or ()]
+        for mirror in self.mirrors:
+            mirror.start()
+
+        # Batched, spooled, sharded, staged and HTTP puts are never waited on
+        self.fire_and_forget = fire_and_forget or batch or self.spool is not None or \
+            self.sharded or bool(self.stages) or upstream_protocol == HTTP
+        self.parse_puts = self.sharded or bool(self.stages)
+
+        self.register_stats()
+
+    def register_stats(self):
+        upstream = self.upstream
+        registry.gauge('upstream_connected', "Connected upstream connections",
+            callback=lambda: sum(1 for c in upstream.connections if c.connected))
+        registry.gauge('upstream_queued_bytes', "Bytes queued for OpenTSDB",
+            callback=lambda: upstream.queued_bytes)
+        registry.counter('upstream_dropped_bytes_total', "Bytes dropped because the upstream queue was full",
+            callback=lambda: upstream.dropped_bytes)
+        registry.counter('upstream_dropped_writes_total', "Writes dropped because the upstream queue was full",
+            callback=lambda: upstream.dropped_items)
+
+        batchers = self.batchers.values()
+        if batchers:
+            registry.counter('batches_total', "Batches written to OpenTSDB",
+                callback=lambda: sum(b.batches for b in batchers))
+            registry.counter('batched_lines_total', "Lines written to OpenTSDB in batches",
+                callback=lambda: sum(b.batched_lines for b in batchers))
+            registry.gauge('batch_largest_lines', "Most lines written in a single batch",
+                callback=lambda: max(b.largest_batch_lines for b in batchers))
+            registry.counter('batch_wait_seconds_total', "Time batches waited for more lines",
+                callback=lambda: sum(b.total_wait_time for b in batchers))
+            registry.counter('batch_enqueue_seconds_total',
+                "Time spent queueing batches for OpenTSDB, see upstream_sendall_seconds for writes",
+                callback=lambda: sum(b.total_enqueue_time for b in batchers))
+            registry.counter('batch_failures_total', "Batches that couldn't be written to OpenTSDB",
+                callback=lambda: sum(b.failed_batches for b in batchers))
+
+        for mirror in self.mirrors:
+            mirror.register_stats()
+
+        spool = self.spool
+        if spool is not None:
+            registry.gauge('spool_bytes', "Bytes waiting in the spool",
+                callback=lambda: spool.size)
+            registry.counter('spooled_bytes_total', "Bytes written to the spool",
+                callback=lambda: spool.spooled_bytes)
+            registry.counter('spool_evicted_bytes_total', "Bytes dropped from a full spool",
+                callback=lambda: spool.evicted_bytes)
+            registry.counter('spool_replayed_bytes_total', "Bytes replayed from the spool",
+                callback=lambda: self.replayer.replayed_bytes)
+
+    def pause(self):
+        # Two replayers would send the same spooled data twice
+        if self.replayer is not None:
+            self.replayer.stop()
+
+    def resume(self):
+        if self.replayer is not None:
+            self.replayer.start()
+
+    def close(self, timeout=None):
+        for stage in self.stages:
+            stage.close()
+        if self.replayer is not None:
+            self.replayer.stop()
+        for batcher in self.batchers.values():
+            batcher.close()
+        timeout = DRAIN_TIMEOUT if timeout is None else timeout
+        deadline = time.time() + timeout
+        self.upstream.close(timeout)
+        for mirror in self.mirrors:
+            mirror.close(max(0, deadline - time.time()))
+        if self.spool is not None:
+            self.spool.close()
+
+    def checkout(self):
+        connection = self.upstream.checkout()
+        if connection is None:
+            raise UpstreamUnavailable("Couldn't connect to OpenTSDB %s:%s" % (self.host, self.port))
+        return connection
+
+    def forward(self, data, lines=None, pool=None):
+        """forward
+
+        send put lines to OpenTSDB without waiting for a reply
+
+        @param data - one or more newline terminated put lines
+        @param lines - the number of lines in data, if the caller knows it
+        @param pool - the UpstreamPool to send to, when sharding
+        """
+        pool = pool or self.upstream
+        batcher = self.batchers.get(pool)
+        if batcher is not None:
+            batcher.add(data, lines)
+        else:
+            self.write(data, pool)
+
+    def forward_records(self, records, stages=True):
+        """forward_records
 
-    def connect(self):
-        """connect to OpenTSDB. Taken from tcollector
+        send put records, with passwords removed, to OpenTSDB without
+        waiting for a reply, routing each to its TSD when sharding
+
+        @param records - list of parser.Record puts
+        @param stages - pass the records through self.stages first
+        """
+        if stages:
+            for stage in self.stages:
+                records = stage.process(records)
+                if not records:
+                    return
+
+        if not self.sharded:
+            data = sanitize(records)
+            if self.mirrors:
+                self.mirror(data)
+            self.forward(data, len(records))
+            return
+        if self.mirrors:
+            self.mirror(sanitize(records))
+        for pool, routed in self.upstream.route(records):
+            self.forward(sanitize(routed), len(routed), pool)
+
+    def mirror(self, data):
+        """mirror
+
+        queue put lines for every mirror, never waiting on them
+
+        @param data - one or more newline terminated put lines
         """
+        for mirror in self.mirrors:
+            mirror.send(data)
+
+    def write(self, data, pool=None):
+        pool = pool or self.upstream
+        connection = pool.checkout()
+        if connection is None and self.spool is not None:
+            self.spool.append(data)
+            return
+        if connection is None:
+            raise UpstreamUnavailable("Couldn't connect to OpenTSDB %s" % pool)
+        connection.send(data)
+
+    def replay(self, data):
+        if not self.sharded:
+            routes = [(self.upstream, data)]
+        else:
+            routes = [(pool, sanitize(routed)) for pool, routed in self.upstream.route(parse(data))]
 
-        adresses = socket.getaddrinfo(self.host, self.port, socket.AF_UNSPEC,
-                                      socket.SOCK_STREAM, 0)
-        for family, socktype, proto, canonname, sockaddr in adresses:
-            try:
-                connection = socket.socket(family, socktype, proto)
-                connection.settimeout(1)
-                connection.connect(sockaddr)
-                return connection
-            except socket.error, msg:
-                log.warning('Connection attempt failed to %s:%d: %s',
-                            self.host, self.port, msg)
-            return None
+        # Send nothing unless every TSD the data belongs to is up, so a
+        # retried record isn't written twice
+        connections = [pool.checkout() for pool, _ in routes]
+        if None in connections:
+            return False
+        for connection, (_, routed) in zip(connections, routes):
+            connection.send(routed)
+        return True
 
-    def handle(self, message):
+    def handle(self, message, address=None, session=None):
 
-        if self.connection is None:
-            self.connection = self.connect()
-            if self.connection is None:
-                raise Exception("Couldn't connect to OpenTSDB %s:%s" % (self.host, self.port))
         log.debug("Forwarding: '%s'" % message)
-        self.connection.sendall(message)
-        try:
-            response = ''
-            while True:
-                recv = self.connection.recv(self.buffer_size)
-                response += recv
-                if len(recv) < self.buffer_size:
-                    break
-            return recv
-        except socket.error:
-            log.debug("Socket error to %s:%s" % (self.host, self.port))
+
+        if not self.fire_and_forget:
+            return self.handle_records(parse(message))
+
+        # Fast path, a message of nothing but puts never gets a reply
+        if not self.parse_puts and message.startswith('put ') and \
+                message.count('\nput ') == message.count('\n') - 1:
+            if self.mirrors:
+                self.mirror(message)
+            self.forward(message)
             return None
 
+        return self.handle_records(parse(message))
+
+    def handle_records(self, records):
+        """handle_records
+
+        forward parsed lines, with passwords removed, to OpenTSDB
+
+        @param records - list of parser.Record
+
+        @returns - what to return to the tcp client
+        """
+        if self.fire_and_forget:
+            forward_records = self.forward_records
+            request = lambda data: self.checkout().request(data)
+        else:
+            # The message's lines go to one connection in order. Only the
+            # commands wait, as OpenTSDB doesn't reply to a good put.
+            connection = self.checkout()
+            request = connection.request
+
+            def forward_records(puts):
+                data = sanitize(puts)
+                if self.mirrors:
+                    self.mirror(data)
+                connection.send(data)
+
+        responses = []
+        puts = []
+        for record in records:
+            if record.is_put:
+                puts.append(record)
+                continue
+            if puts:
+                forward_records(puts)
+                puts = []
+            response = request(record.sanitized())
+            if response is not None:
+                responses.append(response)
+        if puts:
+            forward_records(puts)
+
+        if responses:
+            return ''.join(responses)
+        return None
+
+    def ingest(self, records, address=None):
+        self.handle_records(records)
+
+
+class AuthzMixin(object):
+
+    auth_cache = auth_cache
+    auth_pool = None
+    rate_limiter = None
+
+    def authenticate(self, username=None, password=None):
+        """authenticate
+
+        check a username and password
+
+        @returns - something other than None if the credentials are good
+        """
+        raise NotImplementedError("Subclasses must implement authenticate")
+
+    def setup_auth_cache(self, auth_cache_size=None, auth_cache_ttl=None,
+            auth_cache_negative_ttl=None):
+        self.auth_cache.configure(max_size=auth_cache_size, positive_ttl=auth_cache_ttl,
+            negative_ttl=auth_cache_negative_ttl)
+
+    def setup_auth_pool(self, auth_threads=None):
+        """Runs authenticate in the process wide pool of auth_threads native
+        threads, or in the calling greenlet if auth_threads is 0
+        """
+        if auth_threads == 0:
+            self.auth_pool = None
+            return
+        shared_auth_pool.configure(size=auth_threads)
+        self.auth_pool = shared_auth_pool
+
+    def setup_rate_limit(self, rate_limit_lines=None, rate_limit_bytes=None, rate_limit_burst=None,
+            rate_limit_policy=None, rate_limit_per_address=False, rate_limit_overrides=None):
+        """Limits each user's authorized lines and bytes per second, if a
+        default limit or an overrides file is given
+        """
+        overrides = None
+        if rate_limit_overrides is not None:
+            overrides = load_overrides(rate_limit_overrides)
+        if rate_limit_lines or rate_limit_bytes or overrides:
+            self.rate_limiter = RateLimiter(lines_per_second=rate_limit_lines,
+                bytes_per_second=rate_limit_bytes, burst=rate_limit_burst,
+                policy=rate_limit_policy, per_address=rate_limit_per_address,
+                overrides=overrides)
+
+    def is_authenticated(self, user, password):
+        """Checks a username and password, consulting the process wide
+        auth cache before calling authenticate
+        """
+        if user is None or password is None:
+            return False
+
+        authenticated = self.auth_cache.get(user, password)
+        if authenticated is None:
+            with AUTHENTICATE_SECONDS.time():
+                if self.auth_pool is not None:
+                    authenticated = self.auth_pool.authenticate(self.authenticate, user, password)
+                else:
+                    authenticated = self.authenticate(username=user, password=password) is not None
+            self.auth_cache.set(user, password, authenticated)
+        return authenticated
+
+    def invalidate_auth_cache(self, username=None):
+        """Forgets cached authentications, for one user or for everyone.
+        Call this when passwords change or accounts are disabled.
+        """
+        self.auth_cache.invalidate(username)
+
+    def check_session(self, session, user=None, password=None):
+        """Returns True if the session is authenticated. Once it has
+        expired or the auth cache has been invalidated, the session only
+        keeps a digest of its password, so it is checked again with the
+        line's matching credentials. If the line has none the session ends
+        with SessionExpired, so the client is told to authenticate again.
+        """
+        if session.valid(self.auth_cache):
+            return True
+        if not session.authenticated:
+            return False
+        if user is not None and password is not None:
+            if self.is_authenticated(user, password):
+                session.establish(user, password, self.auth_cache)
+                return True
+            session.clear()
+            return False
+        session.clear()
+        AUTH_SESSIONS_EXPIRED.inc()
+        raise SessionExpired("auth: session expired")
+
+    def authorize(self, user, password, session=None):
+        """Checks a line's credentials. With a session, credentials matching
+        the session's, or none at all, are only checked once per connection,
+        and the first good credentials establish the session.
+        """
+        if session is None:
+            return self.is_authenticated(user, password)
+
+        no_credentials = user is None and password is None
+        if no_credentials or session.matches(user, password, self.auth_cache):
+            return self.check_session(session, user, password)
+
+        authenticated = self.is_authenticated(user, password)
+        if authenticated and not session.authenticated:
+            session.establish(user, password, self.auth_cache)
+            AUTH_SESSIONS.labels('first_line').inc()
+        return authenticated
+
+    def start_session(self, records, session):
+        """Handles auth commands, 'auth <user> <password>', which establish
+        the connection's session. Returns the other records, and the
+        response to the client, if any.
+        """
+        if session is None:
+            return records, None
+        commands = [record for record in records
+            if not record.is_put and record.command == AUTH_COMMAND]
+        if not commands:
+            return records, None
+
+        responses = []
+        for command in commands:
+            fields = command.line.split()
+            if len(fields) == 3 and self.is_authenticated(fields[1], fields[2]):
+                session.establish(fields[1], fields[2], self.auth_cache)
+                AUTH_SESSIONS.labels('command').inc()
+            else:
+                session.clear()
+                AUTH_SESSION_FAILURES.inc()
+                responses.append("auth: bad username or password\n")
+        records = [record for record in records if record not in commands]
+        return records, ''.join(responses) or None
+
+    def filter_records(self, records, address=None, session=None):
+        """Checks each parsed line for user and password, and returns the
+        records with a valid username and password, within the user's
+        rate limit. Lines without credentials authorized by the session are
+        tagged with the session's user.
+        """
+        started = time.time()
+        cached_authed_pairs = {}
+        authzed_records = []
+
+        for record in records:
+            credentials = (record.user, record.password)
+            auth = cached_authed_pairs.get(credentials)
+            if auth is None:
+                auth = self.authorize(record.user, record.password, session)
+                cached_authed_pairs[credentials] = auth
+            if auth:
+                authzed_records.append(record)
+
+        LINES_REJECTED.inc(len(records) - len(authzed_records))
+        if cached_authed_pairs.get((None, None)):
+            authzed_records = tag_user(authzed_records, session.user)
+        FILTER_SECONDS.observe(time.time() - started)
+        return self.admit_records(authzed_records, address)
+
+    def admit_records(self, records, address=None):
+        """Counts records whose credentials were checked as authorized, and
+        returns those within the user's rate limit.
+        """
+        LINES_AUTHORIZED.inc(len(records))
+        if self.rate_limiter is not None:
+            records = self.rate_limiter.limit(records, address)
+        return records
+
+    def filter_message(self, message, address=None, session=None):
+        """Checks each line in a tcollector message for user and password,
+        rejects messages without a valid username and password. Returns a
+        tcollector message with the unauth'd lines removed, and passwords
+        stripped from the rest.
+        """
+        authzed_records = self.filter_records(parse(message), address, session)
+        return sanitize(authzed_records) or '\n'  # Keep a lone \n because tcollector does
+
 
-class DjangoMixin(object):
+class DjangoMixin(AuthzMixin):
 
     django_setup = False
 
@@ -111,105 +613,197 @@ class DjangoMixin(object):
         self.User = User
         self.authenticate = authenticate
 
-    def filter_message(self, message):
-        """Checks each line in a tcollector message for user and password,
-        rejects messages without a valid username and password. Returns a
-        tcollector message with the unauth'd lines removed.
-        """
-        cached_authed_pairs = {}
-        authzed_lines = []
-
-        for line in message.splitlines():
-            user = None
-            password = None
-            items = line.split()
-            for tag in items:
-                split_tag = tag.split('=', 1)
-                if len(split_tag) != 2:
-                    continue
-                key, value = split_tag
-                if key == 'user':
-                    user = value
-                elif key == 'password':
-                    password = value
-
-            cached_auth = cached_authed_pairs.get((user, password))
-            if cached_auth is not None:
-                auth = cached_auth
-            else:
-                auth = self.authenticate(username=user, password=password)
-                cached_authed_pairs[(user, password)] = auth
 
-            if auth is not None:
+class CredentialFileMixin(AuthzMixin):
+
+    credential_file = None
 
-                # Sanitize password
-                password_tag = "password=%s" % password
-                line = line.replace(password_tag, '')
+    def setup_credential_file(self, credential_file_path, reload_interval=None):
+        """Loads users from a local htpasswd or JSON credential file, and
+        starts a greenlet that reloads it whenever it changes
+        """
+        self.credential_file = CredentialFile(credential_file_path)
+        self.credential_reload_interval = reload_interval or CREDENTIAL_RELOAD_INTERVAL
+        self.credential_watcher = gevent.spawn(self._watch_credential_file)
+
+    def authenticate(self, username=None, password=None):
+        if self.credential_file.check(username, password):
+            return username
+        return None
+
+    def stop_credential_watcher(self):
+        self.credential_watcher.kill(block=False)
+
+    def _watch_credential_file(self):
+        while True:
+            gevent.sleep(self.credential_reload_interval)
+            if not self.credential_file.changed():
+                continue
+            try:
+                self.credential_file.reload()
+            except (IOError, OSError, ValueError) as e:
+                log.warning("Keeping previous credentials, couldn't reload '%s': %s" % (
+                    self.credential_file.path, e))
+                continue
+            self.invalidate_auth_cache()
 
-                authzed_lines.append(line.strip())
 
-        return '\n'.join(authzed_lines) + '\n'  # Add trailing \n because tcollector does
+class AuthorizingBackend(ForwardingOpenTSDBBackend, AuthzMixin):
+    """Forwards only the lines whose credentials pass authenticate"""
 
+    def handle(self, message, address=None, session=None):
 
-class DjangoAuthorizingBackend(ForwardingOpenTSDBBackend, DjangoMixin):
-    def __init__(self, host=None, port=None, django_project_path=None, django_settings_module=None):
+        if message == "version\n":
+            return ForwardingOpenTSDBBackend.handle(self, message)
+
+        records, response = self.start_session(parse(message), session)
+        records = self.filter_records(records, address, session)
+        log.debug("Authorized %d lines" % len(records))
+        if records:
+            forwarded = self.handle_records(records)
+            if forwarded is not None:
+                response = (response or '') + forwarded
+        return response
+
+
+class DjangoAuthorizingBackend(AuthorizingBackend, DjangoMixin):
+    def __init__(self, host=None, port=None, django_project_path=None, django_settings_module=None,
+            auth_cache_size=None, auth_cache_ttl=None, auth_cache_negative_ttl=None,
+            auth_threads=None, rate_limit_lines=None, rate_limit_bytes=None, rate_limit_burst=None,
+            rate_limit_policy=None, rate_limit_per_address=False, rate_limit_overrides=None,
+            **forwarding_parameters):
         if django_project_path is None or django_settings_module is None:
             raise ConfigurationException(
                 "%s requires a django_settings_module and django_project_path to be configured" % (
                 self.__class__.__name__,))
 
         self.setup_django(django_project_path, django_settings_module)
+        self.setup_auth_cache(auth_cache_size, auth_cache_ttl, auth_cache_negative_ttl)
+        self.setup_auth_pool(auth_threads)
+        self.setup_rate_limit(rate_limit_lines, rate_limit_bytes, rate_limit_burst,
+            rate_limit_policy, rate_limit_per_address, rate_limit_overrides)
+
+        ForwardingOpenTSDBBackend.__init__(self, host=host, port=port, **forwarding_parameters)
+
+
+class FileAuthorizingBackend(AuthorizingBackend, CredentialFileMixin):
+    def __init__(self, host=None, port=None, credential_file=None, credential_reload_interval=None,
+            auth_cache_size=None, auth_cache_ttl=None, auth_cache_negative_ttl=None,
+            auth_threads=None, rate_limit_lines=None, rate_limit_bytes=None, rate_limit_burst=None,
+            rate_limit_policy=None, rate_limit_per_address=False, rate_limit_overrides=None,
+            **forwarding_parameters):
+        if credential_file is None:
+            raise ConfigurationException(
+                "%s requires a credential_file to be configured" % self.__class__.__name__)
 
-        ForwardingOpenTSDBBackend.__init__(self, host=host, port=port)
+        self.setup_credential_file(credential_file, credential_reload_interval)
+        self.setup_auth_cache(auth_cache_size, auth_cache_ttl, auth_cache_negative_ttl)
+        self.setup_auth_pool(auth_threads)
+        self.setup_rate_limit(rate_limit_lines, rate_limit_bytes, rate_limit_burst,
+            rate_limit_policy, rate_limit_per_address, rate_limit_overrides)
 
-    def handle(self, message):
+        ForwardingOpenTSDBBackend.__init__(self, host=host, port=port, **forwarding_parameters)
+
+    def close(self, timeout=None):
+        self.stop_credential_watcher()
+        AuthorizingBackend.close(self, timeout)
+
+
+class MockAuthorizingBackend(MockOpenTSDBBackend, AuthzMixin):
+    """Records the lines whose credentials pass authenticate"""
+
+    def handle(self, message, address=None, session=None):
+
+        self.messages.append(message)
+        log.debug("%s got message: '%s'" % (self.__class__.__name__, message))
 
         if message == "version\n":
-            filtered_message = message
+            return "%s\n" % opentsdbproxy.__version__
         else:
-            filtered_message = self.filter_message(message)
+            records, response = self.start_session(parse(message), session)
+            filtered_message = sanitize(self.filter_records(records, address, session)) or '\n'
+            log.debug("Filtered Message: '%s'" % filtered_message)
+            if filtered_message != '\n':
+                self.authzed_messages.append(filtered_message)
+            return response
 
-        log.debug("Filtered message to: %s" % filtered_message)
-        if filtered_message != '\n':
-            return ForwardingOpenTSDBBackend.handle(self, filtered_message)
-        else:
-            return None
+    def ingest(self, records, address=None):
+        message = sanitize(records)
+        self.messages.append(message)
+        self.authzed_messages.append(message)
 
+    def reset(self):
+        self.messages = []
+        self.authzed_messages = []
 
-class MockDjangoAuthorizingBackend(MockOpenTSDBBackend, DjangoMixin):
 
-    def __init__(self, host=None, port=None, django_project_path=None, django_settings_module=None):
+class MockDjangoAuthorizingBackend(MockAuthorizingBackend, DjangoMixin):
+
+    def __init__(self, host=None, port=None, django_project_path=None, django_settings_module=None,
+            auth_cache_size=None, auth_cache_ttl=None, auth_cache_negative_ttl=None,
+            auth_threads=None, rate_limit_lines=None, rate_limit_bytes=None, rate_limit_burst=None,
+            rate_limit_policy=None, rate_limit_per_address=False, rate_limit_overrides=None):
         if django_project_path is None or django_settings_module is None:
             raise ConfigurationException(
                 "%s requires a django_settings_module and django_project_path to be configured" % (
                 self.__class__.__name__,))
 
         self.setup_django(django_project_path, django_settings_module)
+        self.setup_auth_cache(auth_cache_size, auth_cache_ttl, auth_cache_negative_ttl)
+        self.setup_auth_pool(auth_threads)
+        self.setup_rate_limit(rate_limit_lines, rate_limit_bytes, rate_limit_burst,
+            rate_limit_policy, rate_limit_per_address, rate_limit_overrides)
 
         self.messages = []
         self.authzed_messages = []
 
-    def handle(self, message):
 
-        self.messages.append(message)
-        log.debug("MockDjangoAuthorizingBackend got message: '%s'" % message)
+class MockFileAuthorizingBackend(MockAuthorizingBackend, CredentialFileMixin):
 
-        if message == "version\n":
-            return "%s\n" % opentsdbproxy.__version__
-        else:
-            filtered_message = self.filter_message(message)
-            log.debug("Filtered Message: '%s'" % filtered_message)
-            if filtered_message != '\n':
-                self.authzed_messages.append(filtered_message)
+    def __init__(self, host=None, port=None, credential_file=None, credential_reload_interval=None,
+            auth_cache_size=None, auth_cache_ttl=None, auth_cache_negative_ttl=None,
+            auth_threads=None, rate_limit_lines=None, rate_limit_bytes=None, rate_limit_burst=None,
+            rate_limit_policy=None, rate_limit_per_address=False, rate_limit_overrides=None):
+        if credential_file is None:
+            raise ConfigurationException(
+                "%s requires a credential_file to be configured" % self.__class__.__name__)
+
+        self.setup_credential_file(credential_file, credential_reload_interval)
+        self.setup_auth_cache(auth_cache_size, auth_cache_ttl, auth_cache_negative_ttl)
+        self.setup_auth_pool(auth_threads)
+        self.setup_rate_limit(rate_limit_lines, rate_limit_bytes, rate_limit_burst,
+            rate_limit_policy, rate_limit_per_address, rate_limit_overrides)
 
-    def reset(self):
         self.messages = []
         self.authzed_messages = []
 
+    def close(self, timeout=None):
+        self.stop_credential_watcher()
+
 
 backends = {
     'mock': MockOpenTSDBBackend,
     'forwarding': ForwardingOpenTSDBBackend,
     'django_authz': DjangoAuthorizingBackend,
     'mock_django_authz': MockDjangoAuthorizingBackend,
+    'file_authz': FileAuthorizingBackend,
+    'mock_file_authz': MockFileAuthorizingBackend,
 }
+
+
+def load_backend_config(path):
+    """load_backend_config
+
+    @param path - JSON object of backend parameters, such as
+                  {"credential_file": "users.htpasswd", "rate_limit_lines": 100}
+
+    @returns - dict of backend parameters
+    """
+    try:
+        with open(path) as config_file:
+            config = json.load(config_file)
+    except (IOError, ValueError) as e:
+        raise ConfigurationException("Couldn't load backend config '%s': %s" % (path, e))
+    if not isinstance(config, dict):
+        raise ConfigurationException("Backend config '%s' must be a JSON object" % path)
+    return dict((str(name), value) for name, value in config.items())
@@ -0,0 +1,134 @@
+import time
+import logging
+
+import gevent
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 65536
+DEFAULT_MAX_LINES = 1000
+DEFAULT_MAX_DELAY_MS = 50
+
+
+class WriteBatcher(object):
+    """Coalesces lines from every client connection into large upstream writes
+
+    Lines are buffered until max_bytes or max_lines is reached, or until the
+    oldest buffered line has waited max_delay_ms, whichever comes first, and
+    are then handed to flush_callback as a single string.
+
+    If flush_callback raises, the batch is handed to on_failure if given, or
+    logged as lost, so a failed write never reaches the client whose lines
+    happened to fill the batch.
+
+    flush_callback only queues the batch for an upstream writer, so
+    total_enqueue_time and longest_enqueue_time measure how long that took,
+    which is only long while a full queue pushes back. The socket writes
+    themselves are timed by the upstream connections.
+    """
+
+    def __init__(self, flush_callback, max_bytes=None, max_lines=None, max_delay_ms=None,
+            on_failure=None):
+        self.flush_callback = flush_callback
+        self.on_failure = on_failure
+        self.max_bytes = max_bytes or DEFAULT_MAX_BYTES
+        self.max_lines = max_lines or DEFAULT_MAX_LINES
+        if max_delay_ms is None:
+            max_delay_ms = DEFAULT_MAX_DELAY_MS
+        self.max_delay = max_delay_ms / 1000.0
+
+        self._chunks = []
+        self._bytes = 0
+        self._lines = 0
+        self._oldest = None
+        self._timer = None
+
+        self.batches = 0
+        self.batched_lines = 0
+        self.batched_bytes = 0
+        self.largest_batch_lines = 0
+        self.total_wait_time = 0.0
+        self.total_enqueue_time = 0.0
+        self.longest_enqueue_time = 0.0
+        self.failed_batches = 0
+
+    @property
+    def buffered_bytes(self):
+        return self._bytes
+
+    def add(self, data, lines=None):
+        """add
+
+        Buffer lines to be written upstream
+
+        @param data - one or more newline terminated lines
+        @param lines - the number of lines in data, if the caller knows it
+        """
+        if lines is None:
+            lines = data.count('\n')
+
+        self._chunks.append(data)
+        self._bytes += len(data)
+        self._lines += lines
+
+        if self._bytes >= self.max_bytes or self._lines >= self.max_lines:
+            self.flush()
+        elif self._timer is None:
+            self._oldest = time.time()
+            self._timer = gevent.spawn_later(self.max_delay, self._timed_flush)
+
+    def flush(self):
+        """flush
+
+        Hand everything buffered to flush_callback now
+        """
+        if self._timer is not None:
+            if self._timer is not gevent.getcurrent():
+                self._timer.kill(block=False)
+            self._timer = None
+        if not self._chunks:
+            return
+
+        # Swap the buffer out first, so lines added while flush_callback
+        # blocks go into the next batch
+        chunks, lines, oldest = self._chunks, self._lines, self._oldest
+        self._chunks = []
+        self._bytes = 0
+        self._lines = 0
+        self._oldest = None
+
+        data = ''.join(chunks)
+        start = time.time()
+        try:
+            self.flush_callback(data)
+        except Exception:
+            self.failed_batches += 1
+            self._fail(data)
+            return
+        finished = time.time()
+
+        self.batches += 1
+        self.batched_lines += lines
+        self.batched_bytes += len(data)
+        self.largest_batch_lines = max(self.largest_batch_lines, lines)
+        if oldest is not None:
+            self.total_wait_time += start - oldest
+        enqueue_time = finished - start
+        self.total_enqueue_time += enqueue_time
+        self.longest_enqueue_time = max(self.longest_enqueue_time, enqueue_time)
+
+    def close(self):
+        self.flush()
+
+    def _fail(self, data):
+        if self.on_failure is None:
+            log.exception("Lost a batch of %d bytes" % len(data))
+            return
+        log.warning("Failed to flush a batch of %d bytes, handing it on" % len(data), exc_info=True)
+        try:
+            self.on_failure(data)
+        except Exception:
+            log.exception("Lost a batch of %d bytes" % len(data))
+
+    def _timed_flush(self):
+        self.flush()
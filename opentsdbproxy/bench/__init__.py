@@ -0,0 +1,8 @@
+"""Benchmarks for the proxy
+
+stubtsd - a local stand in for OpenTSDB that records what it receives
+loadgen - simulated tcollector clients
+harness - runs the proxy against the stub under load and reports throughput,
+          latency, CPU and RSS
+micro - times filter_message and handle per line, against saved baselines
+"""
@@ -0,0 +1,257 @@
+"""End to end benchmark of the proxy
+
+Starts a StubTSD in this process and the proxy in a subprocess pointed at
+it, drives the proxy with a LoadGenerator, and reports delivered lines per
+second, end to end latency percentiles, and the proxy's CPU time and peak RSS.
+
+    $ opentsdb-proxy-bench --backends forwarding,file_authz --clients 100 \\
+        --rate 50 --duration 30 --proxy-args="--batch --upstream-connections 4"
+"""
+
+import os
+import sys
+import time
+import json
+import base64
+import shlex
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+import gevent
+
+from gevent import socket
+
+import opentsdbproxy
+
+from opentsdbproxy.bench.loadgen import LoadGenerator
+from opentsdbproxy.bench.stubtsd import StubTSD
+
+DJANGO_PROJECT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    "test", "django_test_project")
+BENCH_CREDENTIALS = ("bench", "bench")
+STARTUP_TIMEOUT = 30
+DRAIN_TIMEOUT = 10
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def forwarding_setup(tempdir):
+    return [], None
+
+
+def file_authz_setup(tempdir):
+    path = os.path.join(tempdir, "users.htpasswd")
+    user, password = BENCH_CREDENTIALS
+    with open(path, 'w') as credential_file:
+        credential_file.write("%s:{SHA}%s\n" % (user, base64.b64encode(hashlib.sha1(password).digest())))
+    return ['--credential-file', path], BENCH_CREDENTIALS
+
+
+def django_authz_setup(tempdir):
+    return ['--django-project-path', DJANGO_PROJECT_DIR,
+        '--django-settings-module', 'testproject.settings'], ("root", "root")
+
+
+BACKEND_SETUP = {
+    'forwarding': forwarding_setup,
+    'file_authz': file_authz_setup,
+    'django_authz': django_authz_setup,
+}
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def make_certificate(tempdir):
+    cert = os.path.join(tempdir, "server.crt")
+    key = os.path.join(tempdir, "server.key")
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost'],
+        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    return cert, key
+
+
+def process_tree(pid):
+    """The pid and all of its descendants, so --workers is measured whole"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as stat:
+                ppid = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+
+def cpu_seconds(pid):
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open('/proc/%d/stat' % member) as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / float(CLOCK_TICKS)
+
+
+def rss_bytes(pid):
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open('/proc/%d/statm' % member) as statm:
+                total += int(statm.read().split()[1]) * PAGE_SIZE
+        except IOError:
+            continue
+    return total
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def wait_for_port(port, proc):
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("Proxy exited with status %s" % proc.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except socket.error:
+            gevent.sleep(0.1)
+    raise RuntimeError("Proxy didn't start listening within %ss" % STARTUP_TIMEOUT)
+
+
+def run_benchmark(backend, args, tempdir, ssl_cert, ssl_key):
+    stub = StubTSD(record=False, track_latency=True, latency=args.stub_latency,
+        error_rate=args.stub_error_rate, disconnect_rate=args.stub_disconnect_rate)
+    backend_args, credentials = BACKEND_SETUP[backend](tempdir)
+    port = free_port()
+
+    command = [sys.executable, '-c', 'from opentsdbproxy.cli import main; main()',
+        '--backend', backend, '--port', str(port), '--log-level', 'warning',
+        '--ssl-cert', ssl_cert, '--ssl-key', ssl_key,
+        '--opentsdb-host', '127.0.0.1', '--opentsdb-port', str(stub.port)]
+    command += backend_args + shlex.split(args.proxy_args or '')
+
+    log_path = os.path.join(tempdir, "%s.log" % backend)
+    proc = subprocess.Popen(command, stdout=open(log_path, 'w'), stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(port, proc)
+
+        loadgen = LoadGenerator('127.0.0.1', port, clients=args.clients, rate=args.rate,
+            cardinality=args.cardinality, metrics=args.metrics, credentials=credentials)
+        cpu_before = cpu_seconds(proc.pid)
+        started = time.time()
+        loadgen.run(args.duration)
+
+        # Let the proxy finish forwarding what it has buffered
+        deadline = time.time() + DRAIN_TIMEOUT
+        delivered = -1
+        while stub.puts != delivered and time.time() < deadline:
+            delivered = stub.puts
+            gevent.sleep(0.5)
+        elapsed = time.time() - started
+        cpu = cpu_seconds(proc.pid) - cpu_before
+        rss = rss_bytes(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait()
+        stub.stop()
+
+    return {
+        'backend': backend,
+        'clients': args.clients,
+        'sent': loadgen.sent,
+        'delivered': stub.puts,
+        'client_errors': loadgen.errors,
+        'lines_per_second': stub.puts / elapsed,
+        'latency_p50': percentile(stub.latencies, 0.50),
+        'latency_p99': percentile(stub.latencies, 0.99),
+        'cpu_seconds': cpu,
+        'cpu_per_line_us': cpu / stub.puts * 1e6 if stub.puts else None,
+        'rss_bytes': rss,
+        'proxy_log': log_path,
+    }
+
+
+def format_seconds(value):
+    if value is None:
+        return '-'
+    return "%.1fms" % (value * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="%s benchmark" % opentsdbproxy.__fullversion__)
+    parser.add_argument('--backends', default='forwarding',
+        help="Comma separated backends to benchmark, from %s" % ', '.join(sorted(BACKEND_SETUP)))
+    parser.add_argument('--clients', type=int, default=10, help="Concurrent TLS clients")
+    parser.add_argument('--rate', type=int, default=100, help="Datapoints per second per client")
+    parser.add_argument('--cardinality', type=int, default=10, help="Series tag values per client")
+    parser.add_argument('--metrics', type=int, default=10, help="Metric names per client")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to send for")
+    parser.add_argument('--proxy-args', help="Extra arguments for opentsdb-proxy, e.g. --proxy-args='--batch'")
+    parser.add_argument('--stub-latency', type=float, default=0,
+        help="Seconds the stub TSD stalls after each read")
+    parser.add_argument('--stub-error-rate', type=float, default=0,
+        help="Fraction of puts the stub TSD rejects")
+    parser.add_argument('--stub-disconnect-rate', type=float, default=0,
+        help="Chance the stub TSD drops a connection after each read")
+    parser.add_argument('--ssl-cert', help="SSL certificate, one is generated if not given")
+    parser.add_argument('--ssl-key', help="SSL key, one is generated if not given")
+    parser.add_argument('--json', metavar='results.json', help="Also write the results here")
+    args = parser.parse_args()
+
+    backends = [backend.strip() for backend in args.backends.split(',') if backend.strip()]
+    for backend in backends:
+        if backend not in BACKEND_SETUP:
+            parser.error("Can't benchmark backend '%s'" % backend)
+
+    tempdir = tempfile.mkdtemp(prefix='opentsdbproxy-bench-')
+    try:
+        ssl_cert, ssl_key = args.ssl_cert, args.ssl_key
+        if ssl_cert is None or ssl_key is None:
+            ssl_cert, ssl_key = make_certificate(tempdir)
+
+        results = []
+        print "%-14s %10s %10s %9s %9s %10s %12s %9s" % ('backend', 'sent', 'delivered',
+            'lines/s', 'p50', 'p99', 'cpu us/line', 'rss MB')
+        for backend in backends:
+            result = run_benchmark(backend, args, tempdir, ssl_cert, ssl_key)
+            results.append(result)
+            print "%-14s %10d %10d %9.0f %9s %10s %12s %9.1f" % (backend, result['sent'],
+                result['delivered'], result['lines_per_second'],
+                format_seconds(result['latency_p50']), format_seconds(result['latency_p99']),
+                '-' if result['cpu_per_line_us'] is None else "%.1f" % result['cpu_per_line_us'],
+                result['rss_bytes'] / 1048576.0)
+
+        if args.json:
+            for result in results:
+                del result['proxy_log']
+            with open(args.json, 'w') as json_file:
+                json.dump({'arguments': vars(args), 'results': results}, json_file, indent=2)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import time
+import random
+import logging
+
+import gevent
+
+from gevent import socket, ssl
+
+log = logging.getLogger(__name__)
+
+SEND_INTERVAL = 0.1
+
+
+class LoadGenerator(object):
+    """Simulates tcollector clients pushing puts to the proxy
+
+    Each client holds one connection and sends rate datapoints per second,
+    in a burst every SEND_INTERVAL like tcollector's sender thread. Every
+    datapoint's value is the time it was sent, so a StubTSD with
+    track_latency can work out end to end latency.
+
+    @param clients - number of concurrent connections
+    @param rate - datapoints per second per client
+    @param cardinality - distinct values of the 'series' tag per client
+    @param metrics - distinct metric names per client
+    @param credentials - (user, password) tags to add to every line
+    @param use_ssl - connect with TLS, as tcollector does
+    """
+
+    def __init__(self, host, port, clients=10, rate=100, cardinality=10, metrics=10,
+            credentials=None, use_ssl=True):
+        self.host = host
+        self.port = port
+        self.clients = clients
+        self.rate = rate
+        self.cardinality = cardinality
+        self.metrics = metrics
+        self.credentials = credentials
+        self.use_ssl = use_ssl
+
+        self.sent = 0
+        self.errors = 0
+
+    def run(self, duration):
+        """run
+
+        @param duration - seconds to send for
+
+        @returns - the number of datapoints sent
+        """
+        deadline = time.time() + duration
+        clients = [gevent.spawn(self._client, index, deadline) for index in range(self.clients)]
+        gevent.joinall(clients)
+        return self.sent
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port))
+        if self.use_ssl:
+            sock = ssl.wrap_socket(sock)
+        return sock
+
+    def _client(self, index, deadline):
+        suffix = " client=%d" % index
+        if self.credentials is not None:
+            suffix += " user=%s password=%s" % self.credentials
+        suffix += "\n"
+
+        per_send = max(1, int(round(self.rate * SEND_INTERVAL)))
+        carry = random.random() * SEND_INTERVAL
+        try:
+            sock = self._connect()
+        except (socket.error, ssl.SSLError) as e:
+            log.warning("Client %d couldn't connect: %s" % (index, e))
+            self.errors += 1
+            return
+
+        # Stagger clients so their bursts don't all line up
+        gevent.sleep(carry)
+        next_send = time.time()
+        try:
+            while next_send < deadline:
+                now = time.time()
+                timestamp = int(now)
+                lines = []
+                for _ in range(per_send):
+                    lines.append("put bench.metric.%d %d %.6f series=%d%s" % (
+                        random.randrange(self.metrics), timestamp, now,
+                        random.randrange(self.cardinality), suffix))
+                sock.sendall(''.join(lines))
+                self.sent += per_send
+
+                next_send += SEND_INTERVAL
+                gevent.sleep(max(0, next_send - time.time()))
+        except (socket.error, ssl.SSLError) as e:
+            log.warning("Client %d failed: %s" % (index, e))
+            self.errors += 1
+        finally:
+            sock.close()
@@ -0,0 +1,271 @@
+"""Microbenchmarks of the per line hot path
+
+Times filter_message and the backends' handle over synthetic tcollector
+messages, with authentication stubbed out and nothing written upstream, so
+only proxy code is measured. Results can be saved as a JSON baseline and
+later runs compared against it:
+
+    $ opentsdb-proxy-microbench --save baseline.json
+    $ opentsdb-proxy-microbench --compare baseline.json --threshold 0.1
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+
+import opentsdbproxy
+
+from opentsdbproxy.authcache import AuthCache
+from opentsdbproxy.backends import (AuthorizingBackend, ForwardingOpenTSDBBackend,
+    MockAuthorizingBackend)
+
+GOOD_PASSWORD = 'good'
+BAD_PASSWORD = 'bad'
+USERS = 10
+
+LINES_PER_MESSAGE = (1, 10, 100)
+TAGS_PER_LINE = (1, 4, 8)
+AUTHORIZED_RATIOS = (1.0, 0.5, 0.0)
+
+DEFAULT_MIN_TIME = 0.2
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.10
+
+
+class StubAuthenticator(object):
+    """Accepts any user whose password is GOOD_PASSWORD, without I/O
+
+    Each benchmark backend gets its own AuthCache so runs don't share
+    results with each other or with the process wide cache.
+    """
+
+    def setup_stub_auth(self):
+        self.auth_cache = AuthCache()
+
+    def authenticate(self, username=None, password=None):
+        if password == GOOD_PASSWORD:
+            return username
+        return None
+
+
+class StubUpstream(object):
+    """Stands in for the upstream pool's connections, counting what is sent"""
+
+    def __init__(self):
+        self.sent_bytes = 0
+
+    def send(self, data):
+        self.sent_bytes += len(data)
+        return True
+
+    def request(self, data, timeout=None):
+        self.sent_bytes += len(data)
+        if data == "version\n":
+            return "%s\n" % opentsdbproxy.__version__
+        return None
+
+
+class StubForwardingBackend(ForwardingOpenTSDBBackend):
+    """A fire and forget forwarding backend whose upstream pool is never
+    connected, as everything it would write goes to a StubUpstream
+    """
+
+    def __init__(self):
+        ForwardingOpenTSDBBackend.__init__(self, host='stub', port=0, fire_and_forget=True)
+        self.stub_upstream = StubUpstream()
+
+    def checkout(self):
+        return self.stub_upstream
+
+    def write(self, data, pool=None):
+        self.stub_upstream.send(data)
+
+
+class StubAuthorizingBackend(StubAuthenticator, AuthorizingBackend, StubForwardingBackend):
+
+    def __init__(self):
+        StubForwardingBackend.__init__(self)
+        self.setup_stub_auth()
+
+
+class StubMockAuthorizingBackend(StubAuthenticator, MockAuthorizingBackend):
+
+    def __init__(self):
+        self.setup_stub_auth()
+        self.reset()
+
+
+def make_corpus(lines_per_message, tags_per_line, authorized_ratio, messages=100, seed=0):
+    """make_corpus
+
+    Build tcollector messages, each line carrying user and password tags
+
+    @param lines_per_message - put lines in each message
+    @param tags_per_line - tags on each line besides user and password
+    @param authorized_ratio - fraction of lines with a good password
+    @param messages - how many messages to build
+    @param seed - seed for the generator, so corpora are reproducible
+
+    @returns - list of newline terminated messages
+    """
+    rand = random.Random(seed)
+    timestamp = 1356998400
+    corpus = []
+    for _ in range(messages):
+        lines = []
+        for _ in range(lines_per_message):
+            tags = ' '.join("tag%d=value%d" % (tag, rand.randrange(100)) for tag in range(tags_per_line))
+            password = GOOD_PASSWORD if rand.random() < authorized_ratio else BAD_PASSWORD
+            lines.append("put proc.stat.cpu.%d %d %d %s user=user%d password=%s\n" % (
+                rand.randrange(10), timestamp, rand.randrange(1000), tags,
+                rand.randrange(USERS), password))
+            timestamp += 1
+        corpus.append(''.join(lines))
+    return corpus
+
+
+def make_cases(pattern=None):
+    """make_cases
+
+    @param pattern - only make cases whose name contains this
+
+    @returns - list of (name, function to call with each message, corpus)
+    """
+    filtering = StubAuthorizingBackend()
+    forwarding = StubForwardingBackend()
+    authorizing = StubAuthorizingBackend()
+    mock_authorizing = StubMockAuthorizingBackend()
+
+    def mock_handle(message):
+        mock_authorizing.handle(message)
+        mock_authorizing.reset()
+
+    targets = (
+        ('filter_message', filtering.filter_message, True),
+        ('forwarding.handle', forwarding.handle, False),
+        ('authorizing.handle', authorizing.handle, True),
+        ('mock_authorizing.handle', mock_handle, True),
+    )
+
+    cases = []
+    for target, function, authorizes in targets:
+        for lines in LINES_PER_MESSAGE:
+            for tags in TAGS_PER_LINE:
+                # Forwarding ignores credentials, so one ratio is enough
+                ratios = AUTHORIZED_RATIOS if authorizes else AUTHORIZED_RATIOS[:1]
+                for ratio in ratios:
+                    name = "%s/lines=%d/tags=%d/authorized=%.1f" % (target, lines, tags, ratio)
+                    if pattern and pattern not in name:
+                        continue
+                    cases.append((name, function, make_corpus(lines, tags, ratio)))
+    return cases
+
+
+def time_case(function, corpus, min_time=DEFAULT_MIN_TIME, repeat=DEFAULT_REPEAT):
+    """time_case
+
+    Run function over the corpus enough times to take min_time, repeat
+    times over, and keep the fastest
+
+    @returns - best seconds per line
+    """
+    lines = sum(message.count('\n') for message in corpus)
+
+    # Warm the auth cache and work out how many passes fill min_time
+    passes = 1
+    while True:
+        started = time.time()
+        for _ in xrange(passes):
+            for message in corpus:
+                function(message)
+        elapsed = time.time() - started
+        if elapsed >= min_time / 4.0:
+            break
+        passes *= 2
+    passes = max(1, int(passes * min_time / max(elapsed, 1e-9)))
+
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        for _ in xrange(passes):
+            for message in corpus:
+                function(message)
+        per_line = (time.time() - started) / (passes * lines)
+        if best is None or per_line < best:
+            best = per_line
+    return best
+
+
+def run(pattern=None, min_time=DEFAULT_MIN_TIME, repeat=DEFAULT_REPEAT, out=None):
+    """run
+
+    @param pattern - only run cases whose name contains this
+    @param out - file to print progress to, or None
+
+    @returns - dict of case name to nanoseconds per line
+    """
+    results = {}
+    for name, function, corpus in make_cases(pattern):
+        results[name] = time_case(function, corpus, min_time=min_time, repeat=repeat) * 1e9
+        if out is not None:
+            print >>out, "%-60s %10.0f ns/line %12.0f lines/s" % (name, results[name],
+                1e9 / results[name])
+    return results
+
+
+def compare(baseline, results, threshold=DEFAULT_THRESHOLD):
+    """compare
+
+    @param baseline - dict of case name to nanoseconds per line
+    @param results - dict of case name to nanoseconds per line
+    @param threshold - fraction slower than the baseline that counts as a regression
+
+    @returns - list of (name, baseline ns, result ns) for each regression
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        if results[name] > baseline[name] * (1 + threshold):
+            regressions.append((name, baseline[name], results[name]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="%s microbenchmarks" % opentsdbproxy.__fullversion__)
+    parser.add_argument('--filter', metavar='filter_message',
+        help="Only run cases whose name contains this")
+    parser.add_argument('--min-time', metavar=str(DEFAULT_MIN_TIME), type=float,
+        default=DEFAULT_MIN_TIME, help="Seconds to spend on each timing run")
+    parser.add_argument('--repeat', metavar=str(DEFAULT_REPEAT), type=int,
+        default=DEFAULT_REPEAT, help="Timing runs per case, the fastest is kept")
+    parser.add_argument('--save', metavar='baseline.json', help="Write the results as a baseline")
+    parser.add_argument('--compare', metavar='baseline.json', help="Compare the results to a baseline")
+    parser.add_argument('--threshold', metavar=str(DEFAULT_THRESHOLD), type=float,
+        default=DEFAULT_THRESHOLD, help="Fraction slower than the baseline that fails --compare")
+    args = parser.parse_args()
+
+    results = run(pattern=args.filter, min_time=args.min_time, repeat=args.repeat, out=sys.stdout)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'version': opentsdbproxy.__version__, 'python': platform.python_version(),
+                'results': results}, baseline_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(baseline, results, threshold=args.threshold)
+        for name, before, after in regressions:
+            print "REGRESSION %s: %.0f -> %.0f ns/line (+%.0f%%)" % (name, before, after,
+                (after / before - 1) * 100)
+        if regressions:
+            sys.exit(1)
+        print "No regressions beyond %.0f%% of %s" % (args.threshold * 100, args.compare)
+
+
+if __name__ == '__main__':
+    main()
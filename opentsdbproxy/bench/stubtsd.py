@@ -0,0 +1,153 @@
+import json
+import time
+import random
+import logging
+
+import gevent
+
+from gevent.pywsgi import WSGIServer
+from gevent.server import StreamServer
+
+log = logging.getLogger(__name__)
+
+STUB_VERSION = "net.opentsdb built at revision stub\n"
+
+
+class StubTSD(object):
+    """Just enough of a TSD to answer version and accept puts
+
+    @param record - keep every put line received in self.lines
+    @param track_latency - treat each put's value as the time it was sent,
+                           and keep how long it took to arrive in self.latencies
+    @param latency - seconds to stall after every read, to mimic a slow TSD
+    @param error_rate - fraction of puts answered with a 'put:' error
+    @param disconnect_rate - chance of dropping the connection after each read
+    """
+
+    def __init__(self, port=0, address='127.0.0.1', record=True, track_latency=False,
+            latency=0, error_rate=0, disconnect_rate=0):
+        self.record = record
+        self.track_latency = track_latency
+        self.latency = latency
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+
+        self.lines = []
+        self.latencies = []
+        self.puts = 0
+        self.bytes = 0
+        self.connections = 0
+
+        self.server = StreamServer((address, port), self.handle)
+        self.server.start()
+        self.port = self.server.server_port
+
+    def handle(self, sock, address):
+        self.connections += 1
+        partial = ''
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            arrived = time.time()
+            self.bytes += len(data)
+
+            lines = (partial + data).split('\n')
+            partial = lines.pop()
+            replies = []
+            for line in lines:
+                if line.startswith('put '):
+                    self.put(line, arrived, replies)
+                elif line == 'version':
+                    replies.append(STUB_VERSION)
+            if replies:
+                sock.sendall(''.join(replies))
+
+            if self.latency:
+                gevent.sleep(self.latency)
+            if self.disconnect_rate and random.random() < self.disconnect_rate:
+                log.debug("Stub TSD dropping connection from %s" % (address,))
+                break
+        sock.close()
+
+    def put(self, line, arrived, replies):
+        self.puts += 1
+        if self.record:
+            self.lines.append(line)
+        if self.track_latency:
+            try:
+                sent = float(line.split(' ', 4)[3])
+            except (IndexError, ValueError):
+                pass
+            else:
+                self.latencies.append(arrived - sent)
+        if self.error_rate and random.random() < self.error_rate:
+            replies.append("put: stub error\n")
+
+    def stop(self):
+        self.server.stop()
+
+
+class StubHTTPTSD(StubTSD):
+    """Just enough of a TSD's HTTP API to answer /api/version and accept
+    /api/put, recording each datapoint as the put line it would have been
+
+    Points picked by error_rate are reported failed in the details response.
+    """
+
+    def __init__(self, port=0, address='127.0.0.1', record=True, track_latency=False,
+            latency=0, error_rate=0, disconnect_rate=0):
+        self.record = record
+        self.track_latency = track_latency
+        self.latency = latency
+        self.error_rate = error_rate
+        self.disconnect_rate = disconnect_rate
+
+        self.lines = []
+        self.latencies = []
+        self.puts = 0
+        self.bytes = 0
+        self.connections = 0
+        self.requests = 0
+
+        self.server = WSGIServer((address, port), self.application, log=None)
+        self.server.start()
+        self.port = self.server.server_port
+
+    def application(self, environ, start_response):
+        self.requests += 1
+        path = environ.get('PATH_INFO', '')
+        if path == '/api/version':
+            return self.respond(start_response, '200 OK', {'version': 'stub', 'short_revision': 'stub'})
+        if path != '/api/put' or environ['REQUEST_METHOD'] != 'POST':
+            return self.respond(start_response, '404 Not Found', {'error': {'code': 404}})
+
+        body = environ['wsgi.input'].read()
+        arrived = time.time()
+        self.bytes += len(body)
+        datapoints = json.loads(body)
+        if isinstance(datapoints, dict):
+            datapoints = [datapoints]
+
+        errors = []
+        for datapoint in datapoints:
+            tags = ' '.join('%s=%s' % item for item in sorted(datapoint['tags'].items()))
+            line = "put %s %s %s %s" % (datapoint['metric'], datapoint['timestamp'],
+                datapoint['value'], tags)
+            replies = []
+            self.put(str(line), arrived, replies)
+            if replies:
+                errors.append({'datapoint': datapoint, 'error': "stub error"})
+
+        if self.latency:
+            gevent.sleep(self.latency)
+        if self.disconnect_rate and random.random() < self.disconnect_rate:
+            return self.respond(start_response, '500 Internal Server Error', {'error': {'code': 500}})
+        summary = {'success': len(datapoints) - len(errors), 'failed': len(errors), 'errors': errors}
+        return self.respond(start_response, '400 Bad Request' if errors else '200 OK', summary)
+
+    def respond(self, start_response, status, body):
+        body = json.dumps(body)
+        start_response(status, [('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body)))])
+        return [body]
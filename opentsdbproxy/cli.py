@@ -6,25 +6,150 @@ import argparse
 import opentsdbproxy
 
 from opentsdbproxy.exceptions import ConfigurationException
-
-logging.basicConfig(level=logging.DEBUG)
+from opentsdbproxy.framing import DEFAULT_MAX_COMPRESSION_RATIO
+from opentsdbproxy.tls import make_server_context
+from opentsdbproxy.workers import WorkerSupervisor, reuse_port_listener
 
 
 def main():
 
     parser = argparse.ArgumentParser(description=opentsdbproxy.__fullversion__)
     parser.add_argument('--backend', metavar='mock', default='mock', type=str,
-        help="Choose from 'mock', 'forwarding', 'django_authz'")
+        help="Choose from 'mock', 'forwarding', 'django_authz', 'file_authz'")
     parser.add_argument('--port', metavar='4242', type=int, default=4242,
         help="Port to listen to tcollector messages")
+    parser.add_argument('--workers', metavar='1', type=int, default=1,
+        help="Number of worker processes, each listening on the port with SO_REUSEPORT")
+    parser.add_argument('--stats-port', metavar='9242', type=int,
+        help="Port to serve Prometheus metrics on, each worker adds its index to it")
     parser.add_argument('--ssl-cert', metavar='server.crt', required=True,
         help="SSL Certificate")
     parser.add_argument('--ssl-key', metavar='server.key', required=True,
         help="SSL Key")
+    parser.add_argument('--log-level', metavar='debug', default='debug',
+        choices=('debug', 'info', 'warning', 'error'),
+        help="Least severe messages to log")
+    parser.add_argument('--ssl-ciphers', metavar='hardened',
+        help="OpenSSL cipher list to offer clients, or 'hardened' for forward secret "
+        "ECDHE ciphers only. Python's default list if not given")
+    parser.add_argument('--ssl-ecdh-curve', metavar='prime256v1',
+        help="Curve for ECDHE key exchange")
+    parser.add_argument('--no-ssl-session-tickets', dest='ssl_session_tickets',
+        action='store_false', default=True,
+        help="Only resume TLS sessions from the server's session cache, not from tickets")
+    parser.add_argument('--plaintext-port', metavar='4243', type=int,
+        help="Also accept unencrypted tcollector connections on this port, for trusted networks only")
+    parser.add_argument('--http-port', metavar='4443', type=int,
+        help="Also accept batches of JSON datapoints on /api/put over HTTPS on this port")
+    parser.add_argument('--http-max-body', metavar='16777216', type=int,
+        help="Largest /api/put request body accepted, after decompression")
+    parser.add_argument('--backend-config', metavar='backend.json',
+        help="JSON object of backend parameters overriding the command line, such as "
+        "{\"rate_limit_lines\": 100}, read again on SIGHUP")
+    parser.add_argument('--drain-timeout', metavar='30', type=float,
+        help="Seconds SIGTERM waits for clients and queued writes to OpenTSDB before exiting")
+    parser.add_argument('--max-line-length', metavar='8192', type=int,
+        default=opentsdbproxy.MAX_LINE_LENGTH,
+        help="Longest line accepted from tcollector, longer lines are dropped")
+    parser.add_argument('--no-compression', dest='compression', action='store_false', default=True,
+        help="Don't let clients switch to a compressed stream with 'compress zlib|deflate|gzip'")
+    parser.add_argument('--max-compression-ratio', metavar='250', type=int,
+        default=DEFAULT_MAX_COMPRESSION_RATIO,
+        help="Close compressed streams that expand more than this many times")
     parser.add_argument('--opentsdb-host', metavar='example.com',
-        help="Host to forward messages to, used by 'forwarding' and 'django_authz'")
+        help="Host to forward messages to, or a comma separated list of host[:port] to shard "
+        "series across, used by 'forwarding' and 'django_authz'")
     parser.add_argument('--opentsdb-port', default=4242,
         help="Port of host to forward messages to, used by 'forwarding' and 'django_authz'")
+    parser.add_argument('--opentsdb-standby', metavar='standby.example.com',
+        help="Comma separated list of host[:port] to write to, in order, while --opentsdb-host is down")
+    parser.add_argument('--fire-and-forget', action='store_true', default=False,
+        help="Forward puts over any upstream connection, without parsing messages of only puts, "
+        "rather than writing each message in order to one connection, used by 'forwarding' and 'django_authz'")
+    parser.add_argument('--upstream-connections', metavar='4', type=int,
+        help="Number of connections to keep open to OpenTSDB, used by 'forwarding' and 'django_authz'")
+    parser.add_argument('--upstream-checkout', choices=('round_robin', 'least_loaded'),
+        help="How to choose the OpenTSDB connection for each message, used by 'forwarding' and 'django_authz'")
+    parser.add_argument('--upstream-probe-interval', metavar='5', type=float,
+        help="Seconds between version probes of idle OpenTSDB connections, which also reconnect "
+        "them, or of a TSD that is down with --upstream-protocol http")
+    parser.add_argument('--upstream-backoff', metavar='1', type=float,
+        help="Seconds to stop trying an OpenTSDB host after it fails, doubling with each failure")
+    parser.add_argument('--upstream-max-backoff', metavar='60', type=float,
+        help="Longest time to stop trying a failing OpenTSDB host")
+    parser.add_argument('--upstream-protocol', choices=('telnet', 'http'),
+        help="Write puts to OpenTSDB as telnet put lines, or as JSON batches POSTed to "
+        "/api/put with one request in flight per --upstream-connections")
+    parser.add_argument('--http-batch-size', metavar='500', type=int,
+        help="Most datapoints to POST to /api/put at once, with --upstream-protocol http")
+    parser.add_argument('--http-linger-ms', metavar='50', type=int,
+        help="Milliseconds to wait for an /api/put batch to fill, with --upstream-protocol http")
+    parser.add_argument('--upstream-vnodes', metavar='160', type=int,
+        help="Points on the hash ring for each OpenTSDB host when sharding")
+    parser.add_argument('--batch', action='store_true', default=False,
+        help="Coalesce puts from all clients into larger writes to OpenTSDB, used by 'forwarding' and 'django_authz'")
+    parser.add_argument('--batch-max-bytes', metavar='65536', type=int,
+        help="Write a batch once it holds this many bytes")
+    parser.add_argument('--batch-max-lines', metavar='1000', type=int,
+        help="Write a batch once it holds this many lines")
+    parser.add_argument('--batch-max-delay-ms', metavar='50', type=int,
+        help="Write a batch once its oldest line has waited this many milliseconds")
+    parser.add_argument('--dedupe-window', metavar='60', type=int,
+        help="Drop puts repeating a metric, tags and timestamp seen within this many seconds")
+    parser.add_argument('--dedupe-max-entries', metavar='1000000', type=int,
+        help="Most recent puts to remember for --dedupe-window")
+    parser.add_argument('--downsample', metavar='sys.cpu.*:60:avg', action='append',
+        help="Reduce metrics matching a pattern to one point per interval with min, max, avg or "
+        "last, may be repeated")
+    parser.add_argument('--queue-max-bytes', metavar='67108864', type=int,
+        help="Most bytes to queue for OpenTSDB, used by 'forwarding' and 'django_authz'")
+    parser.add_argument('--queue-policy', choices=('block', 'drop_newest', 'drop_oldest'),
+        help="What to do when the OpenTSDB queue is full, 'block' stops reading from clients")
+    parser.add_argument('--mirror', metavar='tsd://staging.example.com:4242', action='append',
+        help="Also copy forwarded puts to a tsd://host:port or file:///path, without slowing "
+        "OpenTSDB writes, add ?policy=drop_newest&max_bytes=n to override the mirror queue "
+        "defaults, may be repeated, used by 'forwarding' and 'django_authz'")
+    parser.add_argument('--mirror-queue-max-bytes', metavar='67108864', type=int,
+        help="Most bytes to queue for each mirror")
+    parser.add_argument('--mirror-queue-policy', choices=('drop_newest', 'drop_oldest'),
+        help="What to do when a mirror's queue is full, drop_oldest by default")
+    parser.add_argument('--spool-dir', metavar='/var/spool/opentsdbproxy',
+        help="Directory to spool puts to while OpenTSDB is unreachable, used by 'forwarding' and 'django_authz'")
+    parser.add_argument('--spool-segment-size', metavar='16777216', type=int,
+        help="Bytes per spool segment file")
+    parser.add_argument('--spool-max-size', metavar='1073741824', type=int,
+        help="Most bytes to spool, the oldest segments are dropped beyond this")
+    parser.add_argument('--spool-replay-rate', metavar='1048576', type=int,
+        help="Bytes per second to replay from the spool once OpenTSDB is reachable")
+    parser.add_argument('--auth-cache-size', metavar='10000', type=int,
+        help="Number of authentication results to cache, 0 disables the cache, used by 'django_authz' and 'file_authz'")
+    parser.add_argument('--auth-cache-ttl', metavar='300', type=int,
+        help="Seconds to cache a successful authentication, used by 'django_authz' and 'file_authz'")
+    parser.add_argument('--auth-cache-negative-ttl', metavar='30', type=int,
+        help="Seconds to cache a failed authentication, used by 'django_authz' and 'file_authz'")
+    parser.add_argument('--auth-threads', metavar='10', type=int,
+        help="Threads to check uncached credentials in, so slow lookups don't stall other connections, "
+        "0 checks them inline, used by 'django_authz' and 'file_authz'")
+    parser.add_argument('--auth-sessions', action='store_true', default=False,
+        help="Authenticate each connection once, from an 'auth <user> <password>' command or its "
+        "first line with credentials, then accept lines with the same credentials or none, "
+        "used by 'django_authz' and 'file_authz'")
+    parser.add_argument('--rate-limit-lines', metavar='1000', type=int,
+        help="Lines per second each user may send, used by 'django_authz' and 'file_authz'")
+    parser.add_argument('--rate-limit-bytes', metavar='100000', type=int,
+        help="Bytes per second each user may send, used by 'django_authz' and 'file_authz'")
+    parser.add_argument('--rate-limit-burst', metavar='1', type=float,
+        help="Seconds of traffic a user may send at once above their rate limit")
+    parser.add_argument('--rate-limit-policy', choices=('drop', 'delay'),
+        help="Drop lines over a user's rate limit, or delay reading from their connection")
+    parser.add_argument('--rate-limit-per-address', action='store_true', default=False,
+        help="Rate limit each user separately for every address they connect from")
+    parser.add_argument('--rate-limit-overrides', metavar='limits.json',
+        help="JSON object of username to {\"lines\": n, \"bytes\": n} per second limits, 0 for unlimited")
+    parser.add_argument('--credential-file', metavar='users.htpasswd',
+        help="htpasswd or JSON file of usernames and password hashes, used by 'file_authz'")
+    parser.add_argument('--credential-reload-interval', metavar='5', type=int,
+        help="Seconds between checks for changes to the credential file, used by 'file_authz'")
     parser.add_argument('--django-project-path',
         help="Path to the Django project you would like to authz against, used by 'django_authz'")
     parser.add_argument('--django-settings-module',
@@ -32,22 +157,109 @@ def main():
 
     args = parser.parse_args()
 
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+
     backend = args.backend.lower()
     backend_parameters = {}
 
+    forwarding_parameters = {
+        'host': args.opentsdb_host, 'port': args.opentsdb_port,
+        'fire_and_forget': args.fire_and_forget,
+        'upstream_connections': args.upstream_connections,
+        'upstream_checkout': args.upstream_checkout,
+        'upstream_vnodes': args.upstream_vnodes,
+        'upstream_protocol': args.upstream_protocol,
+        'standby_hosts': args.opentsdb_standby,
+        'upstream_probe_interval': args.upstream_probe_interval,
+        'upstream_backoff': args.upstream_backoff,
+        'upstream_max_backoff': args.upstream_max_backoff,
+        'http_batch_size': args.http_batch_size,
+        'http_linger_ms': args.http_linger_ms,
+        'batch': args.batch,
+        'batch_max_bytes': args.batch_max_bytes,
+        'batch_max_lines': args.batch_max_lines,
+        'batch_max_delay_ms': args.batch_max_delay_ms,
+        'dedupe_window': args.dedupe_window,
+        'dedupe_max_entries': args.dedupe_max_entries,
+        'downsample': args.downsample,
+        'queue_max_bytes': args.queue_max_bytes,
+        'queue_policy': args.queue_policy,
+        'mirrors': args.mirror,
+        'mirror_queue_max_bytes': args.mirror_queue_max_bytes,
+        'mirror_queue_policy': args.mirror_queue_policy,
+        'spool_dir': args.spool_dir,
+        'spool_segment_size': args.spool_segment_size,
+        'spool_max_size': args.spool_max_size,
+        'spool_replay_rate': args.spool_replay_rate,
+    }
+
+    authz_parameters = {
+        'auth_cache_size': args.auth_cache_size,
+        'auth_cache_ttl': args.auth_cache_ttl,
+        'auth_cache_negative_ttl': args.auth_cache_negative_ttl,
+        'auth_threads': args.auth_threads,
+        'rate_limit_lines': args.rate_limit_lines,
+        'rate_limit_bytes': args.rate_limit_bytes,
+        'rate_limit_burst': args.rate_limit_burst,
+        'rate_limit_policy': args.rate_limit_policy,
+        'rate_limit_per_address': args.rate_limit_per_address,
+        'rate_limit_overrides': args.rate_limit_overrides,
+    }
+
     if backend == 'forwarding':
-        backend_parameters = {'host': args.opentsdb_host, 'port': args.opentsdb_port}
-    elif backend in ('django_authz', 'mock_django_authz',):
-        backend_parameters = {
+        backend_parameters = forwarding_parameters
+    elif backend == 'django_authz':
+        backend_parameters = dict(forwarding_parameters, **authz_parameters)
+        backend_parameters.update({
+            'django_project_path': args.django_project_path,
+            'django_settings_module': args.django_settings_module
+        })
+    elif backend == 'file_authz':
+        backend_parameters = dict(forwarding_parameters, **authz_parameters)
+        backend_parameters.update({
+            'credential_file': args.credential_file,
+            'credential_reload_interval': args.credential_reload_interval
+        })
+    elif backend == 'mock_file_authz':
+        backend_parameters = dict(authz_parameters, **{
+            'host': args.opentsdb_host, 'port': args.opentsdb_port,
+            'credential_file': args.credential_file,
+            'credential_reload_interval': args.credential_reload_interval
+        })
+    elif backend == 'mock_django_authz':
+        backend_parameters = dict(authz_parameters, **{
             'host': args.opentsdb_host, 'port': args.opentsdb_port,
             'django_project_path': args.django_project_path,
             'django_settings_module': args.django_settings_module
-        }
+        })
     ssl_cert_path = os.path.abspath(os.path.expanduser(args.ssl_cert))
     ssl_key_path = os.path.abspath(os.path.expanduser(args.ssl_key))
 
-    try:
+    ssl_context = None
+
+    def run_proxy(worker=None):
+        stats_port = args.stats_port
+        if stats_port is not None and worker is not None:
+            stats_port += worker
         opentsdbproxy.OpenTSDBProxy(backend=backend, backend_parameters=backend_parameters,
-            ssl_cert_path=ssl_cert_path, ssl_key_path=ssl_key_path, port=args.port)
+            ssl_cert_path=ssl_cert_path, ssl_key_path=ssl_key_path, port=args.port,
+            max_line_length=args.max_line_length, reuse_port=worker is not None,
+            stats_port=stats_port, ssl_ciphers=args.ssl_ciphers, ssl_ecdh_curve=args.ssl_ecdh_curve,
+            ssl_session_tickets=args.ssl_session_tickets, plaintext_port=args.plaintext_port,
+            compression=args.compression, max_compression_ratio=args.max_compression_ratio,
+            http_port=args.http_port, http_max_body=args.http_max_body,
+            backend_config=args.backend_config, drain_timeout=args.drain_timeout,
+            auth_sessions=args.auth_sessions, worker=worker, ssl_context=ssl_context)
+
+    try:
+        if args.workers > 1:
+            reuse_port_listener(args.port).close()  # Fail early if SO_REUSEPORT is unusable
+            # Made before forking, so every worker has the same session ticket keys
+            ssl_context = make_server_context(cert_path=ssl_cert_path, key_path=ssl_key_path,
+                ciphers=args.ssl_ciphers, ecdh_curve=args.ssl_ecdh_curve,
+                session_tickets=args.ssl_session_tickets)
+            WorkerSupervisor(args.workers, run_proxy).run()
+        else:
+            run_proxy()
     except ConfigurationException as ce:
         print >>sys.stderr, "Configuration Error: %s" % str(ce)
@@ -0,0 +1,182 @@
+"""Loading and checking of local credential files
+
+A credential file is either htpasswd style, one 'username:hash' per line, or
+a JSON object mapping usernames to hashes. Supported hashes are:
+
+* {SHA}base64 - htpasswd -s
+* $apr1$salt$hash - htpasswd -m, the htpasswd default
+* pbkdf2_sha256$iterations$salt$hash - Django's default, so hashes can be
+  exported straight from an auth_user table
+* sha1$salt$hexdigest, sha256$salt$hexdigest, md5$salt$hexdigest - salted
+  digests of salt + password
+* anything else is handed to crypt(3), which covers $1$, $5$, $6$ and DES
+"""
+
+import os
+import hmac
+import json
+import base64
+import hashlib
+import logging
+
+try:
+    import crypt
+except ImportError:
+    crypt = None
+
+from opentsdbproxy.exceptions import ConfigurationException
+
+log = logging.getLogger(__name__)
+
+APR1_MAGIC = '$apr1$'
+ITOA64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+SALTED_DIGESTS = ('md5', 'sha1', 'sha256', 'sha512')
+
+
+def _to64(value, length):
+    encoded = ''
+    for _ in range(length):
+        encoded += ITOA64[value & 0x3f]
+        value >>= 6
+    return encoded
+
+
+def apr1(password, salt):
+    """The Apache variant of md5-crypt, as written by htpasswd -m
+    """
+    salt = salt[:8]
+    alternate = hashlib.md5(password + salt + password).digest()
+
+    ctx = password + APR1_MAGIC + salt
+    for length in range(len(password), 0, -16):
+        ctx += alternate[:min(16, length)]
+    i = len(password)
+    while i:
+        if i & 1:
+            ctx += '\0'
+        else:
+            ctx += password[0]
+        i >>= 1
+    final = hashlib.md5(ctx).digest()
+
+    for i in range(1000):
+        ctx = password if i & 1 else final
+        if i % 3:
+            ctx += salt
+        if i % 7:
+            ctx += password
+        ctx += final if i & 1 else password
+        final = hashlib.md5(ctx).digest()
+
+    f = [ord(c) for c in final]
+    encoded = ''.join([
+        _to64((f[0] << 16) | (f[6] << 8) | f[12], 4),
+        _to64((f[1] << 16) | (f[7] << 8) | f[13], 4),
+        _to64((f[2] << 16) | (f[8] << 8) | f[14], 4),
+        _to64((f[3] << 16) | (f[9] << 8) | f[15], 4),
+        _to64((f[4] << 16) | (f[10] << 8) | f[5], 4),
+        _to64(f[11], 2),
+    ])
+    return "%s%s$%s" % (APR1_MAGIC, salt, encoded)
+
+
+def verify_password(password, encoded):
+    """verify_password
+
+    @param password - plaintext password to check
+    @param encoded - hash from a credential file
+
+    @returns - True if the password matches the hash
+    """
+    if encoded.startswith('{SHA}'):
+        candidate = '{SHA}' + base64.b64encode(hashlib.sha1(password).digest())
+    elif encoded.startswith(APR1_MAGIC):
+        salt = encoded[len(APR1_MAGIC):].split('$', 1)[0]
+        candidate = apr1(password, salt)
+    elif encoded.startswith('pbkdf2_'):
+        try:
+            algorithm, iterations, salt, _ = encoded.split('$', 3)
+            digest = algorithm[len('pbkdf2_'):]
+            derived = hashlib.pbkdf2_hmac(digest, password, salt, int(iterations))
+        except ValueError:
+            return False
+        candidate = "%s$%s$%s$%s" % (algorithm, iterations, salt, base64.b64encode(derived))
+    elif encoded.split('$', 1)[0] in SALTED_DIGESTS:
+        try:
+            algorithm, salt, _ = encoded.split('$', 2)
+        except ValueError:
+            return False
+        digest = hashlib.new(algorithm, salt + password).hexdigest()
+        candidate = "%s$%s$%s" % (algorithm, salt, digest)
+    elif crypt is not None:
+        candidate = crypt.crypt(password, encoded)
+    else:
+        return False
+
+    return candidate is not None and hmac.compare_digest(candidate, encoded)
+
+
+def parse_credentials(content):
+    """parse_credentials
+
+    @param content - the contents of a credential file
+
+    @returns - dict of username to hash
+    """
+    if content.lstrip().startswith('{'):
+        users = json.loads(content)
+        if not isinstance(users, dict):
+            raise ValueError("JSON credentials must be an object of username to hash")
+        return dict((str(user), str(encoded)) for user, encoded in users.items())
+
+    users = {}
+    for number, line in enumerate(content.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        user, separator, encoded = line.partition(':')
+        if not separator or not user or not encoded:
+            raise ValueError("Line %d isn't 'username:hash'" % number)
+        users[user] = encoded
+    return users
+
+
+class CredentialFile(object):
+    """An in memory index of a credential file
+
+    reload() parses the whole file before swapping it in, so a file that
+    can't be parsed leaves the previous credentials in place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.users = {}
+        self._signature = None
+        try:
+            self.reload()
+        except (IOError, OSError, ValueError) as e:
+            raise ConfigurationException("Couldn't load credentials from '%s': %s" % (path, e))
+
+    def _stat_signature(self):
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def changed(self):
+        try:
+            return self._stat_signature() != self._signature
+        except OSError:
+            return False
+
+    def reload(self):
+        signature = self._stat_signature()
+        with open(self.path) as credential_file:
+            users = parse_credentials(credential_file.read())
+        self.users = users
+        self._signature = signature
+        log.info("Loaded %d users from '%s'" % (len(users), self.path))
+
+    def check(self, username, password):
+        encoded = self.users.get(username)
+        if encoded is None:
+            return False
+        return verify_password(password, encoded)
@@ -7,3 +7,13 @@ class ConfigurationException(BaseException):
 class ProgrammingError(BaseException):
     """Programmer made an oopsie"""
     pass
+
+
+class SessionExpired(Exception):
+    """A connection's auth session lapsed, and its lines have no credentials"""
+    pass
+
+
+class UpstreamUnavailable(Exception):
+    """No OpenTSDB connection could take a write, and there is no spool"""
+    pass
@@ -0,0 +1,281 @@
+import time
+import zlib
+import logging
+
+from opentsdbproxy.stats import registry
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RECV_SIZE = 65536
+DEFAULT_MAX_LINE_LENGTH = 8192
+DEFAULT_MAX_COMPRESSION_RATIO = 250
+
+COMPRESS_COMMAND = 'compress '
+# zlib window bits for each algorithm a client can ask for
+ALGORITHMS = {
+    'zlib': zlib.MAX_WBITS,
+    'deflate': -zlib.MAX_WBITS,
+    'gzip': 16 + zlib.MAX_WBITS,
+}
+
+COMPRESSED_CONNECTIONS = registry.counter('compressed_connections_total',
+    "Connections that negotiated a compressed stream", ('algorithm',))
+COMPRESSED_BYTES = registry.counter('compressed_bytes_received_total',
+    "Compressed bytes received on compressed streams")
+DECOMPRESSED_BYTES = registry.counter('decompressed_bytes_total',
+    "Bytes produced by decompressing compressed streams")
+DECOMPRESS_SECONDS = registry.counter('decompress_cpu_seconds_total',
+    "CPU time spent decompressing compressed streams")
+DECOMPRESSION_FAILURES = registry.counter('decompression_failures_total',
+    "Compressed streams closed for corrupt data or exceeding the compression ratio limit")
+registry.gauge('compression_ratio', "Decompressed bytes per compressed byte received",
+    callback=lambda: float(DECOMPRESSED_BYTES.value) / COMPRESSED_BYTES.value
+    if COMPRESSED_BYTES.value else 0.0)
+
+
+class DecompressionError(Exception):
+    """A compressed stream was corrupt or decompressed to too much data"""
+    pass
+
+
+class LineReader(object):
+    """Reads newline framed messages from a socket
+
+    Data is received into a single preallocated bytearray with recv_into, so
+    a burst of data costs one copy per recv rather than a string concatenation.
+    Each call to read_lines returns every complete line that is available as a
+    single string, and keeps any partial line in the buffer until the rest of
+    it arrives.
+
+    max_line_length bounds the length of a line, and so how much of one is
+    buffered while waiting for its newline. A longer line is dropped, up to
+    and including its terminating newline, whether it arrives in one recv or
+    grows past the limit across several.
+
+    With compression, a client may make its first line 'compress zlib',
+    'compress deflate' or 'compress gzip', and everything it sends after
+    that newline is one compressed stream. The stream is inflated a recv at a
+    time into the same buffer, and no step produces more than recv_size
+    bytes, so memory stays bounded whatever the stream expands to. A stream
+    that is corrupt or expands to more than max_compression_ratio times its
+    compressed size raises DecompressionError.
+    """
+
+    def __init__(self, sock, recv_size=None, max_line_length=None, compression=False,
+            max_compression_ratio=None):
+        self.sock = sock
+        self.recv_size = recv_size or DEFAULT_RECV_SIZE
+        self.max_line_length = max_line_length or DEFAULT_MAX_LINE_LENGTH
+        self.max_compression_ratio = max_compression_ratio or DEFAULT_MAX_COMPRESSION_RATIO
+
+        # The partial tail is never longer than max_line_length, so there is
+        # always room for a full recv after it
+        self._buffer = bytearray(self.max_line_length + self.recv_size)
+        self._view = memoryview(self._buffer)
+        self._end = 0
+        self._discarding = False
+
+        self._negotiating = compression
+        self._decompressor = None
+        self._compressed = ''
+        self._finished = False
+
+        self.bytes_received = 0
+        self.dropped_lines = 0
+        self.algorithm = None
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+        self.decompress_seconds = 0.0
+
+    def read_lines(self):
+        """read_lines
+
+        Block until at least one complete line is available
+
+        @returns - a string of one or more complete lines, each terminated
+                   by a newline, or '' when the peer has closed the connection
+        """
+        while True:
+            if self._decompressor is not None:
+                received = self._inflate()
+            else:
+                received = self.sock.recv_into(self._view[self._end:], self.recv_size) or None
+                if received:
+                    self.bytes_received += received
+            if received is None:
+                if self._end:
+                    log.debug("Discarding %d bytes of incomplete line at EOF", self._end)
+                    self._end = 0
+                return ''
+
+            start = self._end
+            self._end += received
+
+            if self._negotiating:
+                if not self._negotiate():
+                    continue
+                start = 0
+
+            lines = self._frame(start)
+            if lines:
+                return lines
+
+    def _negotiate(self):
+        """Look for a compress command on the first line
+
+        @returns - False until the first line is complete or can't be one
+        """
+        buf = self._buffer
+        end = self._end
+        newline = buf.find('\n', 0, end)
+        if newline < 0:
+            length = min(end, len(COMPRESS_COMMAND))
+            if buf[:length] == COMPRESS_COMMAND[:length] and end <= self.max_line_length:
+                return False
+            self._negotiating = False
+            return True
+
+        self._negotiating = False
+        line = str(buf[:newline]).strip()
+        if not line.startswith(COMPRESS_COMMAND):
+            return True
+
+        algorithm = line[len(COMPRESS_COMMAND):].strip()
+        wbits = ALGORITHMS.get(algorithm)
+        if wbits is None:
+            DECOMPRESSION_FAILURES.inc()
+            raise DecompressionError("Unknown compression '%s', choose from %s" % (
+                algorithm, ', '.join(sorted(ALGORITHMS))))
+        COMPRESSED_CONNECTIONS.labels(algorithm).inc()
+        self.algorithm = algorithm
+        self._decompressor = zlib.decompressobj(wbits)
+        self._compressed = self._view[newline + 1:end].tobytes()
+        self._count_compressed(len(self._compressed))
+        self._end = 0
+        return True
+
+    def _count_compressed(self, size):
+        self.compressed_bytes += size
+        COMPRESSED_BYTES.inc(size)
+
+    def _inflate(self):
+        """Decompress up to recv_size bytes onto the end of the buffer
+
+        Input left over from the last step is used before receiving more.
+
+        @returns - the number of bytes added, which may be 0 if the
+                   decompressor needs more input, or None at EOF
+        """
+        if self._finished:
+            return None
+        data = self._compressed
+        if not data:
+            data = self.sock.recv(self.recv_size)
+            if not data:
+                return None
+            self.bytes_received += len(data)
+            self._count_compressed(len(data))
+
+        decompressor = self._decompressor
+        started = time.clock()
+        try:
+            inflated = decompressor.decompress(data, self.recv_size)
+        except zlib.error as e:
+            DECOMPRESSION_FAILURES.inc()
+            raise DecompressionError("Corrupt %s stream: %s" % (self.algorithm, e))
+        finally:
+            elapsed = time.clock() - started
+            self.decompress_seconds += elapsed
+            DECOMPRESS_SECONDS.inc(elapsed)
+        self._compressed = decompressor.unconsumed_tail
+        if decompressor.unused_data:
+            log.debug("Ignoring %d bytes after the end of the %s stream" % (
+                len(decompressor.unused_data), self.algorithm))
+            self._finished = True
+
+        size = len(inflated)
+        self.decompressed_bytes += size
+        DECOMPRESSED_BYTES.inc(size)
+        # Allow one recv's worth of slack so a short stream isn't held to the ratio
+        if self.decompressed_bytes > self.max_compression_ratio * self.compressed_bytes + self.recv_size:
+            DECOMPRESSION_FAILURES.inc()
+            raise DecompressionError("%s stream expanded more than %d times" % (
+                self.algorithm, self.max_compression_ratio))
+
+        self._buffer[self._end:self._end + size] = inflated
+        return size
+
+    @property
+    def compression_ratio(self):
+        if not self.compressed_bytes:
+            return None
+        return float(self.decompressed_bytes) / self.compressed_bytes
+
+    def _complete_lines(self, head, stop):
+        """Copy out the complete lines between head and stop, dropping any
+        longer than max_line_length
+
+        Rather than finding every newline, each step looks for one in the
+        next max_line_length bytes, so a recv of short lines is checked in a
+        few steps.
+
+        @returns - the lines that were kept, or None if there were none
+        """
+        buf = self._buffer
+        view = self._view
+        max_line_length = self.max_line_length
+        kept = []
+        kept_from = position = head
+        while position < stop:
+            newline = buf.rfind('\n', position, min(position + max_line_length + 1, stop))
+            if newline >= 0:
+                position = newline + 1
+                continue
+            # No newline within max_line_length of the line's start
+            newline = buf.find('\n', position, stop)
+            log.warning("Dropping line longer than %d bytes", max_line_length)
+            self.dropped_lines += 1
+            if position > kept_from:
+                kept.append(view[kept_from:position].tobytes())
+            kept_from = position = newline + 1
+        if stop > kept_from:
+            kept.append(view[kept_from:stop].tobytes())
+        return ''.join(kept) or None
+
+    def _frame(self, start):
+        """Split the complete lines off the front of the buffer
+
+        @param start - offset of the first byte added by the last recv
+
+        @returns - the complete lines, or None if there were none
+        """
+        buf = self._buffer
+        end = self._end
+        head = 0
+
+        if self._discarding:
+            newline = buf.find('\n', start, end)
+            if newline < 0:
+                self._end = 0
+                return None
+            self._discarding = False
+            self.dropped_lines += 1
+            head = newline + 1
+            start = head
+
+        lines = None
+        last_newline = buf.rfind('\n', start, end)
+        if last_newline >= 0:
+            lines = self._complete_lines(head, last_newline + 1)
+            head = last_newline + 1
+
+        tail_length = end - head
+        if tail_length > self.max_line_length:
+            log.warning("Dropping line longer than %d bytes", self.max_line_length)
+            self._discarding = True
+            tail_length = 0
+        elif tail_length and head:
+            buf[0:tail_length] = self._view[head:end].tobytes()
+        self._end = tail_length
+
+        return lines
@@ -0,0 +1,81 @@
+import struct
+import hashlib
+
+from bisect import bisect
+
+DEFAULT_VNODES = 160
+CACHE_SIZE = 65536
+
+POINT = struct.Struct('>Q')
+
+
+def hash_point(key):
+    return POINT.unpack_from(hashlib.md5(key).digest())[0]
+
+
+class HashRing(object):
+    """A consistent hash ring with virtual nodes
+
+    Each node is placed on the ring at vnodes points, and a key belongs to
+    the node at the first point after the key's hash. Adding or removing a
+    node only moves the keys between its points and their predecessors,
+    about 1/n of them, and the many points per node keep the share of keys
+    each node gets even.
+
+    Lookups are cached, since the same series arrive over and over.
+    """
+
+    def __init__(self, nodes=(), vnodes=None):
+        self.vnodes = vnodes or DEFAULT_VNODES
+        self.nodes = []
+        self._points = []
+        self._owners = []
+        self._cache = {}
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        self._build()
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        self._build()
+
+    def _build(self):
+        ring = []
+        for node in self.nodes:
+            for vnode in range(self.vnodes):
+                ring.append((hash_point("%s-%d" % (node, vnode)), node))
+        ring.sort()
+        self._points = [point for point, _ in ring]
+        self._owners = [node for _, node in ring]
+        self._cache = {}
+
+    def get(self, key):
+        """get
+
+        @param key - string to place on the ring
+
+        @returns - the node that owns key, or None if the ring is empty
+        """
+        node = self._cache.get(key)
+        if node is not None:
+            return node
+        if not self._points:
+            return None
+
+        index = bisect(self._points, hash_point(key)) % len(self._points)
+        node = self._owners[index]
+
+        if len(self._cache) >= CACHE_SIZE:
+            self._cache.clear()
+        self._cache[key] = node
+        return node
@@ -0,0 +1,303 @@
+"""An HTTPS /api/put endpoint that takes batches of JSON datapoints
+
+Each request is authenticated once, with HTTP basic auth against the
+backend's credentials, rather than per line with user and password tags.
+The datapoints become put lines tagged with the authenticated user, and go
+through the same rate limiting, stages and forwarding as telnet puts.
+"""
+
+import json
+import time
+import zlib
+import base64
+import logging
+import binascii
+
+from urlparse import parse_qs
+
+from gevent.pywsgi import WSGIServer
+
+from opentsdbproxy.backends import AuthzMixin
+from opentsdbproxy.exceptions import UpstreamUnavailable
+from opentsdbproxy.parser import parse
+from opentsdbproxy.stats import registry
+
+log = logging.getLogger(__name__)
+
+PUT_PATH = '/api/put'
+DEFAULT_MAX_BODY = 16 * 1024 * 1024
+REALM = 'opentsdbproxy'
+
+HTTP_REQUESTS = registry.counter('http_requests_total', "HTTP API requests by status code",
+    ('code',))
+HTTP_DATAPOINTS = registry.counter('http_datapoints_total',
+    "Datapoints accepted from the HTTP API")
+HTTP_DATAPOINTS_FAILED = registry.counter('http_datapoints_failed_total',
+    "Datapoints from the HTTP API that were invalid or rate limited")
+HTTP_REQUEST_SECONDS = registry.histogram('http_request_seconds',
+    "Time spent handling each HTTP API request")
+
+STATUS = {
+    204: '204 No Content',
+    400: '400 Bad Request',
+    401: '401 Unauthorized',
+    404: '404 Not Found',
+    405: '405 Method Not Allowed',
+    411: '411 Length Required',
+    413: '413 Request Entity Too Large',
+    415: '415 Unsupported Media Type',
+    429: '429 Too Many Requests',
+    500: '500 Internal Server Error',
+    503: '503 Service Unavailable',
+}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, code, message, headers=()):
+        Exception.__init__(self, message)
+        self.code = code
+        self.headers = list(headers)
+
+
+def _check_name(kind, name):
+    if not isinstance(name, basestring) or not name:
+        raise ValueError("%s must be a non-empty string" % kind)
+    if any(c.isspace() or c == '=' for c in name):
+        raise ValueError("%s '%s' contains whitespace or '='" % (kind, name))
+
+
+def datapoint_line(datapoint, user=None):
+    """datapoint_line
+
+    @param datapoint - dict with metric, timestamp, value and tags, as
+                       OpenTSDB's /api/put takes them
+    @param user - the authenticated user, which replaces any user tag
+
+    @returns - a newline terminated put line
+    """
+    if not isinstance(datapoint, dict):
+        raise ValueError("Datapoint must be an object")
+    metric = datapoint.get('metric')
+    _check_name("Metric", metric)
+
+    timestamp = datapoint.get('timestamp')
+    if isinstance(timestamp, bool) or not isinstance(timestamp, (int, long)) or timestamp < 0:
+        raise ValueError("Timestamp must be a positive integer")
+
+    value = datapoint.get('value')
+    if isinstance(value, bool):
+        raise ValueError("Value must be a number")
+    if isinstance(value, float):
+        value = repr(value)
+    elif isinstance(value, (int, long)):
+        value = str(value)
+    elif isinstance(value, basestring):
+        try:
+            float(value)
+        except ValueError:
+            raise ValueError("Value '%s' isn't a number" % value)
+    else:
+        raise ValueError("Value must be a number")
+
+    tags = datapoint.get('tags')
+    if not isinstance(tags, dict):
+        raise ValueError("Tags must be an object")
+    tags = dict(tags)
+    tags.pop('password', None)
+    if user is not None:
+        tags['user'] = user
+    if not tags:
+        raise ValueError("At least one tag is required")
+    pairs = []
+    for key, tag_value in sorted(tags.items()):
+        _check_name("Tag key", key)
+        if isinstance(tag_value, (int, long, float)) and not isinstance(tag_value, bool):
+            tag_value = str(tag_value)
+        _check_name("Tag value", tag_value)
+        pairs.append("%s=%s" % (key, tag_value))
+
+    line = "put %s %d %s %s\n" % (metric, timestamp, value, ' '.join(pairs))
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    return line
+
+
+class HTTPIngestServer(object):
+    """Serves POST /api/put over HTTPS, with keep-alive
+
+    A request's body is a JSON datapoint or a list of them, optionally gzip
+    encoded. Like OpenTSDB, a request where every datapoint is written gets
+    204, and otherwise a summary of how many succeeded and failed, with each
+    error listed when the query string has 'details'.
+
+    @param backend - the proxy's backend, which checks credentials if it
+                     authorizes
+    @param listener - (address, port) or a listening socket
+    @param ssl_context - the proxy's TLS context, None for plain HTTP
+    """
+
+    def __init__(self, backend, listener, ssl_context=None, spawn='default', max_body=None):
+        self.backend = backend
+        self.max_body = max_body or DEFAULT_MAX_BODY
+
+        ssl_args = {}
+        if ssl_context is not None:
+            ssl_args['ssl_context'] = ssl_context
+        self.server = WSGIServer(listener, self.application, spawn=spawn, log=None,
+            **ssl_args)
+        self._ssl_context = ssl_context
+
+    @property
+    def authorizing(self):
+        return isinstance(self.backend, AuthzMixin)
+
+    @property
+    def ssl_context(self):
+        return self._ssl_context
+
+    @ssl_context.setter
+    def ssl_context(self, ssl_context):
+        # New connections are wrapped with the new context, open ones keep theirs
+        self._ssl_context = ssl_context
+        self.server.wrap_socket = ssl_context.wrap_socket
+
+    def start(self):
+        self.server.start()
+        log.info("Serving %s on port %s" % (PUT_PATH, self.server.server_port))
+
+    def close(self):
+        """close
+
+        Stop accepting connections, leaving open ones be
+        """
+        self.server.close()
+
+    def stop(self):
+        self.server.stop()
+
+    def application(self, environ, start_response):
+        started = time.time()
+        headers = [('Content-Type', 'application/json')]
+        try:
+            code, body = self.handle_request(environ)
+        except HTTPError as e:
+            code = e.code
+            body = json.dumps({'error': {'code': e.code, 'message': str(e)}})
+            headers.extend(e.headers)
+        except UpstreamUnavailable as e:
+            log.warning("Failed to handle %s request: %s" % (PUT_PATH, e))
+            code = 503
+            body = json.dumps({'error': {'code': 503, 'message': str(e)}})
+        except Exception:
+            log.exception("Failed to handle %s request" % PUT_PATH)
+            code = 500
+            body = json.dumps({'error': {'code': 500, 'message': "Internal error"}})
+
+        HTTP_REQUESTS.labels(code).inc()
+        HTTP_REQUEST_SECONDS.observe(time.time() - started)
+        if body is None:
+            start_response(STATUS[code], [])
+            return []
+        headers.append(('Content-Length', str(len(body))))
+        start_response(STATUS[code], headers)
+        return [body]
+
+    def handle_request(self, environ):
+        """handle_request
+
+        @returns - (status code, JSON body or None)
+        """
+        if environ.get('PATH_INFO', '').rstrip('/') != PUT_PATH:
+            raise HTTPError(404, "Endpoint not found")
+        if environ['REQUEST_METHOD'] != 'POST':
+            raise HTTPError(405, "Method not allowed", [('Allow', 'POST')])
+
+        user = None
+        if self.authorizing:
+            user = self.authenticate(environ)
+
+        datapoints = self.read_datapoints(environ)
+        lines = []
+        errors = []
+        for datapoint in datapoints:
+            try:
+                lines.append(datapoint_line(datapoint, user))
+            except ValueError as e:
+                errors.append({'datapoint': datapoint, 'error': e.args[0]})
+
+        records = parse(''.join(lines))
+        address = (environ.get('REMOTE_ADDR'), environ.get('REMOTE_PORT'))
+        if self.authorizing:
+            records = self.backend.admit_records(records, address)
+        throttled = len(lines) - len(records)
+        if records:
+            self.backend.ingest(records, address)
+
+        HTTP_DATAPOINTS.inc(len(records))
+        failed = len(errors) + throttled
+        if not failed:
+            return 204, None
+        HTTP_DATAPOINTS_FAILED.inc(failed)
+
+        summary = {'success': len(records), 'failed': failed}
+        if 'details' in parse_qs(environ.get('QUERY_STRING', ''), keep_blank_values=True):
+            if throttled:
+                errors.append({'datapoint': None,
+                    'error': "%d datapoints over the rate limit" % throttled})
+            summary['errors'] = errors
+        return 429 if throttled else 400, json.dumps(summary)
+
+    def authenticate(self, environ):
+        """authenticate
+
+        @returns - the username from good basic auth credentials
+        """
+        challenge = [('WWW-Authenticate', 'Basic realm="%s"' % REALM)]
+        scheme, _, encoded = environ.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if scheme.lower() != 'basic':
+            raise HTTPError(401, "Basic authentication required", challenge)
+        try:
+            user, _, password = base64.b64decode(encoded.strip()).partition(':')
+        except (TypeError, binascii.Error):
+            raise HTTPError(401, "Malformed basic authentication", challenge)
+        if not user or not self.backend.is_authenticated(user, password):
+            raise HTTPError(401, "Bad username or password", challenge)
+        return user
+
+    def read_datapoints(self, environ):
+        """read_datapoints
+
+        @returns - list of datapoint dicts from the request body
+        """
+        length = environ.get('CONTENT_LENGTH')
+        if length and int(length) > self.max_body:
+            raise HTTPError(413, "Request body is over %d bytes" % self.max_body)
+        if not length and environ.get('HTTP_TRANSFER_ENCODING', '').lower() != 'chunked':
+            raise HTTPError(411, "Content-Length required")
+        body = environ['wsgi.input'].read(self.max_body + 1)
+        if len(body) > self.max_body:
+            raise HTTPError(413, "Request body is over %d bytes" % self.max_body)
+
+        encoding = environ.get('HTTP_CONTENT_ENCODING', 'identity').lower()
+        if encoding == 'gzip':
+            # Bounded, so a small body can't inflate to more than max_body
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                body = decompressor.decompress(body, self.max_body + 1)
+            except zlib.error as e:
+                raise HTTPError(400, "Corrupt gzip body: %s" % e)
+            if len(body) > self.max_body:
+                raise HTTPError(413, "Decompressed body is over %d bytes" % self.max_body)
+        elif encoding != 'identity':
+            raise HTTPError(415, "Unsupported Content-Encoding '%s'" % encoding)
+
+        try:
+            datapoints = json.loads(body)
+        except ValueError as e:
+            raise HTTPError(400, "Body isn't JSON: %s" % e)
+        if isinstance(datapoints, dict):
+            datapoints = [datapoints]
+        if not isinstance(datapoints, list):
+            raise HTTPError(400, "Body must be a datapoint or a list of datapoints")
+        return datapoints
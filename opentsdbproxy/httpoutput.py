@@ -0,0 +1,360 @@
+"""Writes puts to OpenTSDB 2.x as JSON batches POSTed to /api/put
+
+Unlike the telnet protocol, the HTTP API says how many points of each batch
+were stored, and why the rest weren't.
+"""
+
+import json
+import time
+import httplib
+import logging
+
+import gevent
+
+from gevent import socket
+
+from opentsdbproxy.ingestqueue import IngestQueue
+from opentsdbproxy.parser import parse
+from opentsdbproxy.stats import registry
+from opentsdbproxy.upstream import PUT_ERRORS, BYTES_FORWARDED, PROBE_FAILURES, DRAIN_TIMEOUT, \
+    DEFAULT_POOL_SIZE, RECONNECT_INTERVAL, PROBE_TIMEOUT, CircuitBreaker
+
+log = logging.getLogger(__name__)
+
+PUT_PATH = '/api/put?details'
+VERSION_PATH = '/api/version'
+REQUEST_TIMEOUT = 10
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_LINGER_MS = 50
+
+HTTP_OUTPUT_REQUESTS = registry.counter('http_output_requests_total',
+    "Batches POSTed to OpenTSDB's /api/put by status code", ('code',))
+HTTP_OUTPUT_POINTS = registry.counter('http_output_points_total',
+    "Datapoints OpenTSDB stored from /api/put batches")
+HTTP_OUTPUT_FAILED_POINTS = registry.counter('http_output_failed_points_total',
+    "Datapoints OpenTSDB rejected from /api/put batches, or that couldn't be converted")
+HTTP_OUTPUT_REQUEST_SECONDS = registry.histogram('http_output_request_seconds',
+    "Time each /api/put batch took, from sending to reading the response")
+
+
+def put_datapoints(data):
+    """put_datapoints
+
+    @param data - newline terminated put lines
+
+    @returns - (list of /api/put datapoints, number of lines that weren't puts
+               or couldn't be converted)
+    """
+    datapoints = []
+    invalid = 0
+    for record in parse(data):
+        if record.metric is None:
+            invalid += 1
+            continue
+        value = record.value
+        try:
+            if '.' in value or 'e' in value or 'E' in value:
+                value = float(value)
+            else:
+                value = int(value)
+            timestamp = int(record.timestamp)
+        except ValueError:
+            invalid += 1
+            continue
+        datapoints.append({'metric': record.metric, 'timestamp': timestamp,
+            'value': value, 'tags': record.tags})
+    return datapoints, invalid
+
+
+class _Connection(httplib.HTTPConnection, object):
+    """An HTTP/1.1 keep-alive connection over a cooperative socket"""
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+
+class HTTPUpstream(object):
+    """Sends puts to one TSD as batched JSON POSTs to /api/put
+
+    Puts are queued, and each of size sender greenlets takes up to
+    batch_size lines at a time, waiting up to linger_ms for a batch to fill,
+    and POSTs them over its own keep-alive connection. So at most size
+    requests are in flight. The details in each response are used to count
+    the points OpenTSDB rejected.
+
+    It stands in for an UpstreamPool, where checkout returns the
+    HTTPUpstream itself, or None while its CircuitBreaker is open. A batch
+    that couldn't be sent is handed to on_failure if it is given, and is
+    otherwise retried with the circuit's backoff until the TSD answers.
+
+    While the circuit is open, every probe_interval seconds the trial the
+    circuit allows is a GET of /api/version, so the circuit closes and the
+    spool is replayed once the TSD is back, even if no puts arrive.
+    """
+
+    def __init__(self, host, port, size=None, batch_size=None, linger_ms=None,
+            request_timeout=None, on_failure=None, queue_max_bytes=None, queue_policy=None,
+            circuit_backoff=None, circuit_max_backoff=None, probe_interval=None,
+            probe_timeout=None):
+        self.host = host
+        self.port = port
+        self.size = size or DEFAULT_POOL_SIZE
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        if linger_ms is None:
+            linger_ms = DEFAULT_LINGER_MS
+        self.linger = linger_ms / 1000.0
+        self.request_timeout = request_timeout or REQUEST_TIMEOUT
+        self.probe_interval = probe_interval or RECONNECT_INTERVAL
+        self.probe_timeout = probe_timeout or PROBE_TIMEOUT
+        self.on_failure = on_failure
+        self.breaker = CircuitBreaker("%s:%s" % (host, port), backoff=circuit_backoff,
+            max_backoff=circuit_max_backoff)
+
+        self.queue = IngestQueue(queue_max_bytes, queue_policy)
+        self.connections = [_Connection(host, port, timeout=self.request_timeout)
+            for _ in range(self.size)]
+        self._senders = []
+        self._prober = None
+        self._in_flight = 0
+
+        self.put_errors = 0
+        self.batches = 0
+
+    def __repr__(self):
+        return "<%s %s:%s x%d>" % (self.__class__.__name__, self.host, self.port, self.size)
+
+    @property
+    def healthy(self):
+        return self.breaker.closed
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queued_bytes(self):
+        return self.queue.bytes
+
+    @property
+    def dropped_bytes(self):
+        return self.queue.dropped_bytes
+
+    @property
+    def dropped_items(self):
+        return self.queue.dropped_items
+
+    def start(self):
+        if self._senders:
+            return
+        self._senders = [gevent.spawn(self._send_loop, connection)
+            for connection in self.connections]
+        self._prober = gevent.spawn(self._probe_loop)
+
+    def close(self, timeout=DRAIN_TIMEOUT):
+        """close
+
+        Give queued puts up to timeout seconds to reach OpenTSDB, then
+        close every connection
+        """
+        deadline = time.time() + (timeout or 0)
+        while self._senders and (self._in_flight or not self.queue.empty()) and \
+                time.time() < deadline:
+            gevent.sleep(0.01)
+        if self._in_flight or not self.queue.empty():
+            log.warning("Closing %s with puts still queued" % self)
+        if self._prober is not None:
+            self._prober.kill(block=False)
+            self._prober = None
+        for sender in self._senders:
+            sender.kill(block=False)
+        self._senders = []
+        for connection in self.connections:
+            connection.close()
+
+    def checkout(self):
+        """checkout
+
+        @returns - this HTTPUpstream, or None while the TSD is failing and
+                   it isn't yet time to try it again
+        """
+        self.start()
+        if not self.breaker.allow():
+            return None
+        return self
+
+    def send(self, data):
+        """send
+
+        Queue put lines to be POSTed to OpenTSDB
+
+        @param data - one or more newline terminated put lines
+
+        @returns - False if the queue was full and data was dropped
+        """
+        return self.queue.put(data)
+
+    def request(self, data, timeout=None):
+        """request
+
+        Answer a telnet request over HTTP. Only version is supported.
+
+        @returns - the reply, or None
+        """
+        if data.strip() != 'version':
+            log.debug("Can't send '%s' to OpenTSDB over HTTP" % data.strip())
+            return None
+        version = self._get_version(timeout or self.request_timeout)
+        if version is None:
+            return None
+        return "net.opentsdb %s built at revision %s\n" % (
+            version.get('version', ''), version.get('short_revision', ''))
+
+    def probe(self):
+        """probe
+
+        While the circuit is open and allows a trial, ask the TSD for its
+        version, closing the circuit if it answers
+
+        @returns - True if the circuit is closed afterwards
+        """
+        if self.breaker.closed or not self.breaker.allow():
+            return self.breaker.closed
+        if self._get_version(self.probe_timeout) is None:
+            PROBE_FAILURES.labels(self.breaker.name).inc()
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return self.breaker.closed
+
+    def _get_version(self, timeout):
+        """GET /api/version over a connection of its own
+
+        @returns - the decoded version object, or None if the TSD didn't answer
+        """
+        connection = _Connection(self.host, self.port, timeout=timeout)
+        try:
+            connection.request('GET', VERSION_PATH)
+            response = connection.getresponse()
+            if response.status != 200:
+                raise httplib.HTTPException("%d response" % response.status)
+            return json.loads(response.read())
+        except (socket.error, httplib.HTTPException, ValueError) as e:
+            log.warning("Couldn't get the version of OpenTSDB %s:%s: %s" % (self.host, self.port, e))
+            return None
+        finally:
+            connection.close()
+
+    def _probe_loop(self):
+        while True:
+            gevent.sleep(self.probe_interval)
+            try:
+                self.probe()
+            except Exception:
+                log.exception("Failed probing %s" % self)
+
+    def _next_batch(self):
+        """Wait for puts, then take up to batch_size lines, lingering for more
+
+        @returns - newline terminated put lines
+        """
+        chunks = [self.queue.get()]
+        lines = chunks[0].count('\n')
+        deadline = time.time() + self.linger
+        while lines < self.batch_size:
+            data = self.queue.get(timeout=max(0, deadline - time.time()))
+            if data is None:
+                break
+            chunks.append(data)
+            lines += data.count('\n')
+        return ''.join(chunks)
+
+    def _send_loop(self, connection):
+        while True:
+            data = self._next_batch()
+            self._in_flight += 1
+            try:
+                while not self._post(connection, data):
+                    if self.on_failure is not None:
+                        self._fail(data)
+                        break
+                    gevent.sleep(self.breaker.current_backoff)
+            finally:
+                self._in_flight -= 1
+
+    def _post(self, connection, data):
+        """POST put lines as one batch
+
+        @returns - False if the batch should be tried again later
+        """
+        datapoints, invalid = put_datapoints(data)
+        if invalid:
+            self._rejected(invalid)
+            log.warning("Couldn't convert %d lines for OpenTSDB %s:%s" % (invalid, self.host, self.port))
+        if not datapoints:
+            return True
+
+        body = json.dumps(datapoints)
+        started = time.time()
+        while True:
+            reused = connection.connected
+            try:
+                connection.request('POST', PUT_PATH, body, {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                content = response.read()
+                break
+            except (socket.error, httplib.HTTPException) as e:
+                connection.close()
+                if reused:
+                    # The TSD closed the idle keep-alive connection, try a new one
+                    continue
+                log.warning("Failed POSTing %d points to OpenTSDB %s:%s: %s" % (
+                    len(datapoints), self.host, self.port, e))
+                self.breaker.failure()
+                return False
+        HTTP_OUTPUT_REQUEST_SECONDS.observe(time.time() - started)
+        HTTP_OUTPUT_REQUESTS.labels(response.status).inc()
+        BYTES_FORWARDED.inc(len(body))
+        self.batches += 1
+
+        if response.status >= 500:
+            log.warning("OpenTSDB %s:%s answered %d to %d points" % (
+                self.host, self.port, response.status, len(datapoints)))
+            self.breaker.failure()
+            return False
+        self.breaker.success()
+
+        try:
+            details = json.loads(content) if content else {}
+        except ValueError:
+            details = {}
+        if response.status >= 400 and 'failed' not in details:
+            # Not a details response, for instance a body that was too large
+            log.warning("OpenTSDB %s:%s rejected %d points with %d: %s" % (
+                self.host, self.port, len(datapoints), response.status, content[:200]))
+            self._rejected(len(datapoints))
+            return True
+
+        failed = details.get('failed', 0)
+        HTTP_OUTPUT_POINTS.inc(details.get('success', len(datapoints) - failed))
+        if failed:
+            self._rejected(failed)
+            errors = details.get('errors') or [{}]
+            log.warning("OpenTSDB %s:%s rejected %d of %d points, for instance: %s" % (
+                self.host, self.port, failed, len(datapoints), errors[0].get('error')))
+        return True
+
+    def _rejected(self, count):
+        self.put_errors += count
+        PUT_ERRORS.inc(count)
+        HTTP_OUTPUT_FAILED_POINTS.inc(count)
+
+    def _fail(self, data):
+        try:
+            self.on_failure(data)
+        except Exception:
+            log.exception("Lost %d bytes for OpenTSDB %s:%s" % (len(data), self.host, self.port))
@@ -0,0 +1,130 @@
+import time
+import logging
+
+from collections import deque
+
+from gevent.event import Event
+
+from opentsdbproxy.exceptions import ConfigurationException
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+BLOCK = 'block'
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST)
+
+
+class IngestQueue(object):
+    """A FIFO queue of strings bounded by their total size in bytes
+
+    When a put would take the queue past max_bytes, the policy decides what
+    happens: 'block' makes the putting greenlet wait for room, which stops it
+    reading from its client and pushes back over TCP, 'drop_newest' discards
+    the new item, and 'drop_oldest' discards items from the head of the queue
+    until the new one fits. An item bigger than max_bytes is still accepted
+    into an empty queue, so it can't wedge a blocking queue forever.
+
+    The time each item was queued is kept, so consumers can tell how far
+    behind they are.
+    """
+
+    def __init__(self, max_bytes=None, policy=None):
+        self.max_bytes = max_bytes or DEFAULT_MAX_BYTES
+        self.policy = policy or BLOCK
+        if self.policy not in POLICIES:
+            raise ConfigurationException("Unknown queue policy '%s', choose from %s" % (
+                self.policy, ', '.join(POLICIES)))
+
+        self._items = deque()
+        self._queued_at = deque()
+        self._not_empty = Event()
+        self._not_full = Event()
+        self.bytes = 0
+        # When the item most recently taken by get was queued
+        self.last_queued_at = None
+
+        self.blocked_puts = 0
+        self.dropped_items = 0
+        self.dropped_bytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    def _full(self, size):
+        return self._items and self.bytes + size > self.max_bytes
+
+    def put(self, data):
+        """put
+
+        @param data - string to queue
+
+        @returns - True if data was queued, False if it was dropped
+        """
+        size = len(data)
+        if self._full(size):
+            if self.policy == DROP_NEWEST:
+                self._dropped(size)
+                return False
+            elif self.policy == DROP_OLDEST:
+                while self._full(size):
+                    dropped = self._items.popleft()
+                    self._queued_at.popleft()
+                    self.bytes -= len(dropped)
+                    self._dropped(len(dropped))
+            else:
+                self.blocked_puts += 1
+                while self._full(size):
+                    self._not_full.clear()
+                    self._not_full.wait()
+
+        self._items.append(data)
+        self._queued_at.append(time.time())
+        self.bytes += size
+        self._not_empty.set()
+        return True
+
+    def get(self, timeout=None):
+        """get
+
+        Wait for and remove the item at the head of the queue
+
+        @param timeout - seconds to wait, forever if None
+
+        @returns - the item, or None if the queue stayed empty for timeout
+        """
+        while not self._items:
+            self._not_empty.clear()
+            if not self._not_empty.wait(timeout) and timeout is not None:
+                return None
+
+        data = self._items.popleft()
+        self.last_queued_at = self._queued_at.popleft()
+        self.bytes -= len(data)
+        self._not_full.set()
+        return data
+
+    def age(self):
+        """age
+
+        @returns - seconds the item at the head of the queue has waited, 0
+                   if the queue is empty
+        """
+        if not self._queued_at:
+            return 0
+        return time.time() - self._queued_at[0]
+
+    def _dropped(self, size):
+        self.dropped_items += 1
+        self.dropped_bytes += size
+        if self.dropped_items == 1 or self.dropped_items % 1000 == 0:
+            log.warning("Queue is over %d bytes, %d items dropped so far" % (
+                self.max_bytes, self.dropped_items))
@@ -0,0 +1,286 @@
+"""Copies the puts forwarded to OpenTSDB to secondary sinks
+
+A mirror is another TSD, such as a staging cluster or a migration target, or
+a local file. Each sink has its own bounded queue and writer greenlet, and
+its queue drops rather than blocks when full, so a slow or unreachable
+mirror loses its own copy of the data but never holds up the primary.
+"""
+
+import time
+import logging
+
+from urlparse import urlsplit, parse_qs
+
+import gevent
+
+from gevent import socket
+
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.ingestqueue import IngestQueue, DROP_NEWEST, DROP_OLDEST
+from opentsdbproxy.stats import registry
+
+log = logging.getLogger(__name__)
+
+POLICIES = (DROP_NEWEST, DROP_OLDEST)
+DEFAULT_POLICY = DROP_OLDEST
+DEFAULT_TSD_PORT = 4242
+
+CONNECT_TIMEOUT = 1
+RECV_SIZE = 4096
+MAX_WRITE_BYTES = 1024 * 1024
+BACKOFF = 1
+MAX_BACKOFF = 30
+
+MIRROR_QUEUED_BYTES = registry.gauge('mirror_queued_bytes',
+    "Bytes queued for each mirror", ('sink',))
+MIRROR_LAG_SECONDS = registry.gauge('mirror_lag_seconds',
+    "How long the oldest put not yet written to each mirror has waited", ('sink',))
+MIRROR_WRITTEN_BYTES = registry.counter('mirror_written_bytes_total',
+    "Bytes written to each mirror", ('sink',))
+MIRROR_DROPPED_BYTES = registry.counter('mirror_dropped_bytes_total',
+    "Bytes dropped because a mirror's queue was full", ('sink',))
+MIRROR_WRITE_FAILURES = registry.counter('mirror_write_failures_total',
+    "Failed writes to each mirror, which are retried with a backoff", ('sink',))
+MIRROR_PUT_ERRORS = registry.counter('mirror_put_errors_total',
+    "Puts rejected by each mirror TSD", ('sink',))
+
+
+class MirrorSink(object):
+    """Writes queued puts to one mirror from its own greenlet
+
+    A write that fails is retried, backing off from BACKOFF up to
+    MAX_BACKOFF seconds, while new puts are queued or dropped.
+
+    @param name - the sink's spec, used as its metrics label
+    @param queue_max_bytes - most bytes to queue for the mirror
+    @param queue_policy - drop_oldest or drop_newest when the queue is full
+    """
+
+    def __init__(self, name, queue_max_bytes=None, queue_policy=None):
+        self.name = name
+        queue_policy = queue_policy or DEFAULT_POLICY
+        if queue_policy not in POLICIES:
+            raise ConfigurationException("Mirror '%s' can't use queue policy '%s', choose from %s" % (
+                name, queue_policy, ', '.join(POLICIES)))
+        self.queue = IngestQueue(queue_max_bytes, queue_policy)
+
+        self.written_bytes = 0
+        self.write_failures = 0
+        self.put_errors = 0
+        self._writer = None
+        self._writing_since = None
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.name)
+
+    @property
+    def lag(self):
+        """Seconds the oldest put not yet written has waited"""
+        if self._writing_since is not None:
+            return time.time() - self._writing_since
+        return self.queue.age()
+
+    def register_stats(self):
+        for metric, callback in (
+                (MIRROR_QUEUED_BYTES, lambda: self.queue.bytes),
+                (MIRROR_LAG_SECONDS, lambda: self.lag),
+                (MIRROR_WRITTEN_BYTES, lambda: self.written_bytes),
+                (MIRROR_DROPPED_BYTES, lambda: self.queue.dropped_bytes),
+                (MIRROR_WRITE_FAILURES, lambda: self.write_failures),
+                (MIRROR_PUT_ERRORS, lambda: self.put_errors)):
+            metric.labels(self.name).callback = callback
+
+    def start(self):
+        if self._writer is None:
+            self._writer = gevent.spawn(self._write_loop)
+
+    def send(self, data):
+        """send
+
+        Queue puts for the mirror, never waiting
+
+        @param data - one or more newline terminated put lines
+
+        @returns - False if the queue was full and data was dropped
+        """
+        return self.queue.put(data)
+
+    def close(self, timeout=None):
+        """close
+
+        Give queued puts up to timeout seconds to reach the mirror, then
+        stop writing
+        """
+        deadline = time.time() + (timeout or 0)
+        while self._writer is not None and (self._writing_since is not None or
+                not self.queue.empty()) and time.time() < deadline:
+            gevent.sleep(0.01)
+        if self._writing_since is not None or not self.queue.empty():
+            log.warning("Closing mirror %s with %d bytes still queued" % (self.name, self.queue.bytes))
+        if self._writer is not None:
+            self._writer.kill(block=False)
+            self._writer = None
+        self.disconnect()
+
+    def write(self, data):
+        """write
+
+        @param data - newline terminated put lines
+
+        Raises socket.error, IOError or OSError if data wasn't written
+        """
+        raise NotImplementedError("Subclasses must implement write")
+
+    def disconnect(self):
+        pass
+
+    def _write_loop(self):
+        backoff = BACKOFF
+        while True:
+            data = self.queue.get()
+            self._writing_since = self.queue.last_queued_at
+            # Take whatever else is waiting, so a backlog is written in few writes
+            chunks = [data]
+            size = len(data)
+            while size < MAX_WRITE_BYTES and not self.queue.empty():
+                data = self.queue.get()
+                chunks.append(data)
+                size += len(data)
+            data = ''.join(chunks)
+
+            while True:
+                try:
+                    self.write(data)
+                    break
+                except (socket.error, IOError, OSError) as e:
+                    self.write_failures += 1
+                    log.warning("Failed writing %d bytes to mirror %s, retrying in %ss: %s" % (
+                        len(data), self.name, backoff, e))
+                    self.disconnect()
+                    gevent.sleep(backoff)
+                    backoff = min(backoff * 2, MAX_BACKOFF)
+            backoff = BACKOFF
+            self.written_bytes += len(data)
+            self._writing_since = None
+
+
+class TSDMirror(MirrorSink):
+    """Writes puts to a TSD over the telnet protocol"""
+
+    def __init__(self, name, host, port, queue_max_bytes=None, queue_policy=None):
+        MirrorSink.__init__(self, name, queue_max_bytes, queue_policy)
+        self.host = host
+        self.port = port
+        self.sock = None
+        self._reader = None
+
+    def write(self, data):
+        if self.sock is None:
+            sock = socket.create_connection((self.host, self.port), CONNECT_TIMEOUT)
+            sock.settimeout(None)
+            self.sock = sock
+            self._reader = gevent.spawn(self._read_loop, sock)
+            log.debug("Connected to mirror %s" % self.name)
+        self.sock.sendall(data)
+
+    def disconnect(self):
+        sock, self.sock = self.sock, None
+        if self._reader is not None and self._reader is not gevent.getcurrent():
+            self._reader.kill(block=False)
+        self._reader = None
+        if sock is not None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
+    def _read_loop(self, sock):
+        # A TSD only replies to report puts it rejected
+        partial = ''
+        try:
+            while True:
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    log.warning("Mirror %s closed the connection" % self.name)
+                    break
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                for line in lines:
+                    if line.startswith('put:'):
+                        self.put_errors += 1
+                        log.debug("Mirror %s rejected %s" % (self.name, line))
+        except socket.error as e:
+            log.warning("Error reading from mirror %s: %s" % (self.name, e))
+        if self.sock is sock:
+            self.sock = None
+            self._reader = None
+            sock.close()
+
+
+class FileMirror(MirrorSink):
+    """Appends puts to a local file, which is reopened after a reload so it
+    can be rotated
+
+    Disk writes block, so they are made in the hub's threadpool, leaving
+    the greenlets serving clients and the primary free to run while a slow
+    disk catches up.
+    """
+
+    def __init__(self, name, path, queue_max_bytes=None, queue_policy=None):
+        MirrorSink.__init__(self, name, queue_max_bytes, queue_policy)
+        self.path = path
+        self.file = None
+
+    def write(self, data):
+        gevent.get_hub().threadpool.apply(self._append, (data,))
+
+    def _append(self, data):
+        # Runs in a native thread
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(data)
+        self.file.flush()
+
+    def disconnect(self):
+        mirror_file, self.file = self.file, None
+        if mirror_file is not None:
+            try:
+                mirror_file.close()
+            except IOError:
+                pass
+
+
+def parse_mirror(spec, queue_max_bytes=None, queue_policy=None):
+    """parse_mirror
+
+    @param spec - tsd://host:port or file:///path, optionally followed by
+                  ?policy=drop_newest&max_bytes=n to override the defaults
+                  for this mirror
+    @param queue_max_bytes - default most bytes to queue for the mirror
+    @param queue_policy - default queue policy
+
+    @returns - a MirrorSink
+    """
+    url = urlsplit(spec)
+    name = spec.split('?')[0]
+    options = parse_qs(url.query)
+    queue_policy = options.get('policy', [queue_policy])[-1]
+    if 'max_bytes' in options:
+        try:
+            queue_max_bytes = int(options['max_bytes'][-1])
+        except ValueError:
+            raise ConfigurationException("Bad max_bytes for mirror '%s'" % name)
+
+    if url.scheme == 'tsd':
+        try:
+            port = url.port or DEFAULT_TSD_PORT
+        except ValueError:
+            raise ConfigurationException("Bad port for mirror '%s'" % name)
+        if not url.hostname:
+            raise ConfigurationException("Mirror '%s' needs a host" % name)
+        return TSDMirror(name, url.hostname, port, queue_max_bytes, queue_policy)
+    elif url.scheme == 'file':
+        if not url.path:
+            raise ConfigurationException("Mirror '%s' needs a path" % name)
+        return FileMirror(name, url.path, queue_max_bytes, queue_policy)
+    raise ConfigurationException("Unknown mirror '%s', use tsd://host:port or file:///path" % spec)
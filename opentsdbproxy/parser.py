@@ -0,0 +1,192 @@
+"""Parses tcollector messages into records, once per line
+
+A Record keeps offsets into the message it came from, so a line can be
+forwarded, or forwarded with its password removed, by slicing the original
+buffer rather than rebuilding it from tokens. Runs of consecutive lines that
+need no changes are emitted as a single slice.
+"""
+
+import re
+
+# The fields after 'put ', matched from just past the command
+PUT_FIELDS = re.compile(r' *(\S+) +(\S+) +(\S+)')
+
+USER_TAG = ' user='
+PASSWORD_TAG = ' password='
+
+
+class Record(object):
+    """One line of a tcollector message
+
+    Credential tags are found by their leading space, so a tag value that
+    merely contains 'password=' isn't mistaken for one, and removing the
+    tag with its space leaves the rest of the line well formed.
+
+    @param buffer - the message the line is in
+    @param start - offset of the line's first character
+    @param end - offset just past the line's last character, before any \\r\\n
+    @param newline - whether buffer[end] is the line's \\n
+    """
+
+    __slots__ = ('buffer', 'start', 'end', 'newline', 'is_put',
+        'metric', 'timestamp', 'value', 'tags_start',
+        'user', 'password', 'password_spans', '_tags')
+
+    def __init__(self, buffer, start, end, newline):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+        self.newline = newline
+        self._tags = None
+
+        self.is_put = buffer.startswith('put ', start, end)
+        match = PUT_FIELDS.match(buffer, start + 4, end) if self.is_put else None
+        if match is not None:
+            self.metric, self.timestamp, self.value = match.groups()
+            self.tags_start = match.end()
+        else:
+            self.metric = self.timestamp = self.value = None
+            self.tags_start = start
+
+        self.user = None
+        position = buffer.find(USER_TAG, start, end)
+        while position != -1:
+            value_start = position + len(USER_TAG)
+            value_end = buffer.find(' ', value_start, end)
+            if value_end == -1:
+                value_end = end
+            self.user = buffer[value_start:value_end]
+            position = buffer.find(USER_TAG, value_end, end)
+
+        self.password = None
+        self.password_spans = ()
+        position = buffer.find(PASSWORD_TAG, start, end)
+        while position != -1:
+            value_start = position + len(PASSWORD_TAG)
+            value_end = buffer.find(' ', value_start, end)
+            if value_end == -1:
+                value_end = end
+            self.password = buffer[value_start:value_end]
+            self.password_spans += ((position, value_end),)
+            position = buffer.find(PASSWORD_TAG, value_end, end)
+
+    @property
+    def command(self):
+        command_end = self.buffer.find(' ', self.start, self.end)
+        return self.buffer[self.start:self.end if command_end == -1 else command_end]
+
+    @property
+    def line(self):
+        """The line as received, without its newline"""
+        return self.buffer[self.start:self.end]
+
+    @property
+    def tags(self):
+        """Dict of the line's tags, other than password, parsed on first use"""
+        if self._tags is None:
+            tags = {}
+            for tag in self.buffer[self.tags_start:self.end].split():
+                key, _, value = tag.partition('=')
+                if key != 'password':
+                    tags[key] = value
+            self._tags = tags
+        return self._tags
+
+    @property
+    def series(self):
+        """The metric and its sorted tags, other than password, naming the time series"""
+        tags = [tag for tag in self.buffer[self.tags_start:self.end].split()
+            if not tag.startswith('password=')]
+        tags.sort()
+        return "%s %s" % (self.metric, ' '.join(tags))
+
+    def spans(self):
+        """spans
+
+        @returns - list of (start, end) slices of buffer that make up the line
+                   with its passwords removed, including the newline if the
+                   buffer has one
+        """
+        spans = []
+        position = self.start
+        for start, end in self.password_spans:
+            spans.append((position, start))
+            position = end
+        spans.append((position, self.end + 1 if self.newline else self.end))
+        return spans
+
+    def sanitized(self):
+        """The line with its passwords removed, newline terminated"""
+        return sanitize([self])
+
+
+def parse(buffer):
+    """parse
+
+    @param buffer - one or more lines, the last may lack its newline
+
+    @returns - list of a Record for each line that isn't blank
+    """
+    records = []
+    position = 0
+    length = len(buffer)
+    while position < length:
+        newline = buffer.find('\n', position)
+        if newline == -1:
+            newline = length
+        start = position
+        end = newline
+        while end > start and buffer[end - 1] in ' \r':
+            end -= 1
+        while start < end and buffer[start] == ' ':
+            start += 1
+        if end > start:
+            records.append(Record(buffer, start, end, end == newline and newline < length))
+        position = newline + 1
+    return records
+
+
+def sanitize(records):
+    """sanitize
+
+    @param records - records to emit, in order
+
+    @returns - the records' lines with passwords removed, each newline
+               terminated, slicing each run of unchanged lines only once
+    """
+    pieces = []
+    buffer = None
+    run_start = run_end = None
+    for record in records:
+        for start, end in record.spans():
+            if record.buffer is buffer and start == run_end:
+                run_end = end
+                continue
+            if buffer is not None:
+                pieces.append(buffer[run_start:run_end])
+            buffer = record.buffer
+            run_start, run_end = start, end
+        if not record.newline:
+            pieces.append(buffer[run_start:run_end])
+            pieces.append('\n')
+            buffer = None
+    if buffer is not None:
+        pieces.append(buffer[run_start:run_end])
+    return ''.join(pieces)
+
+
+def tag_user(records, user):
+    """tag_user
+
+    @param records - records to emit, in order
+    @param user - the user to tag lines that have no user tag with
+
+    @returns - the records, with those lacking a user tag replaced by records
+               of their line with the user tag appended
+    """
+    untagged = [record.line for record in records if record.user is None]
+    if not untagged:
+        return records
+    suffix = "%s%s\n" % (USER_TAG, user)
+    tagged = iter(parse(suffix.join(untagged) + suffix))
+    return [next(tagged) if record.user is None else record for record in records]
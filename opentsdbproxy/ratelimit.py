@@ -0,0 +1,199 @@
+import json
+import time
+import logging
+
+import gevent
+
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.stats import registry
+
+log = logging.getLogger(__name__)
+
+DROP = 'drop'
+DELAY = 'delay'
+POLICIES = (DROP, DELAY)
+
+DEFAULT_BURST = 1
+MAX_BUCKETS = 10000
+
+THROTTLED_LINES = registry.counter('throttled_lines_total',
+    "Lines dropped or delayed by rate limiting", ('user',))
+THROTTLE_DELAY_SECONDS = registry.counter('throttle_delay_seconds_total',
+    "Time clients were held back by rate limiting", ('user',))
+
+
+class TokenBucket(object):
+    """Refills at rate tokens per second up to capacity"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = now if now is not None else time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self):
+        return self.tokens >= self.capacity
+
+
+def load_overrides(path):
+    """load_overrides
+
+    @param path - JSON object of username to {"lines": per second,
+                  "bytes": per second}, where 0 or null means unlimited
+
+    @returns - dict of username to (lines per second, bytes per second)
+    """
+    try:
+        with open(path) as overrides_file:
+            overrides = json.load(overrides_file)
+    except (IOError, ValueError) as e:
+        raise ConfigurationException("Couldn't load rate limit overrides '%s': %s" % (path, e))
+    if not isinstance(overrides, dict):
+        raise ConfigurationException("Rate limit overrides '%s' must be a JSON object" % path)
+
+    limits = {}
+    for user, limit in overrides.items():
+        if not isinstance(limit, dict):
+            raise ConfigurationException("Rate limit for '%s' must be an object" % user)
+        limits[user] = (limit.get('lines'), limit.get('bytes'))
+    return limits
+
+
+class RateLimiter(object):
+    """Token buckets of lines and bytes per second for each user
+
+    With per_address, each user gets separate buckets for every address
+    they connect from. Lines over the limit are dropped, or with the delay
+    policy the client's connection is held back until the buckets refill,
+    which slows that client alone. Buckets hold burst seconds of tokens.
+
+    @param lines_per_second - default line limit, None for unlimited
+    @param bytes_per_second - default byte limit, None for unlimited
+    @param overrides - dict of username to (lines per second, bytes per second)
+    """
+
+    def __init__(self, lines_per_second=None, bytes_per_second=None, burst=None,
+            policy=None, per_address=False, overrides=None):
+        self.lines_per_second = lines_per_second
+        self.bytes_per_second = bytes_per_second
+        self.burst = burst or DEFAULT_BURST
+        self.policy = policy or DROP
+        if self.policy not in POLICIES:
+            raise ConfigurationException("Unknown rate limit policy '%s', choose from %s" % (
+                self.policy, ', '.join(POLICIES)))
+        self.per_address = per_address
+        self.overrides = overrides or {}
+
+        self._buckets = {}
+
+    def limits(self, user):
+        return self.overrides.get(user, (self.lines_per_second, self.bytes_per_second))
+
+    def _buckets_for(self, user, address, now):
+        key = (user, address) if self.per_address else user
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                self._forget_idle()
+            line_rate, byte_rate = self.limits(user)
+            buckets = self._buckets[key] = (
+                TokenBucket(line_rate, line_rate * self.burst, now) if line_rate else None,
+                TokenBucket(byte_rate, byte_rate * self.burst, now) if byte_rate else None)
+        return buckets
+
+    def _forget_idle(self):
+        now = time.time()
+        for key, buckets in self._buckets.items():
+            for bucket in buckets:
+                if bucket is not None:
+                    bucket.refill(now)
+            if all(bucket is None or bucket.full for bucket in buckets):
+                del self._buckets[key]
+
+    def limit(self, records, address=None):
+        """limit
+
+        @param records - authorized parser.Records
+        @param address - the client's address, used with per_address
+
+        @returns - the records within each user's limits
+        """
+        if not records:
+            return records
+        if address is not None:
+            address = address[0]
+        now = time.time()
+
+        # Most messages come from one collector, so count in one pass and
+        # only go line by line when a limit is hit
+        usage = {}
+        for record in records:
+            counts = usage.get(record.user)
+            if counts is None:
+                usage[record.user] = [1, record.end - record.start + 1]
+            else:
+                counts[0] += 1
+                counts[1] += record.end - record.start + 1
+
+        delay = 0
+        over = {}
+        for user, (line_count, byte_count) in usage.items():
+            line_bucket, byte_bucket = self._buckets_for(user, address, now)
+            if line_bucket is None and byte_bucket is None:
+                continue
+            for bucket in (line_bucket, byte_bucket):
+                if bucket is not None:
+                    bucket.refill(now)
+
+            if self.policy == DELAY:
+                wait = 0
+                for bucket, amount in ((line_bucket, line_count), (byte_bucket, byte_count)):
+                    if bucket is not None:
+                        bucket.tokens -= amount
+                        if bucket.tokens < 0:
+                            wait = max(wait, -bucket.tokens / bucket.rate)
+                if wait:
+                    THROTTLED_LINES.labels(user).inc(line_count)
+                    THROTTLE_DELAY_SECONDS.labels(user).inc(wait)
+                    delay = max(delay, wait)
+                continue
+
+            if (line_bucket is None or line_bucket.tokens >= line_count) and \
+                    (byte_bucket is None or byte_bucket.tokens >= byte_count):
+                if line_bucket is not None:
+                    line_bucket.tokens -= line_count
+                if byte_bucket is not None:
+                    byte_bucket.tokens -= byte_count
+                continue
+            over[user] = (line_bucket, byte_bucket)
+
+        if delay:
+            gevent.sleep(delay)
+        if not over:
+            return records
+
+        allowed = []
+        for record in records:
+            buckets = over.get(record.user)
+            if buckets is None:
+                allowed.append(record)
+                continue
+            line_bucket, byte_bucket = buckets
+            size = record.end - record.start + 1
+            if (line_bucket is None or line_bucket.tokens >= 1) and \
+                    (byte_bucket is None or byte_bucket.tokens >= size):
+                if line_bucket is not None:
+                    line_bucket.tokens -= 1
+                if byte_bucket is not None:
+                    byte_bucket.tokens -= size
+                allowed.append(record)
+            else:
+                THROTTLED_LINES.labels(record.user).inc()
+        return allowed
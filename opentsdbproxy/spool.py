@@ -0,0 +1,307 @@
+import os
+import mmap
+import time
+import fcntl
+import struct
+import logging
+import weakref
+
+import gevent
+
+from opentsdbproxy.exceptions import ConfigurationException
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+DEFAULT_REPLAY_RATE = 1024 * 1024
+REPLAY_CHECK_INTERVAL = 1
+
+SEGMENT_PREFIX = 'spool-'
+SEGMENT_SUFFIX = '.log'
+RECORD_HEADER = struct.Struct('!I')
+
+# Locked spool directory descriptors by (pid, directory), as a forked
+# process inherits these but not the locks
+_locks = {}
+# Open spools by (pid, directory), so a reloaded backend shares its
+# predecessor's
+_spools = weakref.WeakValueDictionary()
+
+
+def _lock(directory):
+    """Take an exclusive lock on a spool directory for this process, so
+    another process can't replay or remove segments it is appending to
+    """
+    directory = os.path.realpath(directory)
+    key = (os.getpid(), directory)
+    if key in _locks:
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        os.close(fd)
+        raise ConfigurationException("Spool directory '%s' is in use by another process: %s" % (
+            directory, e))
+    _locks[key] = fd
+
+
+def worker_spool_dir(spool_dir, worker):
+    """worker_spool_dir
+
+    Workers each spool to their own subdirectory, as they can't share one
+
+    @param worker - the worker's index, or None when not running workers
+
+    @returns - the directory the worker should spool to
+    """
+    if spool_dir is None or worker is None:
+        return spool_dir
+    return os.path.join(spool_dir, 'worker-%d' % worker)
+
+
+def open_spool(directory, segment_size=None, max_size=None):
+    """open_spool
+
+    @returns - the Spool already open on directory in this process, with its
+               sizes updated, or a new one
+    """
+    key = (os.getpid(), os.path.realpath(directory))
+    spool = _spools.get(key)
+    if spool is None:
+        spool = _spools[key] = Spool(directory, segment_size=segment_size, max_size=max_size)
+    else:
+        spool.segment_size = segment_size or DEFAULT_SEGMENT_SIZE
+        spool.max_size = max_size or DEFAULT_MAX_SIZE
+    return spool
+
+
+class Spool(object):
+    """An on disk log of data that couldn't be written upstream
+
+    Records are appended to numbered segment files as a 4 byte length
+    followed by the data. A new segment is started once the current one
+    reaches segment_size, and the oldest segments are deleted when the
+    spool grows past max_size. Segments left by a previous run are kept
+    and replayed first.
+
+    Only one process may use a directory. Within a process, use open_spool
+    so every backend shares one Spool, and one replay position.
+    """
+
+    def __init__(self, directory, segment_size=None, max_size=None):
+        self.directory = directory
+        self.segment_size = segment_size or DEFAULT_SEGMENT_SIZE
+        self.max_size = max_size or DEFAULT_MAX_SIZE
+
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        except OSError as e:
+            raise ConfigurationException("Couldn't create spool directory '%s': %s" % (directory, e))
+        _lock(directory)
+
+        self.segments = {}
+        for name in os.listdir(directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                sequence = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                self.segments[sequence] = os.path.getsize(os.path.join(directory, name))
+
+        self._current = None
+        self._current_sequence = None
+
+        # Where replay got to, kept here so a replacement replayer resumes it
+        self.replay_sequence = None
+        self.replay_offset = 0
+
+        self.spooled_records = 0
+        self.spooled_bytes = 0
+        self.evicted_segments = 0
+        self.evicted_bytes = 0
+
+        if self.segments:
+            log.info("Found %d bytes spooled in '%s'" % (self.size, directory))
+
+    @property
+    def size(self):
+        return sum(self.segments.values())
+
+    @property
+    def pending(self):
+        return any(self.segments.values())
+
+    def segment_path(self, sequence):
+        return os.path.join(self.directory, "%s%016d%s" % (SEGMENT_PREFIX, sequence, SEGMENT_SUFFIX))
+
+    def append(self, data):
+        """append
+
+        Add a record to the end of the spool
+
+        @param data - one or more newline terminated lines
+        """
+        record_size = RECORD_HEADER.size + len(data)
+        if self._current is None or self.segments[self._current_sequence] + record_size > self.segment_size:
+            self._rotate()
+
+        self._current.write(RECORD_HEADER.pack(len(data)) + data)
+        self._current.flush()
+        self.segments[self._current_sequence] += record_size
+        self.spooled_records += 1
+        self.spooled_bytes += len(data)
+
+        self._evict()
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+            self._current_sequence = None
+
+    def oldest(self):
+        """oldest
+
+        Close the current segment if it is the only one, so it can be read
+
+        @returns - the sequence number of the oldest segment, or None
+        """
+        if not self.segments:
+            return None
+        sequence = min(self.segments)
+        if sequence == self._current_sequence:
+            self.close()
+        return sequence
+
+    def read(self, sequence, offset=0):
+        """read
+
+        Iterate over the records of a closed segment through mmap
+
+        @param sequence - segment to read
+        @param offset - byte offset of the first record to read
+
+        @returns - generator of (offset after the record, record data)
+        """
+        path = self.segment_path(sequence)
+        with open(path, 'rb') as segment:
+            size = os.fstat(segment.fileno()).st_size
+            if size == 0:
+                return
+            mapped = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                while offset + RECORD_HEADER.size <= size:
+                    length, = RECORD_HEADER.unpack_from(mapped, offset)
+                    start = offset + RECORD_HEADER.size
+                    if start + length > size:
+                        log.warning("Discarding truncated record at %d in '%s'" % (offset, path))
+                        return
+                    offset = start + length
+                    yield offset, mapped[start:offset]
+            finally:
+                mapped.close()
+
+    def remove(self, sequence):
+        if sequence == self._current_sequence:
+            self.close()
+        self.segments.pop(sequence, None)
+        try:
+            os.unlink(self.segment_path(sequence))
+        except OSError as e:
+            log.warning("Couldn't remove spool segment %d: %s" % (sequence, e))
+
+    def _rotate(self):
+        self.close()
+        sequence = max(self.segments) + 1 if self.segments else 0
+        self._current = open(self.segment_path(sequence), 'ab')
+        self._current_sequence = sequence
+        self.segments[sequence] = 0
+
+    def _evict(self):
+        size = self.size
+        while size > self.max_size and len(self.segments) > 1:
+            sequence = min(self.segments)
+            evicted = self.segments[sequence]
+            log.warning("Spool is over %d bytes, dropping %d bytes in segment %d" % (
+                self.max_size, evicted, sequence))
+            self.remove(sequence)
+            self.evicted_segments += 1
+            self.evicted_bytes += evicted
+            size -= evicted
+
+
+class SpoolReplayer(object):
+    """Drains a spool back upstream, oldest record first
+
+    Every check_interval seconds, if healthy() is true, the oldest segment is
+    read and each record is passed to send() at no more than rate bytes per
+    second. A segment is deleted once all of its records are sent. If send()
+    returns False, replay pauses and resumes from the same record later.
+    """
+
+    def __init__(self, spool, send, healthy, rate=None, check_interval=None):
+        self.spool = spool
+        self.send = send
+        self.healthy = healthy
+        self.rate = rate or DEFAULT_REPLAY_RATE
+        self.check_interval = check_interval or REPLAY_CHECK_INTERVAL
+
+        self._greenlet = None
+
+        self.replayed_records = 0
+        self.replayed_bytes = 0
+
+    def start(self):
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill(block=False)
+            self._greenlet = None
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.check_interval)
+            if not self.spool.pending or not self.healthy():
+                continue
+            try:
+                self.replay_segment()
+            except Exception:
+                log.exception("Failed to replay spool")
+
+    def replay_segment(self):
+        """replay_segment
+
+        Send the records of the oldest segment
+
+        @returns - True if the whole segment was sent
+        """
+        sequence = self.spool.oldest()
+        if sequence is None:
+            return True
+        spool = self.spool
+        if sequence != spool.replay_sequence:
+            spool.replay_sequence = sequence
+            spool.replay_offset = 0
+
+        started = time.time()
+        sent = 0
+        for offset, data in spool.read(sequence, spool.replay_offset):
+            if not self.send(data):
+                log.info("Pausing spool replay at segment %d offset %d" % (sequence, spool.replay_offset))
+                return False
+            spool.replay_offset = offset
+            self.replayed_records += 1
+            self.replayed_bytes += len(data)
+
+            sent += len(data)
+            ahead = sent / float(self.rate) - (time.time() - started)
+            gevent.sleep(max(0, ahead))
+
+        log.info("Replayed spool segment %d" % sequence)
+        if sequence in spool.segments:
+            spool.remove(sequence)
+        spool.replay_sequence = None
+        spool.replay_offset = 0
+        return True
@@ -0,0 +1,246 @@
+"""Stages that put records pass through before they are forwarded
+
+Each stage has process(records), which returns the records to pass on, and
+close(), called when the backend shuts down.
+"""
+
+import re
+import time
+import fnmatch
+import logging
+
+from collections import OrderedDict
+
+import gevent
+
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.stats import registry
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DEDUPE_WINDOW = 60
+DEFAULT_DEDUPE_MAX_ENTRIES = 1000000
+DOWNSAMPLE_CHECK_INTERVAL = 1
+
+AGGREGATORS = ('min', 'max', 'avg', 'last')
+
+DUPLICATES_DROPPED = registry.counter('duplicates_dropped_total',
+    "Puts dropped as duplicates of a recent series and timestamp")
+DOWNSAMPLED_LINES = registry.counter('downsampled_lines_total', "Puts absorbed by downsampling")
+DOWNSAMPLED_POINTS = registry.counter('downsampled_points_total', "Points written by downsampling")
+
+
+class DuplicateFilter(object):
+    """Drops puts whose metric, tags and timestamp were seen within window seconds
+
+    Each (series, timestamp) is remembered by its hash in insertion order,
+    so the oldest are cheap to expire, and at most max_entries are kept.
+    """
+
+    def __init__(self, window=None, max_entries=None):
+        self.window = window or DEFAULT_DEDUPE_WINDOW
+        self.max_entries = max_entries or DEFAULT_DEDUPE_MAX_ENTRIES
+        self._seen = OrderedDict()
+
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self._seen)
+
+    def process(self, records):
+        now = time.time()
+        self._expire(now)
+
+        kept = []
+        seen = self._seen
+        for record in records:
+            if record.metric is None:
+                kept.append(record)
+                continue
+            key = hash((record.series, record.timestamp))
+            if key in seen:
+                self.duplicates += 1
+                continue
+            seen[key] = now
+            kept.append(record)
+
+        while len(seen) > self.max_entries:
+            seen.popitem(last=False)
+
+        dropped = len(records) - len(kept)
+        if dropped:
+            DUPLICATES_DROPPED.inc(dropped)
+        return kept
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        seen = self._seen
+        while seen:
+            key, added = next(iter(seen.iteritems()))
+            if added > cutoff:
+                break
+            del seen[key]
+
+    def close(self):
+        self._seen.clear()
+
+
+def parse_downsample_rule(rule):
+    """parse_downsample_rule
+
+    @param rule - 'metric pattern:interval seconds:aggregator', for instance
+                  'sys.cpu.*:60:avg'
+
+    @returns - (compiled pattern, interval, aggregator)
+    """
+    try:
+        pattern, interval, aggregator = rule.rsplit(':', 2)
+        interval = int(interval)
+    except ValueError:
+        raise ConfigurationException("Downsample rule '%s' isn't pattern:interval:aggregator" % rule)
+    if interval <= 0:
+        raise ConfigurationException("Downsample interval in '%s' must be positive" % rule)
+    if aggregator not in AGGREGATORS:
+        raise ConfigurationException("Unknown aggregator '%s' in '%s', choose from %s" % (
+            aggregator, rule, ', '.join(AGGREGATORS)))
+    return re.compile(fnmatch.translate(pattern)), interval, aggregator
+
+
+class _Bucket(object):
+
+    __slots__ = ('metric', 'tags', 'start', 'deadline', 'aggregator',
+        'min', 'max', 'sum', 'count', 'last')
+
+    def __init__(self, metric, tags, start, deadline, aggregator):
+        self.metric = metric
+        self.tags = tags
+        self.start = start
+        self.deadline = deadline
+        self.aggregator = aggregator
+        self.min = self.max = self.last = None
+        self.sum = 0.0
+        self.count = 0
+
+    def add(self, number, text):
+        if self.count == 0 or number < self.min[0]:
+            self.min = (number, text)
+        if self.count == 0 or number > self.max[0]:
+            self.max = (number, text)
+        self.last = text
+        self.sum += number
+        self.count += 1
+
+    def line(self):
+        if self.aggregator == 'avg':
+            value = repr(self.sum / self.count)
+        elif self.aggregator == 'last':
+            value = self.last
+        else:
+            value = getattr(self, self.aggregator)[1]
+        return "put %s %d %s %s\n" % (self.metric, self.start, value, self.tags)
+
+
+class Downsampler(object):
+    """Reduces matching metrics to one point per series per interval
+
+    Puts whose metric matches a rule are held in a bucket per series and
+    interval, and the bucket is written through emit, as one put stamped
+    with the start of the interval, once a later interval of the series
+    arrives or the interval has passed in wall clock time. Millisecond
+    timestamps are bucketed in milliseconds.
+
+    @param rules - list of 'pattern:interval:aggregator' strings
+    @param emit - called with newline terminated put lines
+    """
+
+    def __init__(self, rules, emit, check_interval=None):
+        self.rules = [parse_downsample_rule(rule) for rule in rules]
+        self.emit = emit
+        self.check_interval = check_interval or DOWNSAMPLE_CHECK_INTERVAL
+        self._buckets = {}
+        self._greenlet = gevent.spawn(self._flush_loop)
+
+        self.absorbed = 0
+        self.emitted = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def match(self, metric):
+        for pattern, interval, aggregator in self.rules:
+            if pattern.match(metric):
+                return interval, aggregator
+        return None
+
+    def process(self, records):
+        passed = []
+        ready = []
+        now = time.time()
+        for record in records:
+            rule = self.match(record.metric) if record.metric is not None else None
+            if rule is None:
+                passed.append(record)
+                continue
+            interval, aggregator = rule
+            try:
+                timestamp = int(record.timestamp)
+                number = float(record.value)
+            except ValueError:
+                passed.append(record)
+                continue
+
+            width = interval * 1000 if len(record.timestamp) > 10 else interval
+            start = timestamp - timestamp % width
+            series = record.series
+            bucket = self._buckets.get(series)
+            if bucket is not None and bucket.start != start:
+                if start < bucket.start:
+                    # Too late to aggregate, pass it on as it is
+                    passed.append(record)
+                    continue
+                ready.append(self._line(series))
+                bucket = None
+            if bucket is None:
+                tags = series.split(' ', 1)[1]
+                bucket = self._buckets[series] = _Bucket(record.metric, tags, start,
+                    now + interval, aggregator)
+            bucket.add(number, record.value)
+            self.absorbed += 1
+
+        absorbed = len(records) - len(passed)
+        if absorbed:
+            DOWNSAMPLED_LINES.inc(absorbed)
+        if ready:
+            self._emit(ready)
+        return passed
+
+    def _line(self, series):
+        return self._buckets.pop(series).line()
+
+    def _emit(self, lines):
+        self.emitted += len(lines)
+        DOWNSAMPLED_POINTS.inc(len(lines))
+        try:
+            self.emit(''.join(lines))
+        except Exception:
+            log.exception("Lost %d downsampled points" % len(lines))
+
+    def flush(self, everything=False):
+        """flush
+
+        Write the buckets whose interval has passed, or every bucket
+        """
+        now = time.time()
+        lines = [self._line(series) for series, bucket in self._buckets.items()
+            if everything or bucket.deadline <= now]
+        if lines:
+            self._emit(lines)
+
+    def _flush_loop(self):
+        while True:
+            gevent.sleep(self.check_interval)
+            self.flush()
+
+    def close(self):
+        self._greenlet.kill(block=False)
+        self.flush(everything=True)
@@ -0,0 +1,241 @@
+"""Process wide counters, gauges and histograms
+
+Metrics are rendered in the Prometheus text exposition format by
+StatsServer, which serves them over HTTP on a separate port.
+"""
+
+import time
+import logging
+
+from bisect import bisect_left
+
+from gevent.pywsgi import WSGIServer
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'opentsdbproxy_'
+
+# Seconds, from 10us to 10s
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (name, value))
+    return '{%s}' % ','.join(escaped)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._children = {}
+
+    def labels(self, *values):
+        """labels
+
+        @returns - the child metric for these label values, creating it if needed
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError("%s takes labels %s" % (self.name, self.labelnames))
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        return self.__class__(self.name, self.help)
+
+    def samples(self, labels=()):
+        """samples
+
+        @returns - list of (name suffix, labels, value)
+        """
+        if self.labelnames:
+            samples = []
+            for values, child in sorted(self._children.items()):
+                samples.extend(child.samples(tuple(zip(self.labelnames, values))))
+            return samples
+        if self.callback is not None:
+            return [('', labels, self.callback())]
+        return self._samples(labels)
+
+    def _samples(self, labels):
+        raise NotImplementedError("Subclasses must implement _samples")
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        Metric.__init__(self, name, help, labelnames, callback)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def _samples(self, labels):
+        return [('', labels, self.value)]
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        Metric.__init__(self, name, help, labelnames, callback)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def _samples(self, labels):
+        return [('', labels, self.value)]
+
+
+class _Timer(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start)
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), callback=None, buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labelnames, callback)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """time
+
+        @returns - a context manager that observes how long its block takes
+        """
+        return _Timer(self)
+
+    def _samples(self, labels):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            samples.append(('_bucket', labels + (('le', _format_value(float(bound))),), cumulative))
+        samples.append(('_sum', labels, self.sum))
+        samples.append(('_count', labels, self.count))
+        return samples
+
+
+class Registry(object):
+    """Holds every metric by name
+
+    Asking for a metric that already exists returns the existing one. For a
+    metric backed by a callback, the new callback replaces the old one, so
+    a replacement backend takes over its predecessor's metrics.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, help, labelnames=(), callback=None, **kwargs):
+        name = PREFIX + name
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, labelnames, callback, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError("%s is already registered as a %s" % (name, metric.type))
+        elif callback is not None:
+            metric.callback = callback
+        return metric
+
+    def counter(self, name, help, labelnames=(), callback=None):
+        return self._get(Counter, name, help, labelnames, callback)
+
+    def gauge(self, name, help, labelnames=(), callback=None):
+        return self._get(Gauge, name, help, labelnames, callback)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        rendered = []
+        for name in sorted(self.metrics):
+            try:
+                rendered.append(self.metrics[name].render())
+            except Exception:
+                log.exception("Failed to render %s" % name)
+        return ''.join(rendered)
+
+
+registry = Registry()
+
+
+class StatsServer(object):
+    """Serves the registry's metrics over HTTP, at any path"""
+
+    content_type = 'text/plain; version=0.0.4'
+
+    def __init__(self, port, address='', stats_registry=None):
+        self.registry = stats_registry or registry
+        self.server = WSGIServer((address, port), self.application, log=None)
+
+    def application(self, environ, start_response):
+        body = self.registry.render()
+        start_response('200 OK', [('Content-Type', self.content_type),
+            ('Content-Length', str(len(body)))])
+        return [body]
+
+    def start(self):
+        self.server.start()
+        log.info("Serving stats on port %s" % self.server.server_port)
+
+    def stop(self):
+        self.server.stop()
@@ -0,0 +1,92 @@
+import time
+
+from unittest import TestCase
+
+from opentsdbproxy.authcache import AuthCache, AuthSession
+
+
+class TestAuthCache(TestCase):
+
+    def test_hits_and_misses(self):
+        cache = AuthCache()
+
+        self.assertIsNone(cache.get("root", "root"))
+        cache.set("root", "root", True)
+        cache.set("root", "bad", False)
+
+        self.assertTrue(cache.get("root", "root"))
+        self.assertFalse(cache.get("root", "bad"))
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 1)
+
+    def test_no_plaintext_passwords(self):
+        cache = AuthCache()
+        cache.set("root", "sekrit", True)
+
+        self.assertNotIn("sekrit", repr(cache._entries))
+
+    def test_lru_eviction(self):
+        cache = AuthCache(max_size=2)
+        cache.set("a", "a", True)
+        cache.set("b", "b", True)
+        cache.get("a", "a")
+        cache.set("c", "c", True)
+
+        self.assertTrue(cache.get("a", "a"))
+        self.assertIsNone(cache.get("b", "b"))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_separate_ttls(self):
+        cache = AuthCache(positive_ttl=60, negative_ttl=0.01)
+        cache.set("root", "root", True)
+        cache.set("root", "bad", False)
+        time.sleep(0.02)
+
+        self.assertTrue(cache.get("root", "root"))
+        self.assertIsNone(cache.get("root", "bad"))
+        self.assertEqual(cache.expirations, 1)
+
+    def test_invalidate(self):
+        cache = AuthCache()
+        cache.set("a", "a", True)
+        cache.set("b", "b", True)
+
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a", "a"))
+        self.assertTrue(cache.get("b", "b"))
+
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+
+class TestAuthSession(TestCase):
+
+    def test_valid_until_invalidated(self):
+        cache = AuthCache()
+        session = AuthSession()
+        self.assertFalse(session.valid(cache))
+
+        session.establish("root", "root", cache)
+        self.assertTrue(session.valid(cache))
+        self.assertTrue(session.matches("root", "root", cache))
+        self.assertFalse(session.matches("root", "bad", cache))
+        self.assertFalse(session.matches("other", "root", cache))
+
+        cache.invalidate("someone")
+        self.assertFalse(session.valid(cache))
+        self.assertTrue(session.authenticated)
+
+    def test_no_plaintext_password(self):
+        cache = AuthCache()
+        session = AuthSession()
+        session.establish("root", "sekrit", cache)
+
+        self.assertNotIn("sekrit", [getattr(session, name) for name in AuthSession.__slots__])
+
+    def test_expires(self):
+        cache = AuthCache(positive_ttl=0.01)
+        session = AuthSession()
+        session.establish("root", "root", cache)
+        time.sleep(0.02)
+
+        self.assertFalse(session.valid(cache))
@@ -0,0 +1,94 @@
+import time
+import threading
+
+import gevent
+
+from unittest import TestCase
+
+from opentsdbproxy.authpool import AuthPool
+
+
+class SlowAuthenticator(object):
+    """Blocks its thread like a database query would"""
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, username=None, password=None):
+        with self.lock:
+            self.calls.append(username)
+        time.sleep(self.delay)
+        if password == "good":
+            return username
+        return None
+
+
+class TestAuthPool(TestCase):
+
+    def test_authenticate(self):
+        pool = AuthPool(size=2)
+        authenticate = SlowAuthenticator(delay=0)
+
+        self.assertTrue(pool.authenticate(authenticate, "root", "good"))
+        self.assertFalse(pool.authenticate(authenticate, "root", "bad"))
+        self.assertEqual(len(pool), 0)
+
+    def test_coalesces_same_credentials(self):
+        pool = AuthPool(size=4)
+        authenticate = SlowAuthenticator()
+
+        greenlets = [gevent.spawn(pool.authenticate, authenticate, "root", "good")
+            for _ in range(5)]
+        greenlets.append(gevent.spawn(pool.authenticate, authenticate, "other", "good"))
+        gevent.joinall(greenlets)
+
+        self.assertTrue(all(greenlet.value for greenlet in greenlets))
+        self.assertEqual(sorted(authenticate.calls), ["other", "root"])
+
+    def test_doesnt_block_hub(self):
+        pool = AuthPool(size=2)
+        authenticate = SlowAuthenticator(delay=0.3)
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(time.time())
+                gevent.sleep(0.01)
+        ticker = gevent.spawn(tick)
+        try:
+            started = time.time()
+            gevent.joinall([gevent.spawn(pool.authenticate, authenticate, user, "good")
+                for user in ("a", "b")])
+            elapsed = time.time() - started
+        finally:
+            ticker.kill()
+
+        # Both ran at once in threads while other greenlets kept running
+        self.assertLess(elapsed, 0.5)
+        self.assertGreater(len(ticks), 10)
+
+    def test_exception_reaches_every_waiter(self):
+        pool = AuthPool(size=1)
+
+        def broken(username=None, password=None):
+            time.sleep(0.05)
+            raise RuntimeError("database went away")
+
+        greenlets = [gevent.spawn(pool.authenticate, broken, "root", "good") for _ in range(3)]
+        gevent.joinall(greenlets)
+
+        for greenlet in greenlets:
+            self.assertIsInstance(greenlet.exception, RuntimeError)
+        self.assertEqual(len(pool), 0)
+
+    def test_no_plaintext_passwords(self):
+        pool = AuthPool(size=1)
+        authenticate = SlowAuthenticator(delay=0.05)
+
+        greenlet = gevent.spawn(pool.authenticate, authenticate, "root", "sekrit")
+        gevent.sleep(0.01)
+        self.assertEqual(len(pool), 1)
+        self.assertNotIn("sekrit", repr(pool._pending))
+        greenlet.join()
@@ -1,8 +1,10 @@
 import os
 import time
 import uuid
+import shutil
 import urllib
 import httplib
+import tempfile
 
 import opentsdbproxy
 
@@ -11,7 +13,9 @@ from nose.plugins.skip import SkipTest
 from unittest import TestCase
 
 from opentsdbproxy.backends import MockOpenTSDBBackend,\
-    ForwardingOpenTSDBBackend, MockDjangoAuthorizingBackend, DjangoAuthorizingBackend
+    ForwardingOpenTSDBBackend, MockDjangoAuthorizingBackend, DjangoAuthorizingBackend,\
+    load_backend_config
+from opentsdbproxy.exceptions import ConfigurationException
 
 OPENTSDB_BUILT_STRING = "net.opentsdb built at revision"
 DJANGO_PROJECT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -52,6 +56,35 @@ class TestMockOpenTSDBBackend(TestCase):
         self.assertIn(msg, self.backend.messages)
 
 
+class TestLoadBackendConfig(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "backend.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, content):
+        with open(self.path, 'w') as f:
+            f.write(content)
+
+    def test_load(self):
+        self.write('{"credential_file": "users", "rate_limit_lines": 100}')
+
+        config = load_backend_config(self.path)
+
+        self.assertEqual(config, {'credential_file': "users", 'rate_limit_lines': 100})
+        self.assertTrue(all(isinstance(name, str) for name in config))
+
+    def test_invalid(self):
+        self.assertRaises(ConfigurationException, load_backend_config,
+            os.path.join(self.tempdir, "missing.json"))
+        for content in ("{not json", '["rate_limit_lines"]'):
+            self.write(content)
+            self.assertRaises(ConfigurationException, load_backend_config, self.path)
+
+
 class TestForwardingOpenTSDBBackend(TestCase):
 
     def setUp(self):
@@ -0,0 +1,85 @@
+import gevent
+
+from unittest import TestCase
+
+from opentsdbproxy.batching import WriteBatcher
+
+LINE = "put test.my.value 1366155625 42 host=a\n"
+
+
+class TestWriteBatcher(TestCase):
+
+    def setUp(self):
+        self.flushed = []
+
+    def test_flush_on_lines(self):
+        batcher = WriteBatcher(self.flushed.append, max_lines=3, max_delay_ms=10000)
+
+        batcher.add(LINE)
+        batcher.add(LINE * 2)
+        batcher.add(LINE)
+
+        self.assertEqual(self.flushed, [LINE * 3])
+        self.assertEqual(batcher.batches, 1)
+        self.assertEqual(batcher.batched_lines, 3)
+        self.assertEqual(batcher.buffered_bytes, len(LINE))
+
+    def test_flush_on_bytes(self):
+        batcher = WriteBatcher(self.flushed.append, max_bytes=len(LINE) * 2, max_delay_ms=10000)
+
+        batcher.add(LINE)
+        self.assertEqual(self.flushed, [])
+        batcher.add(LINE)
+        self.assertEqual(self.flushed, [LINE * 2])
+
+    def test_flush_on_delay(self):
+        batcher = WriteBatcher(self.flushed.append, max_delay_ms=20)
+
+        batcher.add(LINE)
+        self.assertEqual(self.flushed, [])
+        gevent.sleep(0.1)
+        self.assertEqual(self.flushed, [LINE])
+        self.assertTrue(batcher.total_wait_time > 0)
+
+    def test_enqueue_time(self):
+        def enqueue(data):
+            # As when a full upstream queue pushes back
+            gevent.sleep(0.05)
+            self.flushed.append(data)
+        batcher = WriteBatcher(enqueue, max_lines=1)
+
+        batcher.add(LINE)
+        self.assertEqual(self.flushed, [LINE])
+        self.assertTrue(batcher.longest_enqueue_time >= 0.05)
+        self.assertEqual(batcher.total_enqueue_time, batcher.longest_enqueue_time)
+
+    def test_flush_on_close(self):
+        batcher = WriteBatcher(self.flushed.append, max_delay_ms=10000)
+
+        batcher.add(LINE)
+        batcher.close()
+        self.assertEqual(self.flushed, [LINE])
+
+    def test_failed_flush_is_handed_on(self):
+        def broken(data):
+            raise Exception("Couldn't connect to OpenTSDB")
+        failed = []
+        batcher = WriteBatcher(broken, max_lines=2, max_delay_ms=20, on_failure=failed.append)
+
+        # Neither the client filling the batch nor the timer sees the error
+        batcher.add(LINE * 2)
+        batcher.add(LINE)
+        gevent.sleep(0.1)
+
+        self.assertEqual(failed, [LINE * 2, LINE])
+        self.assertEqual(batcher.failed_batches, 2)
+        self.assertEqual(batcher.batches, 0)
+
+    def test_failed_flush_without_on_failure(self):
+        def broken(data):
+            raise Exception("Couldn't connect to OpenTSDB")
+        batcher = WriteBatcher(broken, max_lines=1)
+
+        batcher.add(LINE)
+        self.assertEqual(batcher.failed_batches, 1)
+        self.assertEqual(batcher.buffered_bytes, 0)
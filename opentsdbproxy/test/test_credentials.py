@@ -0,0 +1,220 @@
+import os
+import json
+import shutil
+import tempfile
+
+import gevent
+
+from gevent import socket
+
+from unittest import TestCase
+
+from opentsdbproxy.authcache import AuthSession, auth_cache
+from opentsdbproxy.backends import MockFileAuthorizingBackend
+from opentsdbproxy.credentials import CredentialFile, verify_password, apr1
+from opentsdbproxy.exceptions import ConfigurationException, SessionExpired
+
+from util import CapturingProxy, certificate_or_skip, free_port, wait_for
+
+HASHES = {
+    'pbkdf2': "pbkdf2_sha256$1000$salt$rHcexLN/QtAYYgZL7OhTd0AyGhy2Tu0auA35PvzxgZM=",
+    'sha': "{SHA}3Hbp8MAAbo+RngxRXGbbujmC94U=",
+    'salted': "sha1$ab$3f8104306e66b20036c32b1b6789b7480134febf",
+    'crypt': "$6$salt$qmvfrgAF.JOiI.LeVZf55uev6dXyfh3OUw7DGwrxMTs/lkg.usnI9U2DuOywM5BYt.eJpyJ4thsDc/J8xzzca.",
+}
+
+
+class TestVerifyPassword(TestCase):
+
+    def test_apr1(self):
+        # Generated with openssl passwd -apr1
+        self.assertEqual(apr1("secret", "abcdefgh"), "$apr1$abcdefgh$h9FWgUz3n9YxylKLlR5SQ/")
+        self.assertEqual(apr1("p@ss w0rd", "x1"), "$apr1$x1$FMh4XEfl.mnwD4x6kM9/U0")
+        self.assertTrue(verify_password("secret", "$apr1$abcdefgh$h9FWgUz3n9YxylKLlR5SQ/"))
+
+    def test_hashes(self):
+        for name, encoded in HASHES.items():
+            self.assertTrue(verify_password("root", encoded), name)
+            self.assertFalse(verify_password("bad", encoded), name)
+
+
+class TestCredentialFile(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "users")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, content):
+        # Write then rename, the way credentials should be replaced
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.write(content)
+        os.rename(temp_path, self.path)
+
+    def test_htpasswd(self):
+        self.write("# users\nroot:%s\n\njoshua:%s\n" % (HASHES['sha'], HASHES['salted']))
+        credentials = CredentialFile(self.path)
+
+        self.assertTrue(credentials.check("root", "root"))
+        self.assertTrue(credentials.check("joshua", "root"))
+        self.assertFalse(credentials.check("nobody", "root"))
+
+    def test_json(self):
+        self.write(json.dumps({"root": HASHES['pbkdf2']}))
+        credentials = CredentialFile(self.path)
+
+        self.assertTrue(credentials.check("root", "root"))
+        self.assertFalse(credentials.check("root", "bad"))
+
+    def test_bad_file(self):
+        self.write("root\n")
+        self.assertRaises(ConfigurationException, CredentialFile, self.path)
+
+    def test_bad_reload_keeps_credentials(self):
+        self.write("root:%s\n" % HASHES['sha'])
+        credentials = CredentialFile(self.path)
+
+        self.write("garbage\n")
+        self.assertTrue(credentials.changed())
+        self.assertRaises(ValueError, credentials.reload)
+        self.assertTrue(credentials.check("root", "root"))
+
+
+class TestMockFileAuthorizingBackend(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "users")
+        self.write("root:%s\n" % HASHES['sha'])
+        self.backend = MockFileAuthorizingBackend(credential_file=self.path,
+            credential_reload_interval=0.05)
+
+    def tearDown(self):
+        self.backend.close()
+        auth_cache.invalidate()
+        shutil.rmtree(self.tempdir)
+
+    def write(self, content):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.write(content)
+        os.rename(temp_path, self.path)
+
+    def test_messages(self):
+        good_msg = "put test.my.value 1366155625 42 host=a user=root password=root\n"
+        bad_msg = "put test.my.value 1366155625 42 host=a user=root password=bad\n"
+        self.backend.handle(good_msg + bad_msg)
+
+        self.assertEqual(self.backend.authzed_messages,
+            [good_msg.replace(" password=root", "")])
+
+    def test_reload(self):
+        msg = "put test.my.value 1366155625 42 host=a user=joshua password=root\n"
+        self.backend.handle(msg)
+        self.assertEqual(self.backend.authzed_messages, [])
+
+        self.write("joshua:%s\n" % HASHES['salted'])
+        gevent.sleep(0.2)
+
+        self.backend.handle(msg)
+        self.assertEqual(self.backend.authzed_messages, [msg.replace(" password=root", "")])
+
+    def test_session_from_first_line(self):
+        session = AuthSession()
+        message = ("put a 1 1 host=a user=root password=root\n"
+            "put b 1 1 host=a\n"
+            "put c 1 1 host=a user=root password=root\n")
+
+        self.backend.handle(message, session=session)
+
+        self.assertEqual(session.user, "root")
+        self.assertEqual(self.backend.authzed_messages,
+            ["put a 1 1 host=a user=root\nput b 1 1 host=a user=root\nput c 1 1 host=a user=root\n"])
+
+    def test_session_from_auth_command(self):
+        session = AuthSession()
+
+        response = self.backend.handle("auth root bad\nput a 1 1 host=a\n", session=session)
+        self.assertEqual(response, "auth: bad username or password\n")
+        self.assertEqual(self.backend.authzed_messages, [])
+
+        response = self.backend.handle("auth root root\nput a 1 1 host=a\n", session=session)
+        self.assertIsNone(response)
+        self.assertEqual(self.backend.authzed_messages, ["put a 1 1 host=a user=root\n"])
+
+    def test_session_checks_other_credentials(self):
+        session = AuthSession()
+        self.backend.handle("auth root root\n", session=session)
+
+        self.backend.handle("put a 1 1 host=a user=root password=bad\n", session=session)
+        self.assertEqual(self.backend.authzed_messages, [])
+
+    def test_session_ends_when_user_is_removed(self):
+        session = AuthSession()
+        self.backend.handle("auth root root\n", session=session)
+
+        self.write("joshua:%s\n" % HASHES['salted'])
+        gevent.sleep(0.2)
+
+        self.assertRaises(SessionExpired, self.backend.handle, "put a 1 1 host=a\n",
+            session=session)
+        self.assertEqual(self.backend.authzed_messages, [])
+        self.assertFalse(session.authenticated)
+
+    def test_without_session_lines_need_credentials(self):
+        self.backend.handle("auth root root\nput a 1 1 host=a\n")
+
+        self.assertEqual(self.backend.authzed_messages, [])
+
+    def test_rate_limit(self):
+        self.backend.close()
+        self.backend = MockFileAuthorizingBackend(credential_file=self.path, rate_limit_lines=2)
+
+        good_msg = "put test.my.value 1366155625 42 host=a user=root password=root\n"
+        self.backend.handle(good_msg * 3)
+
+        self.assertEqual(self.backend.authzed_messages,
+            [good_msg.replace(" password=root", "") * 2])
+
+
+class TestSessionExpiry(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        cert, key = certificate_or_skip(self.tempdir)
+        path = os.path.join(self.tempdir, "users")
+        with open(path, 'w') as f:
+            f.write("root:%s\n" % HASHES['sha'])
+
+        self.port = free_port()
+        CapturingProxy.proxy = None
+        self.greenlet = gevent.spawn(CapturingProxy, port=free_port(), plaintext_port=self.port,
+            backend='mock_file_authz', backend_parameters=dict(credential_file=path),
+            ssl_cert_path=cert, ssl_key_path=key, auth_sessions=True, drain_timeout=1)
+        wait_for(lambda: CapturingProxy.proxy is not None and
+            getattr(CapturingProxy.proxy, 'plaintext_server', None) is not None)
+        self.proxy = CapturingProxy.proxy
+
+    def tearDown(self):
+        self.proxy.drain()
+        self.greenlet.join(timeout=2)
+        auth_cache.invalidate()
+        shutil.rmtree(self.tempdir)
+
+    def test_client_is_told_when_session_expires(self):
+        client = socket.create_connection(('127.0.0.1', self.port))
+        client.sendall("auth root root\nput a 1 1 host=a\n")
+        wait_for(lambda: self.proxy.backend.authzed_messages)
+
+        # As on SIGHUP, or once the auth cache TTL has passed
+        auth_cache.invalidate()
+        client.sendall("put b 1 1 host=a\n")
+        with gevent.Timeout(2):
+            reply = client.makefile().read()
+        client.close()
+
+        self.assertEqual(reply, "auth: session expired\n")
+        self.assertEqual(self.proxy.backend.authzed_messages, ["put a 1 1 host=a user=root\n"])
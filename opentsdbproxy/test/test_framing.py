@@ -0,0 +1,143 @@
+import zlib
+
+from unittest import TestCase
+
+from opentsdbproxy.framing import LineReader, DecompressionError
+
+
+class FakeSocket(object):
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buf, nbytes):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        assert len(chunk) <= nbytes
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    def recv(self, nbytes):
+        if not self.chunks:
+            return ''
+        chunk = self.chunks.pop(0)
+        if len(chunk) > nbytes:
+            self.chunks.insert(0, chunk[nbytes:])
+            chunk = chunk[:nbytes]
+        return chunk
+
+
+class TestLineReader(TestCase):
+
+    def read_all(self, reader):
+        messages = []
+        while True:
+            message = reader.read_lines()
+            if message == '':
+                return messages
+            messages.append(message)
+
+    def test_complete_lines(self):
+        sock = FakeSocket(["version\n", "put a 1 1 x=y\nput b 1 1 x=y\n"])
+        reader = LineReader(sock)
+
+        self.assertEqual(self.read_all(reader),
+            ["version\n", "put a 1 1 x=y\nput b 1 1 x=y\n"])
+
+    def test_partial_lines_are_carried_over(self):
+        sock = FakeSocket(["put a 1 1 ", "x=y\nput b", " 1 1 x=y\nput c 1"])
+        reader = LineReader(sock)
+
+        self.assertEqual(self.read_all(reader),
+            ["put a 1 1 x=y\n", "put b 1 1 x=y\n"])
+
+    def test_small_recv_size(self):
+        data = "put a 1 1 x=y\n" * 10
+        sock = FakeSocket([data[i:i + 3] for i in range(0, len(data), 3)])
+        reader = LineReader(sock, recv_size=3)
+
+        self.assertEqual(''.join(self.read_all(reader)), data)
+
+    def test_overlong_lines_are_dropped(self):
+        sock = FakeSocket(["put a 1 1 x=y\nput ", "x" * 20, "x" * 20,
+            "xxx\nput b 1 1 x=y\n"])
+        reader = LineReader(sock, recv_size=32, max_line_length=16)
+
+        self.assertEqual(self.read_all(reader),
+            ["put a 1 1 x=y\n", "put b 1 1 x=y\n"])
+        self.assertEqual(reader.dropped_lines, 1)
+
+    def test_overlong_lines_arriving_whole_are_dropped(self):
+        lines = ["put a 1 1 x=y\n", "put %s 1 1 x=y\n" % ("x" * 20), "put b 1 1 x=y\n",
+            "put c 1 1 x=y\n", "put %s 1 1 x=y\n" % ("y" * 20)]
+        sock = FakeSocket([''.join(lines), "put d 1 1 x=", "y\n"])
+        reader = LineReader(sock, recv_size=128, max_line_length=16)
+
+        self.assertEqual(self.read_all(reader),
+            ["put a 1 1 x=y\nput b 1 1 x=y\nput c 1 1 x=y\n", "put d 1 1 x=y\n"])
+        self.assertEqual(reader.dropped_lines, 2)
+
+    def test_overlong_compressed_lines_are_dropped(self):
+        data = "put a 1 1 x=y\nput %s 1 1 x=y\nput b 1 1 x=y\n" % ("x" * 20)
+        sock = FakeSocket(["compress zlib\n", zlib.compress(data)])
+        reader = LineReader(sock, max_line_length=16, compression=True)
+
+        self.assertEqual(''.join(self.read_all(reader)), "put a 1 1 x=y\nput b 1 1 x=y\n")
+        self.assertEqual(reader.dropped_lines, 1)
+
+    def test_compress_handshake(self):
+        data = "put a 1 1 x=y\n" * 1000
+        compressed = zlib.compress(data)
+        # The handshake and the start of the stream arrive in one recv
+        sock = FakeSocket(["compress zlib\n" + compressed[:10], compressed[10:]])
+        reader = LineReader(sock, recv_size=1024, compression=True)
+
+        messages = self.read_all(reader)
+        self.assertEqual(''.join(messages), data)
+        self.assertTrue(all(len(message) <= 1024 + 14 for message in messages))
+        self.assertEqual(reader.algorithm, 'zlib')
+        self.assertEqual(reader.compressed_bytes, len(compressed))
+        self.assertEqual(reader.decompressed_bytes, len(data))
+        self.assertTrue(reader.compression_ratio > 10)
+
+    def test_raw_deflate_and_gzip(self):
+        data = "put a 1 1 x=y\nput b 1 1 x=y\n"
+        for algorithm, wbits in (('deflate', -15), ('gzip', 31)):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            compressed = compressor.compress(data) + compressor.flush()
+            sock = FakeSocket(["comp", "ress %s\n" % algorithm, compressed])
+            reader = LineReader(sock, compression=True)
+
+            self.assertEqual(''.join(self.read_all(reader)), data)
+
+    def test_compress_command_needs_compression(self):
+        sock = FakeSocket(["compress zlib\nversion\n"])
+        reader = LineReader(sock)
+
+        self.assertEqual(self.read_all(reader), ["compress zlib\nversion\n"])
+        self.assertEqual(reader.algorithm, None)
+
+    def test_plain_stream_with_compression_allowed(self):
+        sock = FakeSocket(["co", "llect\nversion\n"])
+        reader = LineReader(sock, compression=True)
+
+        self.assertEqual(self.read_all(reader), ["collect\nversion\n"])
+
+    def test_unknown_algorithm(self):
+        reader = LineReader(FakeSocket(["compress lzma\n"]), compression=True)
+
+        self.assertRaises(DecompressionError, reader.read_lines)
+
+    def test_corrupt_stream(self):
+        reader = LineReader(FakeSocket(["compress zlib\n", "not zlib at all"]), compression=True)
+
+        self.assertRaises(DecompressionError, reader.read_lines)
+
+    def test_decompression_bomb(self):
+        compressed = zlib.compress("\n" * (10 * 1024 * 1024), 9)
+        sock = FakeSocket(["compress zlib\n", compressed])
+        reader = LineReader(sock, recv_size=4096, compression=True, max_compression_ratio=100)
+
+        self.assertRaises(DecompressionError, self.read_all, reader)
+        self.assertTrue(reader.decompressed_bytes < 100 * len(compressed) + 2 * 4096)
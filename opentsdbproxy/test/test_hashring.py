@@ -0,0 +1,50 @@
+from unittest import TestCase
+
+from opentsdbproxy.hashring import HashRing
+
+KEYS = ["test.my.value host=host%d" % i for i in range(10000)]
+
+
+class TestHashRing(TestCase):
+
+    def test_empty(self):
+        self.assertEqual(HashRing().get("anything"), None)
+
+    def test_stable(self):
+        ring = HashRing(['a', 'b', 'c'])
+        other = HashRing(['c', 'b', 'a'])
+        for key in KEYS[:100]:
+            self.assertEqual(ring.get(key), other.get(key))
+            self.assertEqual(ring.get(key), ring.get(key))
+
+    def test_balance(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        counts = {}
+        for key in KEYS:
+            node = ring.get(key)
+            counts[node] = counts.get(node, 0) + 1
+
+        self.assertEqual(sorted(counts), ['a', 'b', 'c', 'd'])
+        for count in counts.values():
+            self.assertTrue(abs(count - 2500) < 500, counts)
+
+    def test_remove_only_moves_its_keys(self):
+        ring = HashRing(['a', 'b', 'c', 'd'])
+        before = dict((key, ring.get(key)) for key in KEYS)
+
+        ring.remove('d')
+        for key in KEYS:
+            if before[key] != 'd':
+                self.assertEqual(ring.get(key), before[key])
+            else:
+                self.assertNotEqual(ring.get(key), 'd')
+
+    def test_add_moves_a_fair_share(self):
+        ring = HashRing(['a', 'b', 'c'])
+        before = dict((key, ring.get(key)) for key in KEYS)
+
+        ring.add('d')
+        moved = [key for key in KEYS if ring.get(key) != before[key]]
+        for key in moved:
+            self.assertEqual(ring.get(key), 'd')
+        self.assertTrue(1500 < len(moved) < 3500, len(moved))
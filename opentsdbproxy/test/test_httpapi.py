@@ -0,0 +1,165 @@
+import os
+import json
+import gzip
+import base64
+import shutil
+import tempfile
+
+import mock
+
+from StringIO import StringIO
+from unittest import TestCase
+
+from opentsdbproxy.authcache import auth_cache
+from opentsdbproxy.backends import MockOpenTSDBBackend, MockFileAuthorizingBackend
+from opentsdbproxy.exceptions import UpstreamUnavailable
+from opentsdbproxy.httpapi import HTTPIngestServer, datapoint_line
+
+ROOT_SHA = "{SHA}3Hbp8MAAbo+RngxRXGbbujmC94U="
+
+DATAPOINT = {'metric': "sys.cpu.user", 'timestamp': 1366155625, 'value': 42,
+    'tags': {'host': "web01"}}
+
+
+class TestDatapointLine(TestCase):
+
+    def test_line(self):
+        self.assertEqual(datapoint_line(DATAPOINT), "put sys.cpu.user 1366155625 42 host=web01\n")
+
+    def test_user_replaces_tags(self):
+        datapoint = dict(DATAPOINT, value=0.5,
+            tags={'host': "web01", 'user': "someone", 'password': "secret"})
+
+        self.assertEqual(datapoint_line(datapoint, user="root"),
+            "put sys.cpu.user 1366155625 0.5 host=web01 user=root\n")
+
+    def test_invalid(self):
+        for change in ({'metric': "has space"}, {'metric': None}, {'timestamp': "now"},
+                {'value': "x"}, {'value': True}, {'tags': {}}, {'tags': {'host': "a=b"}}):
+            self.assertRaises(ValueError, datapoint_line, dict(DATAPOINT, **change))
+
+
+class TestHTTPIngestServer(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        path = os.path.join(self.tempdir, "users")
+        with open(path, 'w') as f:
+            f.write("root:%s\n" % ROOT_SHA)
+        self.backend = MockFileAuthorizingBackend(credential_file=path)
+        self.server = HTTPIngestServer(self.backend, ('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.backend.close()
+        auth_cache.invalidate()
+        shutil.rmtree(self.tempdir)
+
+    def request(self, body, user="root", password="root", path='/api/put', method='POST',
+            headers=None):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path.split('?')[0],
+            'QUERY_STRING': path.partition('?')[2],
+            'REMOTE_ADDR': '127.0.0.1',
+            'REMOTE_PORT': '50000',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+        }
+        if user is not None:
+            environ['HTTP_AUTHORIZATION'] = "Basic " + base64.b64encode("%s:%s" % (user, password))
+        environ.update(headers or {})
+
+        response = {}
+
+        def start_response(status, response_headers):
+            response['status'] = int(status.split()[0])
+            response['headers'] = dict(response_headers)
+        chunks = self.server.application(environ, start_response)
+        body = ''.join(chunks)
+        return response['status'], json.loads(body) if body else None, response['headers']
+
+    def test_batch(self):
+        status, body, _ = self.request([DATAPOINT, dict(DATAPOINT, timestamp=1366155626)])
+
+        self.assertEqual(status, 204)
+        self.assertEqual(body, None)
+        self.assertEqual(self.backend.authzed_messages,
+            ["put sys.cpu.user 1366155625 42 host=web01 user=root\n"
+             "put sys.cpu.user 1366155626 42 host=web01 user=root\n"])
+
+    def test_single_datapoint(self):
+        status, _, _ = self.request(DATAPOINT)
+
+        self.assertEqual(status, 204)
+        self.assertEqual(len(self.backend.authzed_messages), 1)
+
+    def test_bad_credentials(self):
+        for user, password in (("root", "wrong"), (None, None), ("nobody", "root")):
+            status, _, headers = self.request([DATAPOINT], user=user, password=password)
+
+            self.assertEqual(status, 401)
+            self.assertTrue(headers['WWW-Authenticate'].startswith('Basic'))
+        self.assertEqual(self.backend.authzed_messages, [])
+
+    def test_partial_failure_details(self):
+        status, body, _ = self.request([DATAPOINT, dict(DATAPOINT, value="x")],
+            path='/api/put?details')
+
+        self.assertEqual(status, 400)
+        self.assertEqual(body['success'], 1)
+        self.assertEqual(body['failed'], 1)
+        self.assertEqual(body['errors'][0]['datapoint']['value'], "x")
+        self.assertEqual(len(self.backend.authzed_messages), 1)
+
+        status, body, _ = self.request([dict(DATAPOINT, value="x")])
+        self.assertEqual(body, {'success': 0, 'failed': 1})
+
+    def test_rate_limited(self):
+        self.backend.setup_rate_limit(rate_limit_lines=2)
+
+        status, body, _ = self.request([DATAPOINT] * 3)
+
+        self.assertEqual(status, 429)
+        self.assertEqual(body, {'success': 2, 'failed': 1})
+
+    def test_gzip_body(self):
+        compressed = StringIO()
+        with gzip.GzipFile(fileobj=compressed, mode='w') as f:
+            f.write(json.dumps([DATAPOINT]))
+
+        status, _, _ = self.request(compressed.getvalue(),
+            headers={'HTTP_CONTENT_ENCODING': 'gzip'})
+
+        self.assertEqual(status, 204)
+        self.assertEqual(len(self.backend.authzed_messages), 1)
+
+    def test_errors(self):
+        self.assertEqual(self.request([DATAPOINT], path='/api/query')[0], 404)
+        self.assertEqual(self.request([DATAPOINT], method='GET')[0], 405)
+        self.assertEqual(self.request("{not json")[0], 400)
+        self.assertEqual(self.request('"datapoint"')[0], 400)
+
+        self.server.max_body = 10
+        self.assertEqual(self.request([DATAPOINT])[0], 413)
+
+    def test_without_authorization(self):
+        backend = MockOpenTSDBBackend()
+        self.server = HTTPIngestServer(backend, ('127.0.0.1', 0))
+
+        status, _, _ = self.request([DATAPOINT], user=None)
+
+        self.assertEqual(status, 204)
+        self.assertEqual(backend.messages, ["put sys.cpu.user 1366155625 42 host=web01\n"])
+
+    def test_upstream_unavailable(self):
+        backend = MockOpenTSDBBackend()
+        self.server = HTTPIngestServer(backend, ('127.0.0.1', 0))
+
+        with mock.patch.object(backend, 'ingest',
+                side_effect=UpstreamUnavailable("Couldn't connect to OpenTSDB")):
+            status, body, _ = self.request([DATAPOINT], user=None)
+
+        self.assertEqual(status, 503)
+        self.assertEqual(body['error']['code'], 503)
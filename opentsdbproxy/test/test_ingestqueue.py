@@ -0,0 +1,84 @@
+import time
+
+import gevent
+
+from unittest import TestCase
+
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.ingestqueue import IngestQueue
+
+
+class TestIngestQueue(TestCase):
+
+    def test_fifo(self):
+        queue = IngestQueue(max_bytes=100)
+        queue.put("a")
+        queue.put("bb")
+
+        self.assertEqual(queue.bytes, 3)
+        self.assertEqual(queue.get(), "a")
+        self.assertEqual(queue.get(), "bb")
+        self.assertEqual(queue.bytes, 0)
+
+    def test_get_timeout(self):
+        queue = IngestQueue(max_bytes=100)
+
+        self.assertEqual(queue.get(timeout=0.01), None)
+        gevent.spawn_later(0.01, queue.put, "a")
+        self.assertEqual(queue.get(timeout=1), "a")
+
+    def test_age(self):
+        queue = IngestQueue(max_bytes=4, policy='drop_oldest')
+        self.assertEqual(queue.age(), 0)
+
+        queue.put("aa")
+        gevent.sleep(0.05)
+        queue.put("bb")
+        self.assertGreaterEqual(queue.age(), 0.05)
+
+        # Dropping the oldest item makes the next one the head
+        queue.put("cc")
+        self.assertLess(queue.age(), 0.05)
+        queue.get()
+        self.assertLess(time.time() - queue.last_queued_at, 0.05)
+
+    def test_drop_newest(self):
+        queue = IngestQueue(max_bytes=4, policy='drop_newest')
+
+        self.assertTrue(queue.put("aa"))
+        self.assertTrue(queue.put("bb"))
+        self.assertFalse(queue.put("cc"))
+        self.assertEqual([queue.get(), queue.get()], ["aa", "bb"])
+        self.assertEqual(queue.dropped_items, 1)
+        self.assertEqual(queue.dropped_bytes, 2)
+
+    def test_drop_oldest(self):
+        queue = IngestQueue(max_bytes=4, policy='drop_oldest')
+
+        queue.put("aa")
+        queue.put("bb")
+        self.assertTrue(queue.put("cc"))
+        self.assertEqual([queue.get(), queue.get()], ["bb", "cc"])
+        self.assertEqual(queue.dropped_items, 1)
+
+    def test_block(self):
+        queue = IngestQueue(max_bytes=4, policy='block')
+        queue.put("aa")
+        queue.put("bb")
+
+        putter = gevent.spawn(queue.put, "cc")
+        gevent.sleep(0.01)
+        self.assertFalse(putter.ready())
+        self.assertEqual(queue.blocked_puts, 1)
+
+        self.assertEqual(queue.get(), "aa")
+        putter.join(timeout=1)
+        self.assertTrue(putter.value)
+        self.assertEqual(len(queue), 2)
+
+    def test_oversized_item_fits_empty_queue(self):
+        queue = IngestQueue(max_bytes=1)
+        self.assertTrue(queue.put("too big"))
+
+    def test_bad_policy(self):
+        self.assertRaises(ConfigurationException, IngestQueue, 1, 'maybe')
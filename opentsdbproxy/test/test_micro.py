@@ -0,0 +1,53 @@
+from unittest import TestCase
+
+from opentsdbproxy.bench import micro
+
+
+class TestMicrobenchmarks(TestCase):
+
+    def test_corpus_is_reproducible(self):
+        first = micro.make_corpus(10, 4, 0.5, messages=5)
+        second = micro.make_corpus(10, 4, 0.5, messages=5)
+
+        self.assertEqual(first, second)
+        self.assertEqual(len(first), 5)
+        for message in first:
+            self.assertEqual(message.count('\n'), 10)
+            self.assertEqual(message.splitlines()[0].count('tag'), 4)
+
+    def test_corpus_authorized_ratio(self):
+        authorized = micro.make_corpus(10, 1, 1.0, messages=2)
+        rejected = micro.make_corpus(10, 1, 0.0, messages=2)
+
+        backend = micro.StubAuthorizingBackend()
+        for message in authorized:
+            self.assertEqual(backend.filter_message(message).count('\n'), 10)
+        for message in rejected:
+            self.assertEqual(backend.filter_message(message), '\n')
+
+    def test_stub_backends_handle(self):
+        corpus = micro.make_corpus(10, 4, 0.5, messages=2)
+
+        forwarding = micro.StubForwardingBackend()
+        authorizing = micro.StubAuthorizingBackend()
+        for message in corpus:
+            self.assertEqual(forwarding.handle(message), None)
+            self.assertEqual(authorizing.handle(message), None)
+
+        self.assertEqual(forwarding.stub_upstream.sent_bytes, sum(len(m) for m in corpus))
+        self.assertTrue(0 < authorizing.stub_upstream.sent_bytes < forwarding.stub_upstream.sent_bytes)
+
+    def test_run(self):
+        results = micro.run(pattern='filter_message/lines=10/tags=1/', min_time=0.001, repeat=1)
+
+        self.assertEqual(len(results), len(micro.AUTHORIZED_RATIOS))
+        for value in results.values():
+            self.assertTrue(value > 0)
+
+    def test_compare(self):
+        baseline = {'a': 100.0, 'b': 100.0, 'c': 100.0}
+        results = {'a': 105.0, 'b': 120.0, 'c': 50.0, 'new': 1000.0}
+
+        regressions = micro.compare(baseline, results, threshold=0.1)
+
+        self.assertEqual(regressions, [('b', 100.0, 120.0)])
@@ -0,0 +1,190 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import gevent
+import mock
+
+from unittest import TestCase
+
+from opentsdbproxy.backends import ForwardingOpenTSDBBackend
+from opentsdbproxy.bench.stubtsd import StubTSD
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.mirror import TSDMirror, FileMirror, parse_mirror
+from opentsdbproxy.parser import parse
+
+from util import free_port, wait_for
+
+MESSAGE = "put test.my.value 1366155625 42 host=a\nput test.my.value 1366155626 43 host=a\n"
+
+
+class TestParseMirror(TestCase):
+
+    def test_tsd(self):
+        mirror = parse_mirror("tsd://staging:4343", queue_max_bytes=100)
+
+        self.assertIsInstance(mirror, TSDMirror)
+        self.assertEqual((mirror.host, mirror.port), ("staging", 4343))
+        self.assertEqual(mirror.queue.max_bytes, 100)
+        self.assertEqual(mirror.queue.policy, 'drop_oldest')
+        self.assertEqual(parse_mirror("tsd://staging").port, 4242)
+
+    def test_file_with_options(self):
+        mirror = parse_mirror("file:///var/log/puts.log?policy=drop_newest&max_bytes=10",
+            queue_policy='drop_oldest')
+
+        self.assertIsInstance(mirror, FileMirror)
+        self.assertEqual(mirror.name, "file:///var/log/puts.log")
+        self.assertEqual(mirror.path, "/var/log/puts.log")
+        self.assertEqual(mirror.queue.policy, 'drop_newest')
+        self.assertEqual(mirror.queue.max_bytes, 10)
+
+    def test_invalid(self):
+        for spec in ("staging:4242", "http://staging", "tsd://", "tsd://staging:port",
+                "file://", "file:///puts.log?max_bytes=lots"):
+            self.assertRaises(ConfigurationException, parse_mirror, spec)
+
+    def test_blocking_isnt_allowed(self):
+        # A full mirror queue would hold up the primary
+        self.assertRaises(ConfigurationException, parse_mirror, "tsd://staging",
+            queue_policy='block')
+
+
+class TestMirrorSinks(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.mirrors = []
+
+    def tearDown(self):
+        for mirror in self.mirrors:
+            mirror.close()
+        shutil.rmtree(self.tempdir)
+
+    def start(self, spec, **kwargs):
+        mirror = parse_mirror(spec, **kwargs)
+        mirror.start()
+        self.mirrors.append(mirror)
+        return mirror
+
+    def test_file(self):
+        path = os.path.join(self.tempdir, "puts.log")
+        mirror = self.start("file://" + path)
+
+        mirror.send(MESSAGE)
+        mirror.send(MESSAGE)
+        wait_for(lambda: mirror.written_bytes == 2 * len(MESSAGE))
+
+        with open(path) as f:
+            self.assertEqual(f.read(), MESSAGE * 2)
+        self.assertEqual(mirror.lag, 0)
+
+    def test_tsd(self):
+        tsd = StubTSD()
+        try:
+            tsd.error_rate = 1
+            mirror = self.start("tsd://127.0.0.1:%d" % tsd.port)
+
+            mirror.send(MESSAGE)
+            wait_for(lambda: mirror.put_errors == 2)
+            self.assertEqual(tsd.lines, MESSAGE.splitlines())
+        finally:
+            tsd.stop()
+
+    def test_unreachable_mirror_drops_without_blocking(self):
+        mirror = self.start("tsd://127.0.0.1:%d" % free_port(), queue_max_bytes=len(MESSAGE) * 2)
+
+        started = time.time()
+        for _ in range(10):
+            mirror.send(MESSAGE)
+        self.assertLess(time.time() - started, 0.1)
+
+        wait_for(lambda: mirror.write_failures >= 1)
+        gevent.sleep(0.05)
+        self.assertGreater(mirror.queue.dropped_bytes, 0)
+        self.assertGreaterEqual(mirror.lag, 0.05)
+
+
+class TestMirroredForwarding(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "puts.log")
+        self.tsd = StubTSD()
+        self.mirror_tsd = StubTSD(latency=1)
+
+    def tearDown(self):
+        self.backend.close(timeout=0)
+        self.tsd.stop()
+        self.mirror_tsd.stop()
+        shutil.rmtree(self.tempdir)
+
+    def test_puts_are_copied(self):
+        self.backend = ForwardingOpenTSDBBackend(host='127.0.0.1', port=self.tsd.port,
+            fire_and_forget=True, mirrors=["file://" + self.path,
+            "tsd://127.0.0.1:%d" % self.mirror_tsd.port])
+
+        message = "put test.my.value 1366155625 42 host=a password=secret\n"
+        for _ in range(3):
+            self.backend.handle(message)
+        wait_for(lambda: len(self.tsd.lines) == 3 and len(self.mirror_tsd.lines) >= 1)
+
+        file_mirror = self.backend.mirrors[0]
+        wait_for(lambda: file_mirror.written_bytes == 3 * len(message))
+        with open(self.path) as f:
+            self.assertEqual(f.read(), message * 3)
+
+    def test_slow_mirror_doesnt_slow_primary(self):
+        self.backend = ForwardingOpenTSDBBackend(host='127.0.0.1', port=self.tsd.port,
+            fire_and_forget=True,
+            mirrors=["tsd://127.0.0.1:%d?max_bytes=%d" % (self.mirror_tsd.port, len(MESSAGE))])
+
+        for index in range(50):
+            self.backend.handle(MESSAGE.replace("1366155625", str(index)))
+        wait_for(lambda: len(self.tsd.lines) == 100)
+
+        mirror = self.backend.mirrors[0]
+        self.assertGreater(mirror.queue.dropped_bytes, 0)
+        self.assertLess(len(self.mirror_tsd.lines), 100)
+
+    def test_slow_file_mirror_doesnt_slow_primary(self):
+        self.backend = ForwardingOpenTSDBBackend(host='127.0.0.1', port=self.tsd.port,
+            fire_and_forget=True, mirrors=["file://" + self.path])
+        file_mirror = self.backend.mirrors[0]
+        append = file_mirror._append
+
+        def slow_append(data):
+            # Blocks its thread the way a stalled disk would
+            time.sleep(0.5)
+            append(data)
+
+        with mock.patch.object(file_mirror, '_append', side_effect=slow_append):
+            started = time.time()
+            for index in range(50):
+                self.backend.handle(MESSAGE.replace("1366155625", str(index)))
+            wait_for(lambda: len(self.tsd.lines) == 100)
+            self.assertLess(time.time() - started, 0.4)
+            self.assertEqual(file_mirror.written_bytes, 0)
+
+            wait_for(lambda: file_mirror.written_bytes > 0)
+
+    def test_puts_are_copied_without_fire_and_forget(self):
+        self.backend = ForwardingOpenTSDBBackend(host='127.0.0.1', port=self.tsd.port,
+            mirrors=["file://" + self.path])
+
+        self.backend.handle(MESSAGE + "version\n")
+        file_mirror = self.backend.mirrors[0]
+        wait_for(lambda: file_mirror.written_bytes == len(MESSAGE))
+        with open(self.path) as f:
+            self.assertEqual(f.read(), MESSAGE)
+
+    def test_no_mirrors_parses_once(self):
+        self.backend = ForwardingOpenTSDBBackend(host='127.0.0.1', port=self.tsd.port)
+
+        # opentsdbproxy.backends is shadowed by the package's backends dict
+        module = sys.modules[ForwardingOpenTSDBBackend.__module__]
+        with mock.patch.object(module, 'parse', wraps=parse) as wrapped:
+            self.backend.handle(MESSAGE)
+        self.assertEqual(wrapped.call_count, 1)
@@ -0,0 +1,81 @@
+from unittest import TestCase
+
+from opentsdbproxy.parser import parse, sanitize, tag_user
+
+LINE = "put test.my.value 1366155625 42 host=bandersnatch.phys.uvic.ca user=root password=secret\n"
+
+
+class TestParser(TestCase):
+
+    def test_put_fields(self):
+        record, = parse(LINE)
+
+        self.assertTrue(record.is_put)
+        self.assertEqual(record.metric, "test.my.value")
+        self.assertEqual(record.timestamp, "1366155625")
+        self.assertEqual(record.value, "42")
+        self.assertEqual(record.user, "root")
+        self.assertEqual(record.password, "secret")
+        self.assertEqual(record.tags, {'host': "bandersnatch.phys.uvic.ca", 'user': "root"})
+        self.assertEqual(record.line, LINE[:-1])
+
+    def test_offsets(self):
+        records = parse(LINE * 3)
+
+        self.assertEqual(len(records), 3)
+        for index, record in enumerate(records):
+            self.assertEqual(record.start, index * len(LINE))
+            self.assertEqual(record.end, (index + 1) * len(LINE) - 1)
+            self.assertTrue(record.newline)
+
+    def test_sanitize(self):
+        self.assertEqual(sanitize(parse(LINE)), LINE.replace(" password=secret", ""))
+
+        line = "put a 1 2 password=secret host=x user=root\n"
+        self.assertEqual(parse(line)[0].sanitized(), "put a 1 2 host=x user=root\n")
+
+    def test_tag_user(self):
+        records = parse("put a 1 2 host=x\nput b 1 2 host=y user=other\nput c 1 2 host=z\n")
+
+        self.assertEqual(sanitize(tag_user(records, "root")),
+            "put a 1 2 host=x user=root\nput b 1 2 host=y user=other\nput c 1 2 host=z user=root\n")
+        self.assertEqual([record.user for record in tag_user(records, "root")],
+            ["root", "other", "root"])
+
+    def test_sanitize_without_passwords_is_one_slice(self):
+        message = "put a 1 2 host=x\nput b 1 2 host=y\n"
+        records = parse(message)
+
+        self.assertEqual(sanitize(records), message)
+        self.assertEqual(sanitize(records[1:]), "put b 1 2 host=y\n")
+        self.assertEqual(sanitize([records[1], records[0]]), "put b 1 2 host=y\nput a 1 2 host=x\n")
+
+    def test_password_inside_tag_value(self):
+        line = "put a 1 2 note=password=secret user=root password=good\n"
+        record, = parse(line)
+
+        self.assertEqual(record.password, "good")
+        self.assertEqual(record.sanitized(), "put a 1 2 note=password=secret user=root\n")
+
+    def test_repeated_password_tags_all_removed(self):
+        record, = parse("put a 1 2 password=one user=root password=two\n")
+
+        self.assertEqual(record.password, "two")
+        self.assertEqual(record.sanitized(), "put a 1 2 user=root\n")
+
+    def test_line_endings_and_blank_lines(self):
+        records = parse("  put a 1 2 host=x  \r\n\n\nversion")
+
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].line, "put a 1 2 host=x")
+        self.assertEqual(records[1].command, "version")
+        self.assertFalse(records[1].is_put)
+        self.assertEqual(sanitize(records), "put a 1 2 host=x\nversion\n")
+
+    def test_malformed_put(self):
+        record, = parse("put user=root password=x\n")
+
+        self.assertTrue(record.is_put)
+        self.assertEqual(record.metric, None)
+        self.assertEqual(record.user, "root")
+        self.assertEqual(record.sanitized(), "put user=root\n")
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.parser import parse
+from opentsdbproxy.ratelimit import RateLimiter, load_overrides
+from opentsdbproxy.stats import registry
+
+LINE = "put test.my.value 1366155625 42 host=a user=%s\n"
+
+
+def records(user, count):
+    return parse(LINE % user * count)
+
+
+class TestRateLimiter(TestCase):
+
+    def test_unlimited(self):
+        limiter = RateLimiter()
+        lines = records('joshua', 100)
+        self.assertIs(limiter.limit(lines), lines)
+
+    def test_drop_lines(self):
+        throttled = registry.counter('throttled_lines_total', '', ('user',)).labels('dropper')
+        before = throttled.value
+        limiter = RateLimiter(lines_per_second=10)
+
+        self.assertEqual(len(limiter.limit(records('dropper', 4))), 4)
+        self.assertEqual(len(limiter.limit(records('dropper', 20))), 6)
+        self.assertEqual(len(limiter.limit(records('other', 10))), 10)
+        self.assertEqual(throttled.value - before, 14)
+
+    def test_drop_bytes(self):
+        limiter = RateLimiter(bytes_per_second=len(LINE % 'bytes') * 3)
+        self.assertEqual(len(limiter.limit(records('bytes', 5))), 3)
+
+    def test_refill(self):
+        limiter = RateLimiter(lines_per_second=100, burst=0.1)
+        self.assertEqual(len(limiter.limit(records('refill', 20))), 10)
+        time.sleep(0.05)
+        self.assertTrue(5 <= len(limiter.limit(records('refill', 20))) <= 8)
+
+    def test_overrides(self):
+        limiter = RateLimiter(lines_per_second=1, overrides={'big': (None, None), 'small': (2, None)})
+        self.assertEqual(len(limiter.limit(records('big', 50))), 50)
+        self.assertEqual(len(limiter.limit(records('small', 50))), 2)
+        self.assertEqual(len(limiter.limit(records('default', 50))), 1)
+
+    def test_per_address(self):
+        limiter = RateLimiter(lines_per_second=5, per_address=True)
+        self.assertEqual(len(limiter.limit(records('roamer', 10), ('10.0.0.1', 1234))), 5)
+        self.assertEqual(len(limiter.limit(records('roamer', 10), ('10.0.0.2', 1234))), 5)
+        self.assertEqual(len(limiter.limit(records('roamer', 10), ('10.0.0.1', 4321))), 0)
+
+    def test_delay(self):
+        limiter = RateLimiter(lines_per_second=100, burst=0.1, policy='delay')
+        started = time.time()
+        self.assertEqual(len(limiter.limit(records('slow', 20))), 20)
+        self.assertTrue(time.time() - started >= 0.09)
+
+    def test_bad_policy(self):
+        self.assertRaises(ConfigurationException, RateLimiter, policy='queue')
+
+
+class TestLoadOverrides(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "limits.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_load(self):
+        with open(self.path, 'w') as f:
+            json.dump({'a': {'lines': 10}, 'b': {'lines': 0, 'bytes': 100}}, f)
+        self.assertEqual(load_overrides(self.path), {'a': (10, None), 'b': (0, 100)})
+
+    def test_bad(self):
+        with open(self.path, 'w') as f:
+            f.write("[1, 2]")
+        self.assertRaises(ConfigurationException, load_overrides, self.path)
+        self.assertRaises(ConfigurationException, load_overrides, self.path + ".missing")
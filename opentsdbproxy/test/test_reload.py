@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+
+import gevent
+
+from unittest import TestCase
+
+from opentsdbproxy.bench.stubtsd import StubTSD
+
+from util import CapturingProxy, certificate_or_skip, free_port, wait_for
+
+LINE = "put test.my.value 1366155625 42 host=a\n"
+
+
+class TestReload(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cert, self.key = certificate_or_skip(self.tempdir)
+
+        self.tsd = StubTSD()
+        backend_parameters = dict(host='127.0.0.1', port=self.tsd.port, batch=True,
+            batch_max_delay_ms=60000, spool_dir=os.path.join(self.tempdir, "spool"))
+        CapturingProxy.proxy = None
+        self.greenlet = gevent.spawn(CapturingProxy, port=free_port(), backend='forwarding',
+            backend_parameters=backend_parameters, ssl_cert_path=self.cert,
+            ssl_key_path=self.key, drain_timeout=1)
+        wait_for(lambda: CapturingProxy.proxy is not None and
+            getattr(CapturingProxy.proxy, 'server', None) is not None)
+        self.proxy = CapturingProxy.proxy
+
+    def tearDown(self):
+        self.proxy.drain()
+        self.greenlet.join(timeout=2)
+        self.tsd.stop()
+        shutil.rmtree(self.tempdir)
+
+    def test_reload_with_spool_and_batcher(self):
+        old_backend = self.proxy.backend
+        old_backend.handle(LINE)
+
+        # The old replayer must be stopped before the new one starts
+        paused = []
+
+        def make_backend():
+            paused.append(old_backend.replayer._greenlet is None)
+            return CapturingProxy.make_backend(self.proxy)
+        self.proxy.make_backend = make_backend
+        self.proxy.reload()
+
+        backend = self.proxy.backend
+        self.assertIsNot(backend, old_backend)
+        self.assertEqual(paused, [True])
+        self.assertIs(backend.spool, old_backend.spool)
+        self.assertIsNone(old_backend.replayer._greenlet)
+        self.assertIsNotNone(backend.replayer._greenlet)
+
+        # The old backend's batch was flushed, and the new one batches
+        wait_for(lambda: self.tsd.lines == [LINE.strip()])
+        backend.handle(LINE)
+        self.assertEqual(backend.batchers.values()[0]._lines, 1)
+
+    def test_failed_reload_resumes(self):
+        old_backend = self.proxy.backend
+        self.proxy.backend_config = os.path.join(self.tempdir, "missing.json")
+        self.proxy.reload()
+
+        self.assertIs(self.proxy.backend, old_backend)
+        self.assertIsNotNone(old_backend.replayer._greenlet)
+
+    def test_tls_context_kept_unless_cert_changes(self):
+        context = self.proxy.ssl_context
+        self.proxy.reload()
+        self.assertIs(self.proxy.ssl_context, context)
+
+        with open(self.key, 'a') as f:
+            f.write("\n")
+        self.proxy.reload()
+        self.assertIsNot(self.proxy.ssl_context, context)
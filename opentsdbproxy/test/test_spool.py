@@ -0,0 +1,149 @@
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.spool import Spool, SpoolReplayer, open_spool, worker_spool_dir
+
+LINE = "put test.my.value 1366155625 42 host=a\n"
+
+
+class TestSpool(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_all(self, spool):
+        records = []
+        while spool.pending:
+            sequence = spool.oldest()
+            records.extend(data for _, data in spool.read(sequence))
+            spool.remove(sequence)
+        return records
+
+    def test_append_and_read(self):
+        spool = Spool(self.directory)
+        spool.append(LINE)
+        spool.append(LINE * 2)
+
+        self.assertEqual(self.read_all(spool), [LINE, LINE * 2])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_segments_rotate(self):
+        spool = Spool(self.directory, segment_size=len(LINE) * 3)
+        for i in range(5):
+            spool.append(LINE)
+
+        self.assertEqual(len(spool.segments), 3)
+        self.assertEqual(self.read_all(spool), [LINE] * 5)
+
+    def test_oldest_segments_are_evicted(self):
+        spool = Spool(self.directory, segment_size=100, max_size=250)
+        for i in range(10):
+            spool.append("%d%s" % (i, LINE))
+
+        self.assertTrue(spool.size <= 250)
+        self.assertTrue(spool.evicted_segments > 0)
+        records = self.read_all(spool)
+        self.assertEqual(records[-1], "9%s" % LINE)
+        self.assertNotIn("0%s" % LINE, records)
+
+    def test_recovers_segments(self):
+        spool = Spool(self.directory)
+        spool.append(LINE)
+        spool.close()
+
+        spool = Spool(self.directory)
+        spool.append(LINE * 2)
+        self.assertEqual(self.read_all(spool), [LINE, LINE * 2])
+
+    def test_truncated_record(self):
+        spool = Spool(self.directory)
+        spool.append(LINE)
+        spool.append(LINE)
+        sequence = spool.oldest()
+        with open(spool.segment_path(sequence), 'r+b') as segment:
+            segment.truncate(spool.segments[sequence] - 1)
+
+        self.assertEqual([data for _, data in spool.read(sequence)], [LINE])
+
+    def test_open_spool_is_shared(self):
+        spool = open_spool(self.directory)
+        spool.append(LINE)
+
+        # As when a reload builds a new backend while the old one closes
+        reopened = open_spool(self.directory, max_size=len(LINE) * 10)
+        self.assertIs(reopened, spool)
+        self.assertEqual(reopened.max_size, len(LINE) * 10)
+
+    def test_locked_against_other_processes(self):
+        Spool(self.directory)
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                Spool(self.directory)
+            except ConfigurationException:
+                os._exit(0)
+            os._exit(1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+    def test_worker_spool_dir(self):
+        self.assertEqual(worker_spool_dir("/var/spool/otp", 2), "/var/spool/otp/worker-2")
+        self.assertEqual(worker_spool_dir("/var/spool/otp", None), "/var/spool/otp")
+        self.assertEqual(worker_spool_dir(None, 2), None)
+
+        first = Spool(worker_spool_dir(self.directory, 0))
+        second = Spool(worker_spool_dir(self.directory, 1))
+        first.append(LINE)
+        self.assertFalse(second.pending)
+
+
+class TestSpoolReplayer(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sent = []
+        self.accept = 2
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def send(self, data):
+        if len(self.sent) >= self.accept:
+            return False
+        self.sent.append(data)
+        return True
+
+    def test_replay_resumes(self):
+        spool = Spool(self.directory)
+        for i in range(4):
+            spool.append("%d%s" % (i, LINE))
+        replayer = SpoolReplayer(spool, self.send, lambda: True, rate=10 ** 9)
+
+        self.assertFalse(replayer.replay_segment())
+        self.assertEqual(len(self.sent), 2)
+
+        self.accept = 10
+        self.assertTrue(replayer.replay_segment())
+        self.assertEqual(self.sent, ["%d%s" % (i, LINE) for i in range(4)])
+        self.assertFalse(spool.pending)
+
+    def test_replacement_replayer_resumes(self):
+        spool = open_spool(self.directory)
+        for i in range(4):
+            spool.append("%d%s" % (i, LINE))
+        replayer = SpoolReplayer(spool, self.send, lambda: True, rate=10 ** 9)
+        self.assertFalse(replayer.replay_segment())
+
+        # A reloaded backend's replayer picks up where the old one stopped
+        self.accept = 10
+        replayer = SpoolReplayer(open_spool(self.directory), self.send, lambda: True, rate=10 ** 9)
+        self.assertTrue(replayer.replay_segment())
+        self.assertEqual(self.sent, ["%d%s" % (i, LINE) for i in range(4)])
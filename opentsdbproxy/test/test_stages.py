@@ -0,0 +1,96 @@
+import time
+
+import gevent
+
+from unittest import TestCase
+
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.parser import parse
+from opentsdbproxy.stages import DuplicateFilter, Downsampler, parse_downsample_rule
+
+
+class TestDuplicateFilter(TestCase):
+
+    def test_drops_duplicates(self):
+        dedupe = DuplicateFilter(window=60)
+        message = ("put a 1366155625 1 host=x dc=y\n"
+            "put a 1366155625 2 dc=y host=x\n"
+            "put a 1366155626 1 host=x dc=y\n"
+            "put a 1366155625 1 host=z dc=y\n")
+
+        kept = dedupe.process(parse(message))
+        self.assertEqual([r.line for r in kept], [
+            "put a 1366155625 1 host=x dc=y",
+            "put a 1366155626 1 host=x dc=y",
+            "put a 1366155625 1 host=z dc=y"])
+        self.assertEqual(dedupe.duplicates, 1)
+
+        # Resent after a reconnect
+        self.assertEqual(dedupe.process(parse(message)), [])
+        self.assertEqual(dedupe.duplicates, 5)
+
+    def test_window_expires(self):
+        dedupe = DuplicateFilter(window=0.05)
+        message = "put a 1366155625 1 host=x\n"
+
+        self.assertEqual(len(dedupe.process(parse(message))), 1)
+        time.sleep(0.1)
+        self.assertEqual(len(dedupe.process(parse(message))), 1)
+        self.assertEqual(len(dedupe), 1)
+
+    def test_bounded(self):
+        dedupe = DuplicateFilter(max_entries=10)
+        dedupe.process(parse(''.join("put a %d 1 host=x\n" % t for t in range(100))))
+
+        self.assertEqual(len(dedupe), 10)
+
+
+class TestDownsampler(TestCase):
+
+    def setUp(self):
+        self.emitted = []
+
+    def tearDown(self):
+        self.downsampler.close()
+
+    def test_rules(self):
+        self.assertEqual(parse_downsample_rule("sys.*:60:avg")[1:], (60, 'avg'))
+        self.assertRaises(ConfigurationException, parse_downsample_rule, "sys.*:avg")
+        self.assertRaises(ConfigurationException, parse_downsample_rule, "sys.*:0:avg")
+        self.assertRaises(ConfigurationException, parse_downsample_rule, "sys.*:60:median")
+        self.downsampler = Downsampler([], self.emitted.append)
+
+    def test_aggregates(self):
+        self.downsampler = Downsampler(["sys.cpu.*:60:avg", "sys.mem:60:max"], self.emitted.append)
+        message = ("put sys.cpu.user 1366155600 1 host=x\n"
+            "put sys.cpu.user 1366155630 2 host=x\n"
+            "put sys.mem 1366155600 5 host=x\n"
+            "put sys.mem 1366155630 7 host=x\n"
+            "put sys.disk 1366155630 3 host=x\n")
+
+        passed = self.downsampler.process(parse(message))
+        self.assertEqual([r.metric for r in passed], ["sys.disk"])
+        self.assertEqual(self.emitted, [])
+
+        # The next interval closes the last one
+        self.downsampler.process(parse("put sys.cpu.user 1366155660 4 host=x\n"))
+        self.assertEqual(self.emitted, ["put sys.cpu.user 1366155600 1.5 host=x\n"])
+
+        self.downsampler.flush(everything=True)
+        self.assertEqual(sorted(self.emitted[1].splitlines()), [
+            "put sys.cpu.user 1366155660 4.0 host=x",
+            "put sys.mem 1366155600 7 host=x"])
+
+    def test_flushes_after_interval(self):
+        self.downsampler = Downsampler(["a:1:last"], self.emitted.append, check_interval=0.05)
+        self.downsampler.process(parse("put a 1366155600000 1 host=x\nput a 1366155600500 2 host=x\n"))
+
+        gevent.sleep(1.2)
+        self.assertEqual(self.emitted, ["put a 1366155600000 2 host=x\n"])
+
+    def test_late_points_pass(self):
+        self.downsampler = Downsampler(["a:60:min"], self.emitted.append)
+        self.downsampler.process(parse("put a 1366155660 1 host=x\n"))
+
+        passed = self.downsampler.process(parse("put a 1366155600 1 host=x\n"))
+        self.assertEqual(len(passed), 1)
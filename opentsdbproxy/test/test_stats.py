@@ -0,0 +1,72 @@
+from unittest import TestCase
+
+from gevent import socket
+
+from opentsdbproxy.stats import Registry, StatsServer
+
+
+class TestRegistry(TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_and_gauge(self):
+        counter = self.registry.counter('lines_total', "Lines")
+        counter.inc()
+        counter.inc(2)
+        self.registry.gauge('depth', "Depth", callback=lambda: 7)
+
+        rendered = self.registry.render()
+        self.assertIn("# TYPE opentsdbproxy_lines_total counter\n", rendered)
+        self.assertIn("opentsdbproxy_lines_total 3\n", rendered)
+        self.assertIn("opentsdbproxy_depth 7\n", rendered)
+
+    def test_same_metric_is_returned(self):
+        first = self.registry.counter('lines_total', "Lines")
+        self.assertIs(self.registry.counter('lines_total', "Lines"), first)
+        self.assertRaises(ValueError, self.registry.gauge, 'lines_total', "Lines")
+
+    def test_labels(self):
+        counter = self.registry.counter('throttled_total', "Throttled", labelnames=('user',))
+        counter.labels('root').inc()
+        counter.labels('a"b').inc(2)
+
+        rendered = self.registry.render()
+        self.assertIn('opentsdbproxy_throttled_total{user="root"} 1\n', rendered)
+        self.assertIn('opentsdbproxy_throttled_total{user="a\\"b"} 2\n', rendered)
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('seconds', "Seconds", buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(5)
+
+        rendered = self.registry.render()
+        self.assertIn('opentsdbproxy_seconds_bucket{le="0.1"} 2\n', rendered)
+        self.assertIn('opentsdbproxy_seconds_bucket{le="1.0"} 2\n', rendered)
+        self.assertIn('opentsdbproxy_seconds_bucket{le="+Inf"} 3\n', rendered)
+        self.assertIn('opentsdbproxy_seconds_count 3\n', rendered)
+
+
+class TestStatsServer(TestCase):
+
+    def test_serves_metrics(self):
+        registry = Registry()
+        registry.counter('lines_total', "Lines").inc(5)
+        server = StatsServer(0, address='127.0.0.1', stats_registry=registry)
+        server.start()
+        try:
+            sock = socket.create_connection(('127.0.0.1', server.server.server_port))
+            sock.sendall("GET /metrics HTTP/1.0\r\n\r\n")
+            response = ''
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                response += data
+            sock.close()
+        finally:
+            server.stop()
+
+        self.assertTrue(response.startswith("HTTP/1.1 200"))
+        self.assertIn("opentsdbproxy_lines_total 5\n", response)
@@ -0,0 +1,151 @@
+import os
+import signal
+import shutil
+import tempfile
+import subprocess
+
+from unittest import TestCase
+
+import gevent
+
+from gevent import socket, ssl
+from gevent.server import StreamServer
+
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.stats import registry
+from opentsdbproxy.tls import make_server_context, read_fingerprint, OP_NO_TICKET
+
+from util import certificate_or_skip
+
+
+class TestServerContext(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cert, self.key = certificate_or_skip(self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_options(self):
+        context = make_server_context(self.cert, self.key)
+        self.assertTrue(context.options & ssl.OP_NO_SSLv3)
+        self.assertFalse(context.options & OP_NO_TICKET)
+
+        context = make_server_context(self.cert, self.key, session_tickets=False)
+        self.assertTrue(context.options & OP_NO_TICKET)
+
+    def test_bad_settings(self):
+        self.assertRaises(ConfigurationException, make_server_context,
+            self.cert + ".missing", self.key)
+        self.assertRaises(ConfigurationException, make_server_context,
+            self.cert, self.key, ciphers="NOT-A-CIPHER")
+        self.assertRaises(ConfigurationException, make_server_context,
+            self.cert, self.key, ecdh_curve="not-a-curve")
+
+    def handshake_with(self, context, client_ciphers):
+        """Returns True if a TLS 1.2 client offering only client_ciphers can connect"""
+        def handle(sock, address):
+            try:
+                context.wrap_socket(sock, server_side=True).close()
+            except (ssl.SSLError, socket.error):
+                pass
+
+        server = StreamServer(('127.0.0.1', 0), handle)
+        server.start()
+        client_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        client_context.options |= getattr(ssl, 'OP_NO_TLSv1_3', 0)
+        client_context.set_ciphers(client_ciphers)
+        try:
+            client_context.wrap_socket(
+                socket.create_connection(('127.0.0.1', server.server_port))).close()
+            return True
+        except ssl.SSLError:
+            return False
+        finally:
+            server.stop()
+
+    def test_default_ciphers_allow_older_clients(self):
+        # An RSA key exchange, as offered by clients without ECDHE
+        context = make_server_context(self.cert, self.key)
+        self.assertTrue(self.handshake_with(context, "AES128-GCM-SHA256"))
+
+        context = make_server_context(self.cert, self.key, ciphers='hardened')
+        self.assertFalse(self.handshake_with(context, "AES128-GCM-SHA256"))
+        self.assertTrue(self.handshake_with(context, "ECDHE-RSA-AES128-GCM-SHA256"))
+
+    def test_handshake_counted(self):
+        context = make_server_context(self.cert, self.key)
+
+        def handle(sock, address):
+            tls_sock = context.wrap_socket(sock, server_side=True)
+            tls_sock.sendall(tls_sock.recv(100))
+            tls_sock.close()
+
+        server = StreamServer(('127.0.0.1', 0), handle)
+        server.start()
+        try:
+            client = ssl.wrap_socket(socket.create_connection(('127.0.0.1', server.server_port)))
+            client.sendall("version\n")
+            self.assertEqual(client.recv(100), "version\n")
+            client.close()
+        finally:
+            server.stop()
+
+        full = registry.metrics['opentsdbproxy_tls_full_handshakes_total']
+        self.assertEqual(full.samples()[0][2], 1)
+
+    def test_fingerprint(self):
+        fingerprint = read_fingerprint(self.cert, self.key)
+        self.assertEqual(read_fingerprint(self.cert, self.key), fingerprint)
+        self.assertIsNone(read_fingerprint(self.cert + ".missing", self.key))
+
+        with open(self.key, 'a') as f:
+            f.write("\n")
+        self.assertNotEqual(read_fingerprint(self.cert, self.key), fingerprint)
+
+    def serve_in_child(self, context):
+        """Serve TLS from a forked process, like a worker, returning its port"""
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                gevent.reinit()
+
+                def handle(sock, address):
+                    try:
+                        context.wrap_socket(sock, server_side=True).close()
+                    except (ssl.SSLError, socket.error):
+                        pass
+                StreamServer(listener, handle).serve_forever()
+            finally:
+                os._exit(0)
+        port = listener.getsockname()[1]
+        listener.close()
+        self.children.append(pid)
+        return port
+
+    def resumed(self, first_port, second_port):
+        session = os.path.join(self.tempdir, "session")
+        for port, option in ((first_port, '-sess_out'), (second_port, '-sess_in')):
+            process = subprocess.Popen(['openssl', 's_client', '-connect', '127.0.0.1:%d' % port,
+                '-tls1_2', option, session], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+            output = process.communicate('')[0]
+        return "Reused," in output
+
+    def test_tickets_resume_across_forked_workers(self):
+        self.children = []
+        try:
+            shared = make_server_context(self.cert, self.key)
+            self.assertTrue(self.resumed(self.serve_in_child(shared), self.serve_in_child(shared)))
+
+            separate = [make_server_context(self.cert, self.key) for _ in range(2)]
+            self.assertFalse(self.resumed(self.serve_in_child(separate[0]),
+                self.serve_in_child(separate[1])))
+        finally:
+            for pid in self.children:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
@@ -0,0 +1,453 @@
+import os
+import time
+import socket
+import shutil
+import tempfile
+
+import gevent
+import gevent.socket
+import mock
+
+from unittest import TestCase
+
+from opentsdbproxy.backends import ForwardingOpenTSDBBackend
+from opentsdbproxy.bench.stubtsd import StubTSD, StubHTTPTSD, STUB_VERSION
+from opentsdbproxy.exceptions import ConfigurationException, UpstreamUnavailable
+from opentsdbproxy.httpoutput import put_datapoints
+from opentsdbproxy.upstream import CircuitBreaker, UpstreamConnection, UpstreamPool, \
+    parse_upstreams
+
+from util import CapturingProxy, certificate_or_skip, free_port, wait_for
+
+
+class TestFireAndForgetForwarding(TestCase):
+
+    def setUp(self):
+        self.tsd = StubTSD()
+        self.backend = ForwardingOpenTSDBBackend(host='127.0.0.1',
+            port=self.tsd.port, fire_and_forget=True)
+
+    def tearDown(self):
+        self.backend.close()
+        self.tsd.stop()
+
+    def wait_for_lines(self, count):
+        with gevent.Timeout(2):
+            while len(self.tsd.lines) < count:
+                gevent.sleep(0.01)
+
+    def test_puts_dont_wait(self):
+        msg = "put test.my.value 1366155625 42 host=a\nput test.my.value 1366155626 43 host=a\n"
+        with gevent.Timeout(0.5):
+            response = self.backend.handle(msg)
+        self.assertIsNone(response)
+
+        self.wait_for_lines(2)
+        self.assertEqual(self.tsd.lines, msg.splitlines())
+
+    def test_requests_are_matched_to_replies(self):
+        self.tsd.error_rate = 1
+        msg = "put test.my.value 1366155625 bad host=a\nversion\n"
+        response = self.backend.handle(msg)
+        self.assertEqual(response, STUB_VERSION)
+        self.assertEqual(self.backend.upstream.put_errors, 1)
+
+
+class TestForwarding(TestCase):
+
+    def setUp(self):
+        self.tsd = StubTSD()
+        self.backend = ForwardingOpenTSDBBackend(host='127.0.0.1', port=self.tsd.port,
+            upstream_connections=1)
+
+    def tearDown(self):
+        self.backend.close()
+        self.tsd.stop()
+
+    def test_interleaved_puts_and_versions(self):
+        self.tsd.error_rate = 0.5
+        put = "put test.my.value 1366155625 42 host=a\n"
+
+        def client(index):
+            responses = []
+            for _ in range(5):
+                self.assertIsNone(self.backend.handle(put * index))
+                responses.append(self.backend.handle(put + "version\n" + put))
+            return responses
+
+        greenlets = [gevent.spawn(client, index) for index in range(1, 5)]
+        with gevent.Timeout(5):
+            gevent.joinall(greenlets, raise_error=True)
+
+        # No reply went to the wrong request, however the puts were answered
+        for greenlet in greenlets:
+            self.assertEqual(greenlet.value, [STUB_VERSION] * 5)
+        with gevent.Timeout(2):
+            while len(self.tsd.lines) < 5 * (1 + 2 + 3 + 4) + 4 * 5 * 2:
+                gevent.sleep(0.01)
+
+    def test_late_reply_isnt_handed_on(self):
+        connection = UpstreamConnection('127.0.0.1', self.tsd.port)
+        self.assertTrue(connection.open())
+        self.assertEqual(connection.request("version\n"), STUB_VERSION)
+
+        self.tsd.latency = 0.3
+        connection.request("version\n")
+        self.assertIsNone(connection.request("version\n", timeout=0.05))
+        self.assertFalse(connection.connected)
+
+        self.assertTrue(connection.open())
+        self.assertEqual(connection.request("version\n"), STUB_VERSION)
+        connection.close()
+
+
+class TestUpstreamPool(TestCase):
+
+    def setUp(self):
+        self.tsd = StubTSD()
+
+    def tearDown(self):
+        self.pool.close()
+        self.tsd.stop()
+
+    def test_round_robin(self):
+        self.pool = UpstreamPool('127.0.0.1', self.tsd.port, size=3)
+
+        checked_out = [self.pool.checkout() for _ in range(6)]
+        self.assertEqual(checked_out, self.pool.connections * 2)
+
+    def test_least_loaded(self):
+        self.pool = UpstreamPool('127.0.0.1', self.tsd.port, size=2, checkout='least_loaded')
+
+        busy = self.pool.checkout()
+        busy.send("put test.my.value 1366155625 42 host=a\n")
+        self.assertIsNot(self.pool.checkout(), busy)
+
+    def test_broken_members_reconnect(self):
+        self.pool = UpstreamPool('127.0.0.1', self.tsd.port, size=2, reconnect_interval=0.05)
+        self.pool.start()
+
+        broken = self.pool.connections[0]
+        broken.close()
+        self.assertNotIn(broken, [self.pool.checkout() for _ in range(4)])
+
+        with gevent.Timeout(1):
+            while not broken.connected:
+                gevent.sleep(0.01)
+
+
+class TestBatchedForwarding(TestCase):
+
+    def setUp(self):
+        self.tsd = StubTSD()
+        self.backend = ForwardingOpenTSDBBackend(host='127.0.0.1',
+            port=self.tsd.port, batch=True, batch_max_delay_ms=10000)
+
+    def tearDown(self):
+        self.tsd.stop()
+
+    def test_close_flushes(self):
+        msg = "put test.my.value 1366155625 42 host=a\n"
+        self.assertIsNone(self.backend.handle(msg))
+        self.assertIsNone(self.backend.handle(msg))
+        self.assertEqual(self.tsd.lines, [])
+
+        self.backend.close()
+        gevent.sleep(0.1)
+        self.assertEqual(self.tsd.lines, msg.splitlines() * 2)
+
+
+class TestShardedForwarding(TestCase):
+
+    def setUp(self):
+        self.tsds = [StubTSD(), StubTSD(), StubTSD()]
+        hosts = ','.join("127.0.0.1:%d" % tsd.port for tsd in self.tsds)
+        self.backend = ForwardingOpenTSDBBackend(host=hosts, port=4242, batch=True,
+            batch_max_delay_ms=10)
+
+    def tearDown(self):
+        self.backend.close()
+        for tsd in self.tsds:
+            tsd.stop()
+
+    def wait_for_lines(self, count):
+        with gevent.Timeout(2):
+            while sum(len(tsd.lines) for tsd in self.tsds) < count:
+                gevent.sleep(0.01)
+
+    def test_parse_upstreams(self):
+        self.assertEqual(parse_upstreams("a, b:4243", "4242"), [('a', 4242), ('b', 4243)])
+        self.assertRaises(ConfigurationException, parse_upstreams, "a:port", 4242)
+        self.assertRaises(ConfigurationException, parse_upstreams, ",", 4242)
+
+    def test_series_stay_on_one_tsd(self):
+        lines = []
+        for timestamp in range(1366155625, 1366155635):
+            for host in range(30):
+                # Tag order must not matter
+                if timestamp % 2:
+                    lines.append("put test.my.value %d 42 host=h%d dc=x\n" % (timestamp, host))
+                else:
+                    lines.append("put test.my.value %d 42 dc=x host=h%d\n" % (timestamp, host))
+        self.assertIsNone(self.backend.handle(''.join(lines)))
+        self.wait_for_lines(len(lines))
+
+        owners = {}
+        for index, tsd in enumerate(self.tsds):
+            self.assertTrue(tsd.lines)
+            for line in tsd.lines:
+                series = tuple(sorted(line.split()[4:]))
+                self.assertEqual(owners.setdefault(series, index), index)
+        self.assertEqual(len(owners), 30)
+
+    def test_requests_go_to_any_tsd(self):
+        self.assertEqual(self.backend.handle("version\n"), STUB_VERSION)
+
+
+class TestStagedForwarding(TestCase):
+
+    def setUp(self):
+        self.tsd = StubTSD()
+        self.backend = ForwardingOpenTSDBBackend(host='127.0.0.1', port=self.tsd.port,
+            dedupe_window=60, downsample=["sys.cpu.*:60:max"])
+
+    def tearDown(self):
+        self.tsd.stop()
+
+    def test_dedupe_and_downsample(self):
+        msg = ("put test.my.value 1366155625 42 host=a\n"
+            "put sys.cpu.user 1366155600 1 host=a\n"
+            "put sys.cpu.user 1366155610 3 host=a\n")
+        self.assertIsNone(self.backend.handle(msg))
+        self.assertIsNone(self.backend.handle(msg))
+
+        self.backend.close()
+        gevent.sleep(0.1)
+        self.assertEqual(sorted(self.tsd.lines), ["put sys.cpu.user 1366155600 3 host=a",
+            "put test.my.value 1366155625 42 host=a"])
+
+
+class TestHTTPForwarding(TestCase):
+
+    def setUp(self):
+        self.tsd = StubHTTPTSD()
+        self.backend = ForwardingOpenTSDBBackend(host='127.0.0.1', port=self.tsd.port,
+            upstream_protocol='http', upstream_connections=2, http_batch_size=100,
+            http_linger_ms=20)
+
+    def tearDown(self):
+        self.backend.close()
+        self.tsd.stop()
+
+    def wait_for_lines(self, count):
+        with gevent.Timeout(2):
+            while len(self.tsd.lines) < count:
+                gevent.sleep(0.01)
+
+    def test_put_datapoints(self):
+        datapoints, invalid = put_datapoints(
+            "put a 1366155625 42 host=x password=p\nput b 1366155625 0.5 host=y\nput c x 1 host=z\n")
+
+        self.assertEqual(invalid, 1)
+        self.assertEqual(datapoints, [
+            {'metric': 'a', 'timestamp': 1366155625, 'value': 42, 'tags': {'host': 'x'}},
+            {'metric': 'b', 'timestamp': 1366155625, 'value': 0.5, 'tags': {'host': 'y'}}])
+
+    def test_puts_are_batched(self):
+        lines = ["put test.my.value %d 42 host=a\n" % timestamp
+            for timestamp in range(1366155625, 1366155625 + 250)]
+        for line in lines:
+            self.assertIsNone(self.backend.handle(line))
+        self.wait_for_lines(len(lines))
+
+        self.assertEqual(sorted(self.tsd.lines), sorted(line.strip() for line in lines))
+        self.assertTrue(self.tsd.requests <= 5)
+        self.assertTrue(self.tsd.requests >= 3)
+
+    def test_failed_points_are_counted(self):
+        self.tsd.error_rate = 1
+        self.backend.handle("put test.my.value 1366155625 42 host=a\n" * 3)
+        self.wait_for_lines(3)
+
+        with gevent.Timeout(2):
+            while self.backend.upstream.put_errors < 3:
+                gevent.sleep(0.01)
+        self.assertEqual(self.backend.upstream.put_errors, 3)
+
+    def test_version(self):
+        self.assertEqual(self.backend.handle("version\n"), "net.opentsdb stub built at revision stub\n")
+
+
+class TestCircuitBreaker(TestCase):
+
+    def test_backoff_doubles(self):
+        breaker = CircuitBreaker("tsd", backoff=1, max_backoff=4)
+        self.assertTrue(breaker.closed)
+        self.assertTrue(breaker.allow())
+
+        backoffs = []
+        for _ in range(4):
+            breaker.failure()
+            backoffs.append(breaker.current_backoff)
+        self.assertEqual(backoffs, [1, 2, 4, 4])
+        self.assertFalse(breaker.allow())
+
+        breaker.success()
+        self.assertTrue(breaker.closed)
+        self.assertTrue(breaker.allow())
+
+    def test_one_trial_after_backoff(self):
+        breaker = CircuitBreaker("tsd", backoff=0.01)
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+        gevent.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+
+class TestUpstreamHealth(TestCase):
+
+    def setUp(self):
+        self.tsd = None
+        self.pool = None
+
+    def tearDown(self):
+        if self.pool is not None:
+            self.pool.close()
+        if self.tsd is not None:
+            self.tsd.stop()
+
+    def test_connect_tries_every_address(self):
+        self.tsd = StubTSD()
+        addresses = [(socket.AF_INET, socket.SOCK_STREAM, 0, '', ('127.0.0.1', free_port())),
+            (socket.AF_INET, socket.SOCK_STREAM, 0, '', ('127.0.0.1', self.tsd.port))]
+        connection = UpstreamConnection('localhost', self.tsd.port)
+
+        with mock.patch('opentsdbproxy.upstream.socket.getaddrinfo', return_value=addresses):
+            self.assertTrue(connection.open())
+        connection.close()
+
+    def test_down_tsd_fails_fast_and_recovers(self):
+        port = free_port()
+        self.pool = UpstreamPool('127.0.0.1', port, size=2, reconnect_interval=0.02,
+            circuit_backoff=0.05)
+
+        self.assertIsNone(self.pool.checkout())
+        self.assertFalse(self.pool.breaker.closed)
+        with mock.patch.object(UpstreamConnection, 'connect') as connect:
+            started = time.time()
+            for _ in range(100):
+                self.assertIsNone(self.pool.checkout())
+            self.assertTrue(time.time() - started < 0.05)
+            self.assertFalse(connect.called)
+
+        self.tsd = StubTSD(port=port)
+        with gevent.Timeout(2):
+            while not self.pool.healthy:
+                gevent.sleep(0.01)
+        self.assertTrue(self.pool.breaker.closed)
+        self.assertIsNotNone(self.pool.checkout())
+
+    def test_probe_closes_unresponsive_members(self):
+        self.tsd = StubTSD()
+        self.pool = UpstreamPool('127.0.0.1', self.tsd.port, size=1, reconnect_interval=60,
+            circuit_backoff=60)
+        self.pool.start()
+        self.assertTrue(self.pool.probe())
+
+        # Connected, but the TSD never answers
+        with mock.patch.object(UpstreamConnection, 'request', return_value=None):
+            self.assertFalse(self.pool.probe())
+        self.assertFalse(self.pool.connections[0].connected)
+        self.assertFalse(self.pool.breaker.closed)
+
+    def test_failover_to_standby(self):
+        self.tsd = StubTSD()
+        backend = ForwardingOpenTSDBBackend(host='127.0.0.1', port=free_port(),
+            standby_hosts="127.0.0.1:%d" % self.tsd.port, fire_and_forget=True)
+        try:
+            msg = "put test.my.value 1366155625 42 host=a\n"
+            self.assertIsNone(backend.handle(msg))
+            with gevent.Timeout(2):
+                while not self.tsd.lines:
+                    gevent.sleep(0.01)
+            self.assertEqual(self.tsd.lines, [msg.strip()])
+            self.assertIs(backend.upstream.active, backend.upstream.pools[1])
+        finally:
+            backend.close()
+
+    def test_http_upstream_recovers_without_traffic(self):
+        tempdir = tempfile.mkdtemp()
+        port = free_port()
+        backend = ForwardingOpenTSDBBackend(host='127.0.0.1', port=port, upstream_protocol='http',
+            http_linger_ms=0, spool_dir=os.path.join(tempdir, "spool"),
+            upstream_probe_interval=0.02, upstream_backoff=0.05)
+        try:
+            backend.replayer.check_interval = 0.02
+            msg = "put test.my.value 1366155625 42 host=a\n"
+            backend.handle(msg)
+            wait_for(lambda: backend.spool.size)
+            self.assertFalse(backend.upstream.healthy)
+
+            # No more puts arrive, so only the probes can find the TSD is back
+            self.tsd = StubHTTPTSD(port=port)
+            wait_for(lambda: self.tsd.lines == [msg.strip()])
+            self.assertTrue(backend.upstream.healthy)
+        finally:
+            backend.close(0)
+            shutil.rmtree(tempdir)
+
+    def test_no_upstream_without_spool(self):
+        backend = ForwardingOpenTSDBBackend(host='127.0.0.1', port=free_port(),
+            fire_and_forget=True, upstream_backoff=60)
+        try:
+            msg = "put test.my.value 1366155625 42 host=a\n"
+            self.assertRaises(UpstreamUnavailable, backend.handle, msg)
+            self.assertFalse(backend.upstream.breaker.closed)
+            # With the breaker open, later writes fail without connecting
+            with mock.patch.object(UpstreamConnection, 'connect') as connect:
+                self.assertRaises(UpstreamUnavailable, backend.handle, msg)
+                self.assertRaises(UpstreamUnavailable, backend.handle, "version\n")
+                self.assertFalse(connect.called)
+        finally:
+            backend.close(0)
+
+    def test_standby_with_sharding(self):
+        self.assertRaises(ConfigurationException, ForwardingOpenTSDBBackend,
+            host="a,b", port=4242, standby_hosts="c")
+
+
+class TestUpstreamUnavailableProxy(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        cert, key = certificate_or_skip(self.tempdir)
+        self.port = free_port()
+        CapturingProxy.proxy = None
+        self.greenlet = gevent.spawn(CapturingProxy, port=free_port(), plaintext_port=self.port,
+            backend='forwarding', backend_parameters=dict(host='127.0.0.1', port=free_port(),
+            upstream_backoff=60), ssl_cert_path=cert, ssl_key_path=key, drain_timeout=1)
+        wait_for(lambda: CapturingProxy.proxy is not None and
+            getattr(CapturingProxy.proxy, 'plaintext_server', None) is not None)
+        self.proxy = CapturingProxy.proxy
+
+    def tearDown(self):
+        self.proxy.drain()
+        self.greenlet.join(timeout=2)
+        shutil.rmtree(self.tempdir)
+
+    def test_connection_stays_open(self):
+        client = gevent.socket.create_connection(('127.0.0.1', self.port))
+        client.settimeout(0.2)
+        msg = "put test.my.value 1366155625 42 host=a\n"
+        with mock.patch('opentsdbproxy.log') as log:
+            for _ in range(3):
+                client.sendall(msg)
+                self.assertRaises(socket.timeout, client.recv, 1)
+        client.close()
+
+        # Logged once for the three messages rather than with a traceback each
+        self.assertEqual(log.warning.call_count, 1)
+        self.assertFalse(log.exception.called)
+        self.assertEqual(self.proxy.unavailable_dropped, 2)
@@ -0,0 +1,120 @@
+import os
+import time
+import errno
+import signal
+import shutil
+import tempfile
+
+from gevent import socket
+
+from nose.plugins.skip import SkipTest
+from unittest import TestCase
+
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.workers import SO_REUSEPORT, WorkerSupervisor, reuse_port_listener
+
+from util import wait_for
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class TestWorkerSupervisor(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.supervisor_pid = None
+
+    def tearDown(self):
+        if self.supervisor_pid is not None and alive(self.supervisor_pid):
+            os.kill(self.supervisor_pid, signal.SIGKILL)
+            os.waitpid(self.supervisor_pid, 0)
+        shutil.rmtree(self.tempdir)
+
+    def record_start(self, index):
+        """Runs in each worker, leaving a file named for its index and pid"""
+        open(os.path.join(self.tempdir, "%d-%d" % (index, os.getpid())), 'w').close()
+
+    def starts(self):
+        return sorted(tuple(int(part) for part in name.split('-'))
+            for name in os.listdir(self.tempdir))
+
+    def supervise(self, supervisor):
+        """Run the supervisor in its own process, as it forks and takes signals"""
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                supervisor.run()
+                status = 0
+            except ConfigurationException:
+                status = 2
+            finally:
+                os._exit(status)
+        self.supervisor_pid = pid
+
+    def test_fork_restart_stop(self):
+        def run_worker(index):
+            self.record_start(index)
+            time.sleep(60)
+
+        self.supervise(WorkerSupervisor(2, run_worker, restart_delay=0.01, startup_grace=0.1))
+        wait_for(lambda: len(self.starts()) == 2, timeout=5)
+        self.assertEqual([index for index, _ in self.starts()], [0, 1])
+
+        # A worker that dies is replaced under the same index
+        time.sleep(0.2)
+        _, first_pid = self.starts()[0]
+        os.kill(first_pid, signal.SIGKILL)
+        wait_for(lambda: len(self.starts()) == 3, timeout=5)
+        self.assertEqual(sorted(index for index, _ in self.starts()), [0, 0, 1])
+
+        os.kill(self.supervisor_pid, signal.SIGTERM)
+        _, status = os.waitpid(self.supervisor_pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.supervisor_pid = None
+        for _, pid in self.starts():
+            wait_for(lambda: not alive(pid), timeout=5)
+
+    def test_stops_when_workers_cant_start(self):
+        def run_worker(index):
+            self.record_start(index)
+            raise ConfigurationException("bad config")
+
+        started = time.time()
+        self.supervise(WorkerSupervisor(2, run_worker, restart_delay=0.01,
+            max_startup_failures=3))
+        _, status = os.waitpid(self.supervisor_pid, 0)
+        self.supervisor_pid = None
+
+        self.assertEqual(os.WEXITSTATUS(status), 2)
+        self.assertLess(time.time() - started, 2)
+        # Stopped at the third start of whichever worker got there first
+        self.assertLessEqual(len(self.starts()), 6)
+        self.assertGreaterEqual(len(self.starts()), 3)
+
+    def test_needs_a_worker(self):
+        self.assertRaises(ConfigurationException, WorkerSupervisor, 0, lambda index: None)
+
+
+class TestReusePortListener(TestCase):
+
+    def test_listeners_share_a_port(self):
+        if SO_REUSEPORT is None:
+            raise SkipTest("SO_REUSEPORT isn't supported here")
+
+        first = reuse_port_listener(0, '127.0.0.1')
+        port = first.getsockname()[1]
+        second = reuse_port_listener(port, '127.0.0.1')
+        try:
+            self.assertEqual(second.getsockname()[1], port)
+            client = socket.create_connection(('127.0.0.1', port))
+            client.close()
+        finally:
+            first.close()
+            second.close()
@@ -0,0 +1,43 @@
+"""Helpers shared by the test modules"""
+
+import shutil
+import subprocess
+
+import gevent
+
+from nose.plugins.skip import SkipTest
+
+from opentsdbproxy import OpenTSDBProxy
+from opentsdbproxy.bench.harness import free_port, make_certificate
+
+__all__ = ['free_port', 'wait_for', 'certificate_or_skip', 'CapturingProxy']
+
+
+def wait_for(condition, timeout=2):
+    """Yield to other greenlets until condition() is true, failing the test
+    with gevent.Timeout after timeout seconds
+    """
+    with gevent.Timeout(timeout):
+        while not condition():
+            gevent.sleep(0.01)
+
+
+def certificate_or_skip(tempdir):
+    """Make a self signed cert and key in tempdir, removing tempdir and
+    skipping the test if openssl isn't installed
+
+    @returns - (cert path, key path)
+    """
+    try:
+        return make_certificate(tempdir)
+    except (OSError, subprocess.CalledProcessError):
+        shutil.rmtree(tempdir)
+        raise SkipTest("openssl is needed to make a test certificate")
+
+
+class CapturingProxy(OpenTSDBProxy):
+    """Keeps hold of the proxy, whose constructor serves until it is drained"""
+
+    def make_backend(self):
+        self.__class__.proxy = self
+        return OpenTSDBProxy.make_backend(self)
@@ -0,0 +1,97 @@
+"""The TLS context shared by every client connection
+
+One SSLContext per process means one session cache and one set of session
+ticket keys, so a tcollector reconnecting to the same process resumes its
+session rather than doing a full handshake. Workers forked after the context
+is made share its ticket keys, so tickets resume on any of them.
+"""
+
+import hashlib
+import logging
+
+from gevent import ssl
+
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.stats import registry
+
+log = logging.getLogger(__name__)
+
+# Not exported by the ssl module before Python 3.6
+OP_NO_TICKET = getattr(ssl, 'OP_NO_TICKET', 0x4000)
+
+# Forward secret ciphers only, for ciphers='hardened'. Without a cipher list
+# the Python default is kept, so older clients can still connect.
+HARDENED_CIPHERS = "ECDHE+AESGCM:ECDHE+CHACHA20:ECDHE+AES:!aNULL:!MD5:!DSS"
+DEFAULT_ECDH_CURVE = "prime256v1"
+
+HANDSHAKE_SECONDS = registry.histogram('tls_handshake_seconds', "Time spent in each TLS handshake")
+HANDSHAKE_FAILURES = registry.counter('tls_handshake_failures_total',
+    "TLS handshakes that failed or timed out")
+
+
+def make_server_context(cert_path, key_path, ciphers=None, ecdh_curve=None, session_tickets=True):
+    """make_server_context
+
+    @param ciphers - OpenSSL cipher list, or 'hardened' for HARDENED_CIPHERS.
+                     The Python default if None
+    @param ecdh_curve - curve for ECDHE key exchange, prime256v1 by default
+    @param session_tickets - let clients resume with tickets as well as from
+                             the session cache
+
+    @returns - an SSLContext for the listener
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_COMPRESSION
+    context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    if not session_tickets:
+        context.options |= OP_NO_TICKET
+
+    try:
+        context.load_cert_chain(cert_path, key_path)
+    except (IOError, ssl.SSLError) as e:
+        raise ConfigurationException("Couldn't load SSL cert '%s' and key '%s': %s" % (
+            cert_path, key_path, e))
+    if ciphers is not None:
+        try:
+            context.set_ciphers(HARDENED_CIPHERS if ciphers == 'hardened' else ciphers)
+        except ssl.SSLError as e:
+            raise ConfigurationException("Bad SSL cipher list '%s': %s" % (ciphers, e))
+    try:
+        context.set_ecdh_curve(ecdh_curve or DEFAULT_ECDH_CURVE)
+    except (ValueError, ssl.SSLError) as e:
+        raise ConfigurationException("Bad ECDH curve '%s': %s" % (ecdh_curve, e))
+
+    register_stats(context)
+    return context
+
+
+def read_fingerprint(cert_path, key_path):
+    """read_fingerprint
+
+    @returns - a digest of the cert and key files' contents, to tell whether
+               they changed, or None if they couldn't be read
+    """
+    digest = hashlib.sha256()
+    try:
+        for path in (cert_path, key_path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    except IOError:
+        return None
+    return digest.hexdigest()
+
+
+def register_stats(context):
+    def stat(name):
+        return lambda: context.session_stats()[name]
+
+    registry.counter('tls_resumed_handshakes_total', "TLS handshakes that resumed a session",
+        callback=stat('hits'))
+    registry.counter('tls_full_handshakes_total', "TLS handshakes that negotiated a new session",
+        callback=lambda: context.session_stats()['accept_good'] - context.session_stats()['hits'])
+    registry.counter('tls_session_cache_misses_total', "Resumptions asked for that weren't cached",
+        callback=stat('misses'))
+    registry.counter('tls_session_cache_timeouts_total', "Resumptions asked for that had expired",
+        callback=stat('timeouts'))
+    registry.gauge('tls_session_cache_entries', "Sessions in the session cache",
+        callback=stat('number'))
@@ -0,0 +1,710 @@
+import time
+import logging
+
+from collections import deque, OrderedDict
+
+import gevent
+
+from gevent import socket
+from gevent.event import AsyncResult
+from gevent.lock import Semaphore
+from opentsdbproxy.exceptions import ConfigurationException
+from opentsdbproxy.hashring import HashRing
+from opentsdbproxy.ingestqueue import IngestQueue, DEFAULT_MAX_BYTES
+from opentsdbproxy.stats import registry
+
+log = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 1
+REQUEST_TIMEOUT = 1
+RECV_SIZE = 4096
+
+DEFAULT_POOL_SIZE = 4
+RECONNECT_INTERVAL = 5
+PROBE_TIMEOUT = 2
+DRAIN_TIMEOUT = 5
+
+CIRCUIT_BACKOFF = 1
+CIRCUIT_MAX_BACKOFF = 60
+
+ROUND_ROBIN = 'round_robin'
+LEAST_LOADED = 'least_loaded'
+CHECKOUT_POLICIES = (ROUND_ROBIN, LEAST_LOADED)
+
+BYTES_FORWARDED = registry.counter('bytes_forwarded_total', "Bytes written to OpenTSDB")
+PUT_ERRORS = registry.counter('put_errors_total', "Puts rejected by OpenTSDB")
+SENDALL_SECONDS = registry.histogram('upstream_sendall_seconds', "Time spent in each sendall to OpenTSDB")
+SHARD_LINES = registry.counter('shard_lines_total', "Lines routed to each OpenTSDB shard", ('shard',))
+CIRCUIT_OPEN = registry.gauge('upstream_circuit_open',
+    "1 while an OpenTSDB upstream is failing fast, 0 once it is back", ('upstream',))
+CIRCUIT_OPENED = registry.counter('upstream_circuit_opened_total',
+    "Times an OpenTSDB upstream started failing fast", ('upstream',))
+PROBE_FAILURES = registry.counter('upstream_probe_failures_total',
+    "Health probes that got no version reply or couldn't connect", ('upstream',))
+FAILOVERS = registry.counter('upstream_failovers_total',
+    "Times writes moved to a different upstream of a failover group", ('upstream',))
+
+
+def parse_upstreams(hosts, default_port):
+    """parse_upstreams
+
+    @param hosts - a host, or a comma separated list of host or host:port
+    @param default_port - port for hosts given without one
+
+    @returns - list of (host, port)
+    """
+    upstreams = []
+    for entry in hosts.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, port = entry, default_port
+        if entry.count(':') == 1:
+            host, port = entry.split(':')
+        try:
+            port = int(port)
+        except (TypeError, ValueError):
+            raise ConfigurationException("Bad OpenTSDB port in '%s'" % entry)
+        upstreams.append((host, port))
+    if not upstreams:
+        raise ConfigurationException("No OpenTSDB hosts in '%s'" % hosts)
+    return upstreams
+
+
+class UpstreamConnection(object):
+    """A persistent connection to an OpenTSDB TSD
+
+    Writes are queued and sent by a writer greenlet, so callers never block
+    on the upstream socket. A reader greenlet hands replies to outstanding
+    requests in the order the requests were written. OpenTSDB doesn't reply
+    to a successful put, and reports a failed put with a line starting with
+    'put:', so puts must be written with send, never request, and 'put:'
+    lines are logged rather than matched to a request. Replies have no
+    delimiter, so one request is outstanding at a time and whatever
+    arrives for it is its reply.
+
+    If on_failure is given, it is called with any data that couldn't be
+    written, including everything still queued when the connection drops.
+    Otherwise queued data waits for the connection to be reopened.
+
+    Queued writes are bounded by queue_max_bytes, see IngestQueue for the
+    queue_policy choices.
+    """
+
+    def __init__(self, host, port, request_timeout=None, on_failure=None,
+            queue_max_bytes=None, queue_policy=None):
+        self.host = host
+        self.port = port
+        self.request_timeout = request_timeout or REQUEST_TIMEOUT
+        self.on_failure = on_failure
+
+        self.sock = None
+        self._queue = IngestQueue(queue_max_bytes, queue_policy)
+        self._pending = deque()
+        self._requesting = Semaphore()
+        self._partial = ''
+        self._writer = None
+        self._reader = None
+        self._writing = False
+
+        self.put_errors = 0
+
+    def __repr__(self):
+        return "<%s %s:%s>" % (self.__class__.__name__, self.host, self.port)
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    @property
+    def queue(self):
+        return self._queue
+
+    @property
+    def load(self):
+        """Writes waiting to be sent plus requests waiting for a reply"""
+        return self._queue.qsize() + len(self._pending)
+
+    def connect(self):
+        """connect to OpenTSDB. Taken from tcollector
+        """
+
+        adresses = socket.getaddrinfo(self.host, self.port, socket.AF_UNSPEC,
+                                      socket.SOCK_STREAM, 0)
+        for family, socktype, proto, canonname, sockaddr in adresses:
+            try:
+                connection = socket.socket(family, socktype, proto)
+                connection.settimeout(CONNECT_TIMEOUT)
+                connection.connect(sockaddr)
+                return connection
+            except socket.error as msg:
+                log.warning('Connection attempt failed to %s:%s: %s',
+                            self.host, self.port, msg)
+        return None
+
+    def open(self):
+        """open
+
+        Connect to OpenTSDB and start the writer and reader greenlets
+
+        @returns - True if the connection is up
+        """
+        if self.connected:
+            return True
+
+        try:
+            sock = self.connect()
+        except socket.error as e:
+            # getaddrinfo failed
+            log.warning("Couldn't resolve OpenTSDB %s:%s: %s" % (self.host, self.port, e))
+            return False
+        if sock is None:
+            return False
+        sock.settimeout(None)
+
+        self.sock = sock
+        self._partial = ''
+        self._writer = gevent.spawn(self._write_loop, sock)
+        self._reader = gevent.spawn(self._read_loop, sock)
+        log.debug("Connected to OpenTSDB %s:%s" % (self.host, self.port))
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self._disconnect(self.sock)
+
+    def drain(self, timeout=None):
+        """drain
+
+        Wait for queued writes to be written to OpenTSDB
+
+        @param timeout - seconds to wait
+
+        @returns - True if nothing is left to write
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.connected and (self._writing or not self._queue.empty()):
+            if deadline is not None and time.time() >= deadline:
+                break
+            gevent.sleep(0.01)
+        return not self._writing and self._queue.empty()
+
+    def send(self, data):
+        """send
+
+        Queue data to be written to OpenTSDB, without waiting for it to be
+        written or for a reply
+
+        @param data - one or more newline terminated lines
+
+        @returns - False if the queue was full and data was dropped
+        """
+        return self._queue.put(data)
+
+    def request(self, data, timeout=None):
+        """request
+
+        Write data to OpenTSDB and wait for the reply
+
+        @param data - one or more newline terminated lines
+        @param timeout - seconds to wait for a reply
+
+        @returns - the reply, or None if there was none within the timeout,
+                   in which case the connection is closed, as the late
+                   reply would otherwise be handed to the next request
+        """
+        if timeout is None:
+            timeout = self.request_timeout
+
+        with self._requesting:
+            if not self.connected:
+                return None
+            result = AsyncResult()
+            self._pending.append(result)
+            if not self._queue.put(data):
+                self._pending.remove(result)
+                return None
+            try:
+                return result.get(timeout=timeout)
+            except gevent.Timeout:
+                try:
+                    self._pending.remove(result)
+                except ValueError:
+                    return None
+                log.warning("No reply from OpenTSDB %s:%s within %ss, reconnecting" % (
+                    self.host, self.port, timeout))
+                self.close()
+                return None
+
+    def _write_loop(self, sock):
+        while True:
+            data = self._queue.get()
+            self._writing = True
+            started = time.time()
+            try:
+                sock.sendall(data)
+                self._writing = False
+                SENDALL_SECONDS.observe(time.time() - started)
+                BYTES_FORWARDED.inc(len(data))
+            except socket.error as e:
+                self._writing = False
+                log.warning("Failed writing %d bytes to OpenTSDB %s:%s: %s" % (
+                    len(data), self.host, self.port, e))
+                self._fail(data)
+                self._disconnect(sock)
+                return
+
+    def _read_loop(self, sock):
+        try:
+            while True:
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    log.warning("OpenTSDB %s:%s closed the connection" % (self.host, self.port))
+                    break
+                self._dispatch(data)
+        except socket.error as e:
+            log.warning("Error reading from OpenTSDB %s:%s: %s" % (self.host, self.port, e))
+        self._disconnect(sock)
+
+    def _dispatch(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+
+        reply = []
+        for line in lines:
+            if line.startswith('put:'):
+                self.put_errors += 1
+                PUT_ERRORS.inc()
+                log.warning("OpenTSDB %s:%s rejected %s" % (self.host, self.port, line))
+            else:
+                reply.append(line + '\n')
+
+        if not reply:
+            return
+        if self._pending:
+            self._pending.popleft().set(''.join(reply))
+        else:
+            log.debug("Unexpected reply from OpenTSDB: '%s'" % ''.join(reply))
+
+    def _disconnect(self, sock):
+        if self.sock is not sock:
+            return
+        self.sock = None
+
+        current = gevent.getcurrent()
+        for greenlet in (self._writer, self._reader):
+            if greenlet is not None and greenlet is not current:
+                greenlet.kill(block=False)
+        self._writer = self._reader = None
+
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+        while self._pending:
+            self._pending.popleft().set(None)
+
+        if self.on_failure is not None:
+            while not self._queue.empty():
+                self._fail(self._queue.get())
+
+    def _fail(self, data):
+        if self.on_failure is None:
+            log.warning("Lost %d bytes for OpenTSDB %s:%s" % (len(data), self.host, self.port))
+            return
+        try:
+            self.on_failure(data)
+        except Exception:
+            log.exception("Lost %d bytes for OpenTSDB %s:%s" % (len(data), self.host, self.port))
+
+
+class CircuitBreaker(object):
+    """Fails fast while an upstream is down
+
+    The circuit is closed while the upstream works. Each failure opens it
+    for a backoff that doubles with every consecutive failure, from backoff
+    up to max_backoff seconds, and while it is open allow() is False, so
+    callers give up at once instead of waiting on a connect timeout. Once
+    the backoff has passed, allow() is True for a single trial, and a
+    success closes the circuit again.
+
+    @param name - the upstream, for logs and the circuit metrics
+    """
+
+    def __init__(self, name, backoff=None, max_backoff=None):
+        self.name = name
+        self.backoff = backoff or CIRCUIT_BACKOFF
+        self.max_backoff = max_backoff or CIRCUIT_MAX_BACKOFF
+        self.failures = 0
+        self.retry_at = 0
+
+    @property
+    def closed(self):
+        return self.failures == 0
+
+    @property
+    def current_backoff(self):
+        if not self.failures:
+            return 0
+        return min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+
+    def allow(self):
+        """allow
+
+        @returns - True if the upstream should be tried now
+        """
+        if not self.failures:
+            return True
+        now = time.time()
+        if now < self.retry_at:
+            return False
+        # Let this trial through, and hold everything else back until it is done
+        self.retry_at = now + self.current_backoff
+        return True
+
+    def success(self):
+        if self.failures:
+            log.info("OpenTSDB %s is back after %d failures" % (self.name, self.failures))
+            CIRCUIT_OPEN.labels(self.name).set(0)
+        self.failures = 0
+        self.retry_at = 0
+
+    def failure(self):
+        if not self.failures:
+            CIRCUIT_OPENED.labels(self.name).inc()
+            CIRCUIT_OPEN.labels(self.name).set(1)
+        self.failures += 1
+        self.retry_at = time.time() + self.current_backoff
+        log.warning("OpenTSDB %s is failing, next try in %ss" % (self.name, self.current_backoff))
+
+
+class UpstreamPool(object):
+    """A fixed number of persistent connections to one TSD
+
+    Each message is written whole to a single member connection, and every
+    member has its own writer greenlet, so writes from different clients
+    never interleave.
+
+    Every reconnect_interval seconds each connected member is probed with a
+    version request, and a member that doesn't answer within probe_timeout
+    is closed, while members that lost their connection are reconnected.
+    A CircuitBreaker stops checkout from connecting, and the probes from
+    reconnecting, while the TSD is down, so a dead TSD costs nothing but the
+    occasional trial connect.
+
+    queue_max_bytes bounds the writes queued across all members, and is
+    split evenly between them.
+    """
+
+    def __init__(self, host, port, size=None, checkout=None,
+            reconnect_interval=None, request_timeout=None, on_failure=None,
+            queue_max_bytes=None, queue_policy=None, probe_timeout=None,
+            circuit_backoff=None, circuit_max_backoff=None):
+        self.host = host
+        self.port = port
+        self.size = size or DEFAULT_POOL_SIZE
+        self.checkout_policy = checkout or ROUND_ROBIN
+        if self.checkout_policy not in CHECKOUT_POLICIES:
+            raise ConfigurationException("Unknown upstream checkout policy '%s', choose from %s" % (
+                self.checkout_policy, ', '.join(CHECKOUT_POLICIES)))
+        self.reconnect_interval = reconnect_interval or RECONNECT_INTERVAL
+        self.probe_timeout = probe_timeout or PROBE_TIMEOUT
+        self.breaker = CircuitBreaker("%s:%s" % (host, port), backoff=circuit_backoff,
+            max_backoff=circuit_max_backoff)
+
+        member_max_bytes = (queue_max_bytes or DEFAULT_MAX_BYTES) // self.size
+        self.connections = [UpstreamConnection(host, port, request_timeout=request_timeout,
+            on_failure=on_failure, queue_max_bytes=member_max_bytes, queue_policy=queue_policy)
+            for _ in range(self.size)]
+        self._next = 0
+        self._reconnector = None
+
+    def __repr__(self):
+        return "<%s %s:%s x%d>" % (self.__class__.__name__, self.host, self.port, self.size)
+
+    @property
+    def healthy(self):
+        return any(connection.connected for connection in self.connections)
+
+    @property
+    def put_errors(self):
+        return sum(connection.put_errors for connection in self.connections)
+
+    @property
+    def queued_bytes(self):
+        return sum(connection.queue.bytes for connection in self.connections)
+
+    @property
+    def dropped_bytes(self):
+        return sum(connection.queue.dropped_bytes for connection in self.connections)
+
+    @property
+    def dropped_items(self):
+        return sum(connection.queue.dropped_items for connection in self.connections)
+
+    def start(self):
+        if self._reconnector is not None:
+            return
+        self._reconnector = gevent.spawn(self._probe_loop)
+        self.reconnect()
+
+    def reconnect(self):
+        """reconnect
+
+        Reopen members that lost their connection, unless the circuit is open
+
+        @returns - True if any member is connected
+        """
+        for connection in self.connections:
+            if connection.connected:
+                continue
+            if not self.breaker.allow():
+                break
+            log.debug("Reconnecting %s" % connection)
+            if connection.open():
+                self.breaker.success()
+            else:
+                self.breaker.failure()
+        return self.healthy
+
+    def close(self, timeout=DRAIN_TIMEOUT):
+        """close
+
+        Give queued writes up to timeout seconds to reach OpenTSDB, then
+        close every member connection
+        """
+        if self._reconnector is not None:
+            self._reconnector.kill(block=False)
+            self._reconnector = None
+
+        deadline = time.time() + (timeout or 0)
+        for connection in self.connections:
+            if not connection.drain(max(0, deadline - time.time())):
+                log.warning("Closing %s with writes still queued" % connection)
+            connection.close()
+
+    def checkout(self):
+        """checkout
+
+        Choose the member connection to write the next message to
+
+        @returns - a connected UpstreamConnection, or None if no member could
+                   connect to OpenTSDB
+        """
+        self.start()
+
+        connected = [c for c in self.connections if c.connected]
+        if not connected:
+            if not self.breaker.allow():
+                return None
+            connection = self.connections[self._next % self.size]
+            self._next += 1
+            if connection.open():
+                self.breaker.success()
+                return connection
+            self.breaker.failure()
+            return None
+
+        if self.checkout_policy == LEAST_LOADED:
+            return min(connected, key=lambda c: c.load)
+
+        connection = connected[self._next % len(connected)]
+        self._next += 1
+        return connection
+
+    def probe(self):
+        """probe
+
+        Ask each connected member for the version, closing those that don't
+        answer, then reconnect the members that are down
+
+        @returns - True if any member is connected afterwards
+        """
+        probed = failed = 0
+        for connection in self.connections:
+            # A member with writes queued would answer late, and a probe
+            # stuck behind them would look like a dead TSD
+            if not connection.connected or connection.load:
+                continue
+            probed += 1
+            if connection.request("version\n", timeout=self.probe_timeout) is None:
+                failed += 1
+                log.warning("%s didn't answer a health probe" % connection)
+                PROBE_FAILURES.labels(self.breaker.name).inc()
+                connection.close()
+        if probed and probed == failed:
+            # Connected but not answering, so treat it as down
+            self.breaker.failure()
+        return self.reconnect()
+
+    def _probe_loop(self):
+        while True:
+            gevent.sleep(self.reconnect_interval)
+            try:
+                self.probe()
+            except Exception:
+                log.exception("Failed probing %s" % self)
+
+
+class FailoverPool(object):
+    """A primary upstream followed by standbys
+
+    checkout returns a connection from the first upstream that is up, so
+    writes move to a standby as soon as the primary's circuit opens, and move
+    back once its probes succeed again. It has the same counters as an
+    UpstreamPool.
+
+    @param pools - UpstreamPools or HTTPUpstreams, the primary first
+    """
+
+    def __init__(self, pools):
+        self.pools = list(pools)
+        self.active = self.pools[0]
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, ','.join(repr(pool) for pool in self.pools))
+
+    @property
+    def connections(self):
+        return [c for pool in self.pools for c in pool.connections]
+
+    @property
+    def healthy(self):
+        return any(pool.healthy for pool in self.pools)
+
+    @property
+    def put_errors(self):
+        return sum(pool.put_errors for pool in self.pools)
+
+    @property
+    def queued_bytes(self):
+        return sum(pool.queued_bytes for pool in self.pools)
+
+    @property
+    def dropped_bytes(self):
+        return sum(pool.dropped_bytes for pool in self.pools)
+
+    @property
+    def dropped_items(self):
+        return sum(pool.dropped_items for pool in self.pools)
+
+    def start(self):
+        self.pools[0].start()
+
+    def close(self, timeout=DRAIN_TIMEOUT):
+        deadline = time.time() + (timeout or 0)
+        for pool in self.pools:
+            pool.close(max(0, deadline - time.time()))
+
+    def checkout(self):
+        """checkout
+
+        @returns - a connection to the first upstream that is up, or None
+        """
+        for pool in self.pools:
+            connection = pool.checkout()
+            if connection is None:
+                continue
+            if pool is not self.active:
+                log.warning("Writing to OpenTSDB %s:%s instead of %s:%s" % (
+                    pool.host, pool.port, self.active.host, self.active.port))
+                FAILOVERS.labels("%s:%s" % (pool.host, pool.port)).inc()
+                self.active = pool
+            return connection
+        return None
+
+
+class ShardedUpstream(object):
+    """An UpstreamPool for each of several TSDs, with every series routed to
+    one of them by a consistent hash of its metric and sorted tags
+
+    A series always lands on the same TSD, and adding or removing a TSD only
+    moves about 1/n of the series. It has the same counters and checkout as
+    an UpstreamPool, where checkout returns a connection to any TSD, for
+    requests like version that aren't tied to a series.
+
+    queue_max_bytes bounds the writes queued across all TSDs, and is split
+    evenly between them. pool_class is UpstreamPool, or anything with the
+    same interface such as an HTTPUpstream.
+    """
+
+    def __init__(self, upstreams, vnodes=None, queue_max_bytes=None, pool_class=None,
+            **pool_parameters):
+        pool_class = pool_class or UpstreamPool
+        shard_max_bytes = (queue_max_bytes or DEFAULT_MAX_BYTES) // len(upstreams)
+        self.pools = OrderedDict()
+        for host, port in upstreams:
+            name = "%s:%s" % (host, port)
+            self.pools[name] = pool_class(host, port, queue_max_bytes=shard_max_bytes,
+                **pool_parameters)
+        self.ring = HashRing(self.pools, vnodes=vnodes)
+        self._next = 0
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, ','.join(self.pools))
+
+    @property
+    def connections(self):
+        return [c for pool in self.pools.values() for c in pool.connections]
+
+    @property
+    def healthy(self):
+        return any(pool.healthy for pool in self.pools.values())
+
+    @property
+    def put_errors(self):
+        return sum(pool.put_errors for pool in self.pools.values())
+
+    @property
+    def queued_bytes(self):
+        return sum(pool.queued_bytes for pool in self.pools.values())
+
+    @property
+    def dropped_bytes(self):
+        return sum(pool.dropped_bytes for pool in self.pools.values())
+
+    @property
+    def dropped_items(self):
+        return sum(pool.dropped_items for pool in self.pools.values())
+
+    def start(self):
+        for pool in self.pools.values():
+            pool.start()
+
+    def close(self, timeout=DRAIN_TIMEOUT):
+        deadline = time.time() + (timeout or 0)
+        for pool in self.pools.values():
+            pool.close(max(0, deadline - time.time()))
+
+    def checkout(self):
+        """checkout
+
+        @returns - a connection to any TSD that is up, or None
+        """
+        pools = self.pools.values()
+        for offset in range(len(pools)):
+            connection = pools[(self._next + offset) % len(pools)].checkout()
+            if connection is not None:
+                self._next += offset + 1
+                return connection
+        return None
+
+    def route(self, records):
+        """route
+
+        @param records - parser.Record puts
+
+        @returns - list of (UpstreamPool, records for it), keeping the
+                   records' order within each
+        """
+        routes = OrderedDict()
+        for record in records:
+            routes.setdefault(self.ring.get(record.series), []).append(record)
+        routed = []
+        for name, group in routes.items():
+            SHARD_LINES.labels(name).inc(len(group))
+            routed.append((self.pools[name], group))
+        return routed
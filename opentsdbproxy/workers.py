@@ -0,0 +1,177 @@
+import os
+import sys
+import time
+import errno
+import signal
+import logging
+
+import gevent
+
+from gevent import socket
+
+from opentsdbproxy.exceptions import ConfigurationException
+
+log = logging.getLogger(__name__)
+
+LISTEN_BACKLOG = 256
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+STARTUP_GRACE = 5
+MAX_STARTUP_FAILURES = 5
+
+# Python 2 doesn't define SO_REUSEPORT, but Linux has had it since 3.9
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+if SO_REUSEPORT is None and sys.platform.startswith('linux'):
+    SO_REUSEPORT = 15
+
+
+def reuse_port_listener(port, address=''):
+    """reuse_port_listener
+
+    Create a listening socket that other processes can bind to the same port,
+    letting the kernel spread incoming connections across them
+
+    @param port - port to listen on
+    @param address - address to listen on, all addresses by default
+    """
+    if SO_REUSEPORT is None:
+        raise ConfigurationException("SO_REUSEPORT isn't supported on %s" % sys.platform)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        listener.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    except socket.error as e:
+        listener.close()
+        raise ConfigurationException("Couldn't set SO_REUSEPORT: %s" % e)
+    listener.bind((address, port))
+    listener.listen(LISTEN_BACKLOG)
+    return listener
+
+
+class WorkerSupervisor(object):
+    """Runs a proxy in several forked worker processes
+
+    Each worker calls run_worker with its index, and should build its own
+    backend and listen with SO_REUSEPORT. Workers that exit are restarted until the
+    supervisor is asked to stop with SIGTERM or SIGINT, which it passes on to
+    every worker. SIGHUP is passed on too, so every worker reloads.
+
+    A worker that exits within startup_grace seconds of starting is restarted
+    after a delay that doubles with each such exit, up to MAX_RESTART_DELAY,
+    and after max_startup_failures in a row every worker is stopped and run
+    raises ConfigurationException, as the worker can't start at all.
+    """
+
+    def __init__(self, workers, run_worker, restart_delay=RESTART_DELAY,
+            startup_grace=STARTUP_GRACE, max_startup_failures=MAX_STARTUP_FAILURES):
+        if workers < 1:
+            raise ConfigurationException("At least one worker is needed, not %s" % workers)
+        self.workers = workers
+        self.run_worker = run_worker
+        self.restart_delay = restart_delay
+        self.startup_grace = startup_grace
+        self.max_startup_failures = max_startup_failures
+        self.children = {}
+        self.started = {}
+        self.startup_failures = {}
+        self.running = False
+
+    def run(self):
+        self.running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+
+        for index in range(self.workers):
+            self._spawn(index)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+
+            index = self.children.pop(pid, None)
+            started = self.started.pop(pid, None)
+            if index is None:
+                continue
+            if not self.running:
+                log.debug("Worker %d (pid %d) exited" % (index, pid))
+                continue
+
+            if time.time() - started < self.startup_grace:
+                failures = self.startup_failures[index] = self.startup_failures.get(index, 0) + 1
+            else:
+                failures = self.startup_failures[index] = 0
+            if failures >= self.max_startup_failures:
+                log.error("Worker %d exited %d times within %ss of starting, stopping" % (
+                    index, failures, self.startup_grace))
+                self._stop(None, None)
+                self._wait_all()
+                raise ConfigurationException("Worker %d keeps exiting as it starts, see the log" % index)
+
+            delay = min(MAX_RESTART_DELAY, self.restart_delay * 2 ** failures)
+            log.warning("Worker %d (pid %d) died with status %d, restarting in %ss" % (
+                index, pid, status, delay))
+            time.sleep(delay)
+            if self.running:
+                self._spawn(index)
+
+        log.info("All workers stopped")
+
+    def _wait_all(self):
+        while self.children:
+            try:
+                pid, _ = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            self.children.pop(pid, None)
+            self.started.pop(pid, None)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            self.started[pid] = time.time()
+            log.info("Started worker %d (pid %d)" % (index, pid))
+            return
+
+        # The worker must never return into the supervisor's loop
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            gevent.reinit()
+            self.run_worker(index)
+            status = 0
+        except BaseException:
+            log.exception("Worker %d failed" % index)
+        finally:
+            os._exit(status)
+
+    def _reload(self, signum, frame):
+        log.info("Reloading %d workers..." % len(self.children))
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except OSError:
+                pass
+
+    def _stop(self, signum, frame):
+        if not self.running:
+            return
+        self.running = False
+        log.info("Stopping %d workers..." % len(self.children))
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
@@ -29,6 +29,7 @@ setupdict = {
     'License :: OSI Approved :: Apache Software License',
     'Operating System :: OS Independent',
     'Programming Language :: Python',
+    'Programming Language :: Python :: 2.7',
     'Topic :: Scientific/Engineering'],
 }
 
@@ -37,7 +38,9 @@ setupdict['packages'] = find_packages()
 
 setupdict['test_suite'] = 'opentsdb'
 
-setupdict['install_requires'] = ['gevent>=0.13.7']
+# ssl.SSLContext needs 2.7.9, and gevent 1.1 is the first to serve with one
+setupdict['python_requires'] = '>=2.7.9, <3'
+setupdict['install_requires'] = ['gevent>=1.1']
 setupdict['tests_require'] = ['nose', 'mock']
 setupdict['extras_require'] = {
     'test': setupdict['tests_require'],
@@ -48,6 +51,8 @@ setupdict['test_suite'] = 'nose.collector'
 setupdict['entry_points'] = {
     'console_scripts': [
         'opentsdb-proxy=opentsdbproxy.cli:main',
+        'opentsdb-proxy-bench=opentsdbproxy.bench.harness:main',
+        'opentsdb-proxy-microbench=opentsdbproxy.bench.micro:main',
     ]
 }
 